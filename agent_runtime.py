@@ -1,8 +1,11 @@
 import re
+import time
 import xml.etree.ElementTree as ET
 from dataclasses import dataclass, field
 
+import metrics
 from lite_toolcall_client import LiteToolcallManager
+from settings import Config
 
 
 DENIED_AGENT_PROMPT = "当前用户无权使用Agent能力，未传入具体工具调用文档。"
@@ -47,6 +50,13 @@ class AgentToolRound:
 
 
 def normalize_agent_config(config: dict) -> dict:
+    if isinstance(config, Config):
+        # 配置快照不可变，规范化结果在同一快照上只计算一次
+        return config.memo("agent", lambda: _normalize_agent_config(config))
+    return _normalize_agent_config(config)
+
+
+def _normalize_agent_config(config: dict) -> dict:
     agent = config.get("agent")
     if not isinstance(agent, dict):
         agent = {}
@@ -81,17 +91,28 @@ def normalize_agent_config(config: dict) -> dict:
     }
 
 
+def _access_sets(config: dict) -> tuple[frozenset, frozenset]:
+    if isinstance(config, Config):
+        whitelist = config.memo(
+            "agent_whitelist_set",
+            lambda: frozenset(normalize_agent_config(config)["tool_call_whitelist"]),
+        )
+        return config.owner_set, whitelist
+    owner_ids = frozenset(str(item) for item in config.get("owner_ids", []) or [])
+    return owner_ids, frozenset(normalize_agent_config(config)["tool_call_whitelist"])
+
+
 def agent_access(user_id: str | None, config: dict) -> str:
     agent = normalize_agent_config(config)
     if not agent["enabled"]:
         return "off"
     normalized_user = str(user_id or "")
-    owner_ids = [str(item) for item in config.get("owner_ids", []) or []]
+    owner_ids, whitelist = _access_sets(config)
     if normalized_user in owner_ids:
         return "owner"
     if agent.get("tool_call_allow_all"):
         return "whitelist"
-    if normalized_user in agent["tool_call_whitelist"]:
+    if normalized_user in whitelist:
         return "whitelist"
     return "denied"
 
@@ -190,7 +211,9 @@ def execute_tool_calls(manager: LiteToolcallManager, calls: list[dict]) -> Agent
         else:
             raw = call.get("raw", "")
             print(f"[Agent ToolCall] 调用 #{index} -> {server}: raw_len={len(raw)}, raw={_preview(raw)}")
+            started = time.monotonic()
             response = manager.run(server, raw)
+            metrics.STAGE_SECONDS.observe(time.monotonic() - started, stage='tool_call')
             result = str(response.get("result", ""))
             image = "是" if response.get("img_base64") else "否"
             print(
@@ -203,6 +226,7 @@ def execute_tool_calls(manager: LiteToolcallManager, calls: list[dict]) -> Agent
             "result": str(response.get("result", "")),
         }
         round_result.calls.append(item)
+        metrics.TOOL_CALLS.inc(server=item["server"], status=item["status"])
         if response.get("img_base64"):
             round_result.images.append({
                 "mime": response.get("img_mime", "image/png"),
@@ -0,0 +1,232 @@
+import re
+
+from settings import Config
+
+
+DEFAULT_TOKENIZER = 'estimate'
+DEFAULT_TOTAL_TOKENS = 16000
+DEFAULT_SECTION_TOKENS = {
+    'memory': 2000,
+    'summary': 1000,
+    'context': 6000,
+    'image': 1500,
+    'tool_results': 4000,
+    'input': 3000,
+}
+
+# 超出总预算时按这个顺序继续压缩各部分（越靠前越先被压缩）
+TOTAL_TRIM_ORDER = ('context', 'tool_results', 'summary', 'memory', 'image', 'input')
+
+TRUNCATED_MARKER = '…（内容过长，已省略）…'
+
+_CJK = re.compile(r'[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+
+def estimate_tokens(text: str) -> int:
+    '''
+    按字符粗略估算token数：中日韩字符每个约1个token，其余字符约4个一个token。
+
+    :param text: 文本
+    '''
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _tiktoken_counter():
+    import tiktoken
+    encoding = tiktoken.get_encoding('cl100k_base')
+    return lambda text: len(encoding.encode(text or '', disallowed_special=()))
+
+
+# 可用的计数器：{名称: 返回计数函数的工厂}
+TOKENIZERS = {
+    'estimate': lambda: estimate_tokens,
+    'tiktoken': _tiktoken_counter,
+}
+
+_counters = {}
+
+
+def register_tokenizer(name: str, factory) -> None:
+    '''
+    注册token计数器，之后可以在配置`prompt_budget.tokenizer`中使用。
+
+    :param name: 计数器名称
+    :param factory: 无参函数，返回`count(text) -> int`
+    '''
+    TOKENIZERS[name] = factory
+    _counters.pop(name, None)
+
+
+def get_tokenizer(name: str):
+    '''
+    获取token计数函数，未知或无法加载时退回字符估算。
+
+    :param name: 计数器名称
+    '''
+    counter = _counters.get(name)
+    if counter is not None:
+        return counter
+    factory = TOKENIZERS.get(name)
+    if factory is None:
+        print(f'[Prompt预算] 未知的计数器 {name}，使用字符估算')
+        counter = estimate_tokens
+    else:
+        try:
+            counter = factory()
+        except Exception as e:
+            print(f'[Prompt预算] 计数器 {name} 加载失败，使用字符估算: {e}')
+            counter = estimate_tokens
+    _counters[name] = counter
+    return counter
+
+
+def _non_negative_int(value, default: int) -> int:
+    try:
+        parsed = int(value)
+    except (TypeError, ValueError):
+        return default
+    return parsed if parsed >= 0 else default
+
+
+def normalize_budget_config(config: dict) -> dict:
+    '''
+    规范化配置中的`prompt_budget`段，预算为0表示不限制。
+
+    :param config: 配置快照或配置字典
+    '''
+    if isinstance(config, Config):
+        return config.memo('prompt_budget', lambda: _normalize_budget_config(config))
+    return _normalize_budget_config(config)
+
+
+def _normalize_budget_config(config: dict) -> dict:
+    budget = config.get('prompt_budget')
+    if not isinstance(budget, dict):
+        budget = {}
+    sections = budget.get('sections')
+    if not isinstance(sections, dict):
+        sections = {}
+    return {
+        'tokenizer': str(budget.get('tokenizer', DEFAULT_TOKENIZER)).strip().lower(),
+        'total_tokens': _non_negative_int(budget.get('total_tokens'), DEFAULT_TOTAL_TOKENS),
+        'sections': {
+            name: _non_negative_int(sections.get(name), default)
+            for name, default in DEFAULT_SECTION_TOKENS.items()
+        },
+    }
+
+
+class PromptBudget:
+    '''
+    按预算裁剪提示词的各个部分。
+
+    文本部分保留开头和结尾、省略中间；列表部分（上下文、长期记忆，均为从旧到新）从最旧的开始丢弃，
+    列表元素按`str()`的结果计数。
+    '''
+
+    def __init__(self, budget_config: dict):
+        self.count = get_tokenizer(budget_config['tokenizer'])
+        self.total = budget_config['total_tokens']
+        self.limits = budget_config['sections']
+
+    def measure(self, value) -> int:
+        if isinstance(value, list):
+            return sum(self.count(str(item)) for item in value)
+        return self.count(value or '')
+
+    def trim(self, value, limit: int):
+        '''把一个部分裁剪到`limit`个token以内。'''
+        if self.measure(value) <= limit:
+            return value
+        if isinstance(value, list):
+            kept = []
+            used = 0
+            for item in reversed(value):
+                used += self.count(str(item))
+                if used > limit:
+                    break
+                kept.append(item)
+            return kept[::-1]
+        return self._trim_text(value, limit)
+
+    def _trim_text(self, text: str, limit: int) -> str:
+        if limit <= self.count(TRUNCATED_MARKER):
+            return ''
+        # 二分查找能保留的最多字符数
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count(self._cut(text, middle)) <= limit:
+                low = middle
+            else:
+                high = middle - 1
+        return self._cut(text, low)
+
+    @staticmethod
+    def _cut(text: str, keep: int) -> str:
+        head = keep - keep // 2
+        tail = keep // 2
+        return text[:head] + TRUNCATED_MARKER + (text[-tail:] if tail else '')
+
+    def fit(self, sections: dict, fixed: int = 0) -> dict:
+        '''
+        先按各部分预算裁剪，总量仍超出时按`TOTAL_TRIM_ORDER`继续压缩。
+
+        :param sections: {部分名称: 文本或字符串列表}
+        :param fixed: 不可裁剪部分（system前缀等）占用的token数
+        :return: 裁剪后的各部分，结构与传入的相同
+        '''
+        result = dict(sections)
+        original = {name: self.measure(value) for name, value in sections.items()}
+        sizes = dict(original)
+        for name, value in sections.items():
+            limit = self.limits.get(name, 0)
+            if limit and sizes[name] > limit:
+                result[name] = self.trim(value, limit)
+                sizes[name] = self.measure(result[name])
+
+        if self.total:
+            for name in TOTAL_TRIM_ORDER:
+                overflow = fixed + sum(sizes.values()) - self.total
+                if overflow <= 0:
+                    break
+                if name not in result or not sizes[name]:
+                    continue
+                result[name] = self.trim(result[name], max(0, sizes[name] - overflow))
+                sizes[name] = self.measure(result[name])
+
+        for name, value in sections.items():
+            if sizes[name] != original[name]:
+                self._report(name, value, result[name], original[name], sizes[name])
+        return result
+
+    def fit_one(self, name: str, value, available: int | None = None):
+        '''
+        按部分预算裁剪单个部分（用于其余部分已经裁剪好、只有这一部分会变化的情况）。
+
+        :param name: 部分名称
+        :param value: 文本或字符串列表
+        :param available: 总预算中留给这一部分的token数，None表示不限制
+        '''
+        limit = self.limits.get(name, 0) or None
+        if available is not None:
+            available = max(0, available)
+            limit = available if limit is None else min(limit, available)
+        if limit is None:
+            return value
+        size = self.measure(value)
+        if size <= limit:
+            return value
+        result = self.trim(value, limit)
+        self._report(name, value, result, size, self.measure(result))
+        return result
+
+    @staticmethod
+    def _report(name: str, value, result, before: int, after: int):
+        detail = f'{before} → {after} tokens'
+        if isinstance(value, list):
+            detail += f'，丢弃{len(value) - len(result)}条'
+        print(f'[Prompt预算] {name} 超出预算已裁剪：{detail}')
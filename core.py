@@ -1,9 +1,21 @@
-from openai import OpenAI
+from openai import DEFAULT_CONNECTION_LIMITS, APIStatusError, AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+import asyncio
+import concurrent.futures
+import hashlib
 import requests
 import textwrap
+import budget
 import data
+import imagecache
+import metrics
+import recall
+import records
+import resilience
+import settings
+import summary
 import time
 import threading
+from collections import deque
 from agent_runtime import (
     agent_access,
     build_agent_prompt,
@@ -25,13 +37,30 @@ _agent_manager_lock = threading.Lock()
 _agent_manager = None
 _agent_manager_signature = None
 
+# OpenAI 客户端池：{(api_key, base_url): OpenAI}，复用底层 HTTP 连接池
+_client_lock = threading.Lock()
+_clients = {}
+# 异步客户端绑定创建它的事件循环：{(api_key, base_url, loop): AsyncOpenAI}
+_async_clients = {}
+_client_pool_signature = None
+DEFAULT_HTTP_POOL = {
+    'max_connections': 20,
+    'max_keepalive_connections': 10,
+    'keepalive_expiry': 30,
+}
+
 
 def get_api_status():
-    '''获取API状态'''
+    '''
+    获取API状态
+
+    `endpoints`为各聊天端点的健康状态和延迟（见`resilience.health()`）
+    '''
     with _api_status_lock:
         return {
             'chat_api': _chat_api_status,
-            'visual_api': _visual_api_status
+            'visual_api': _visual_api_status,
+            'endpoints': resilience.health()
         }
 
 
@@ -56,6 +85,132 @@ def get_agent_manager(agent_config: dict) -> LiteToolcallManager:
         return _agent_manager
 
 
+def _http_pool_config(config: dict) -> dict:
+    pool = config.get('http_pool')
+    if not isinstance(pool, dict):
+        pool = {}
+    result = {}
+    for key, default in DEFAULT_HTTP_POOL.items():
+        try:
+            value = type(default)(pool.get(key, default))
+        except (TypeError, ValueError):
+            value = default
+        result[key] = value if value > 0 else default
+    return result
+
+
+def _connection_limits(pool: dict):
+    # 使用 openai 导出的 Limits 类型，与其依赖的 httpx 版本保持一致
+    return type(DEFAULT_CONNECTION_LIMITS)(
+        max_connections           = pool['max_connections'],
+        max_keepalive_connections = pool['max_keepalive_connections'],
+        keepalive_expiry          = pool['keepalive_expiry'],
+    )
+
+
+def _check_pool_signature(config) -> dict:
+    '''连接池配置变化时关闭全部客户端（需持有`_client_lock`）'''
+    global _client_pool_signature
+    pool = config.memo('http_pool', lambda: _http_pool_config(config))
+    if _client_pool_signature != pool:
+        _close_clients()
+        _client_pool_signature = pool
+    return pool
+
+
+def get_client(api_key: str, base_url: str) -> OpenAI:
+    '''
+    获取复用的 OpenAI 客户端（按 `(api_key, base_url)` 缓存）。
+
+    同一端点的所有请求共享一个 HTTP 连接池，避免每次调用都重新进行 TCP+TLS 握手。
+    连接池大小和 keep-alive 由配置项 `http_pool` 控制，配置变化后客户端会被重建。
+
+    :param api_key: API 密钥
+    :param base_url: API 地址
+    '''
+    config = settings.get_config()
+    key = (api_key, base_url)
+    with _client_lock:
+        pool = _check_pool_signature(config)
+        client = _clients.get(key)
+        if client is None:
+            client = OpenAI(
+                api_key     = api_key,
+                base_url    = base_url,
+                http_client = DefaultHttpxClient(limits=_connection_limits(pool))
+            )
+            _clients[key] = client
+        return client
+
+
+def get_async_client(api_key: str, base_url: str) -> AsyncOpenAI:
+    '''
+    获取复用的 AsyncOpenAI 客户端（按 `(api_key, base_url, 当前事件循环)` 缓存）。
+
+    必须在事件循环中调用；连接池配置与 `get_client()` 相同。
+
+    :param api_key: API 密钥
+    :param base_url: API 地址
+    '''
+    config = settings.get_config()
+    key = (api_key, base_url, asyncio.get_running_loop())
+    with _client_lock:
+        pool = _check_pool_signature(config)
+        client = _async_clients.get(key)
+        if client is None:
+            client = AsyncOpenAI(
+                api_key     = api_key,
+                base_url    = base_url,
+                http_client = DefaultAsyncHttpxClient(limits=_connection_limits(pool))
+            )
+            _async_clients[key] = client
+        return client
+
+
+def _close_async_client(loop, client):
+    # 异步客户端只能在自己的事件循环里关闭
+    if loop.is_closed():
+        return
+    try:
+        loop.call_soon_threadsafe(lambda: loop.create_task(client.close()))
+    except RuntimeError:
+        pass
+
+
+def _close_clients():
+    for client in _clients.values():
+        try:
+            client.close()
+        except Exception:
+            pass
+    _clients.clear()
+    for (_, _, loop), client in _async_clients.items():
+        _close_async_client(loop, client)
+    _async_clients.clear()
+
+
+def _on_config_reload(old_config, new_config):
+    '''配置热重载时释放不再使用的客户端'''
+    endpoints = {
+        (new_config.get('ai_api_key'), new_config.get('model_base_url')),
+        (new_config.get('visual_api_key'), new_config.get('visual_base_url')),
+    }
+    # 备用端点的客户端同样保留
+    for fallback in resilience.normalize_resilience_config(new_config)['fallbacks']:
+        endpoints.add((fallback['api_key'], fallback['base_url']))
+    with _client_lock:
+        for key in [key for key in _clients if key not in endpoints]:
+            try:
+                _clients.pop(key).close()
+            except Exception:
+                pass
+        for key in [key for key in _async_clients if key[:2] not in endpoints]:
+            _close_async_client(key[2], _async_clients.pop(key))
+
+
+settings.add_listener(_on_config_reload)
+
+
 def initialize_agent_manager(config: dict):
     agent_config = normalize_agent_config(config)
     if not agent_config["enabled"]:
@@ -65,101 +220,525 @@ def initialize_agent_manager(config: dict):
     return manager
 
 
-def get_ai(prompt: str, model: str, user_id: str | None = None, images: list[dict] | None = None) -> str:
+def _chat_config():
+    '''读取并检查聊天模型的配置，缺少必需项时抛出ValueError'''
+    config = settings.get_config()
+
+    # 检查必需的配置项
+    if not config.get('ai_api_key') or config['ai_api_key'] == '':
+        print('错误: ai_api_key 未设置，AI 功能无法使用')
+        raise ValueError('ai_api_key 未设置')
+
+    if not config.get('model_base_url') or config['model_base_url'] == '':
+        print('错误: model_base_url 未设置，AI 功能无法使用')
+        raise ValueError('model_base_url 未设置')
+
+    return config
+
+
+def _chat_messages(prompt: str | list[dict], images: list[dict] | None = None) -> list[dict]:
+    if isinstance(prompt, str):
+        messages = [{"role": "user", "content": prompt}]
+    else:
+        messages = list(prompt)
+    if images:
+        # 图片附在最后一条消息上
+        message_content = [{"type": "text", "text": messages[-1]["content"]}]
+        for image in images:
+            mime = image.get("mime", "image/png")
+            payload = image.get("base64", "")
+            if payload:
+                message_content.append({
+                    "type": "image_url",
+                    "image_url": {"url": f"data:{mime};base64,{payload}"},
+                })
+        messages[-1] = {**messages[-1], "content": message_content}
+    return messages
+
+
+def _set_chat_api_status(ok: bool):
+    global _chat_api_status
+    with _api_status_lock:
+        _chat_api_status = "正常" if ok else "异常"
+
+
+def _set_visual_api_status(ok: bool):
+    global _visual_api_status
+    with _api_status_lock:
+        _visual_api_status = "正常" if ok else "异常"
+
+
+def _chat_endpoints(config, model: str, policy: dict) -> list[dict]:
+    '''按顺序排列的聊天端点：主端点（`model_base_url` + 调用方指定的模型），然后是`llm_resilience.fallbacks`'''
+    endpoints = [{'base_url': config['model_base_url'], 'model': model, 'api_key': config['ai_api_key']}]
+    seen = {(config['model_base_url'], model)}
+    for fallback in policy['fallbacks']:
+        if (fallback['base_url'], fallback['model']) not in seen:
+            seen.add((fallback['base_url'], fallback['model']))
+            endpoints.append(fallback)
+    return endpoints
+
+
+def _retryable(error: Exception) -> bool:
+    '''请求本身有问题（4xx，限流和超时除外）时重试没有意义'''
+    if isinstance(error, APIStatusError):
+        return error.status_code >= 500 or error.status_code in {408, 409, 429}
+    return True
+
+
+def _record_failure(breaker, error: Exception, policy: dict) -> None:
+    '''只有端点本身的故障（超时、5xx、限流等）计入熔断，请求本身的错误不会让端点熔断'''
+    if _retryable(error):
+        breaker.record_failure(error, policy['failure_threshold'])
+    else:
+        breaker.record_rejected(error)
+
+
+def _completion_request(endpoint: dict, messages: list[dict], stream: bool) -> dict:
+    return {'model': endpoint['model'], 'stream': stream, 'messages': messages}
+
+
+def _collect_delta(chunk, pieces: list, stream_state: dict, on_delta) -> None:
+    '''处理流式响应中的一个片段'''
+    if not chunk.choices:
+        return
+    delta = chunk.choices[0].delta.content
+    if delta:
+        pieces.append(delta)
+        stream_state['emitted'] = True
+        on_delta(delta)
+
+
+def _complete(endpoint: dict, messages: list[dict], timeout: float, on_delta, stream_state: dict) -> str:
+    # 重试由调用方控制，关闭 SDK 自带的重试
+    client = get_client(endpoint['api_key'], endpoint['base_url']).with_options(max_retries=0, timeout=timeout)
+    if on_delta is None:
+        response = client.chat.completions.create(**_completion_request(endpoint, messages, False))
+        return response.choices[0].message.content
+    pieces = []
+    for chunk in client.chat.completions.create(**_completion_request(endpoint, messages, True)):
+        _collect_delta(chunk, pieces, stream_state, on_delta)
+    return ''.join(pieces)
+
+
+async def _complete_async(endpoint: dict, messages: list[dict], timeout: float, on_delta, stream_state: dict) -> str:
+    client = get_async_client(endpoint['api_key'], endpoint['base_url']).with_options(max_retries=0, timeout=timeout)
+    if on_delta is None:
+        response = await client.chat.completions.create(**_completion_request(endpoint, messages, False))
+        return response.choices[0].message.content
+    pieces = []
+    async for chunk in await client.chat.completions.create(**_completion_request(endpoint, messages, True)):
+        _collect_delta(chunk, pieces, stream_state, on_delta)
+    return ''.join(pieces)
+
+
+HEDGE_WORKERS = 32
+
+# 同步版本的对冲请求在线程池中执行
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+
+
+def _hedge_target(endpoints: list[dict], policy: dict, on_delta):
+    '''
+    决定本次请求是否对冲。
+
+    :return: (备用端点, 对冲等待秒数)，不满足条件（未启用、流式输出、没有可用备用端点、主端点延迟历史不足）时返回None
+    '''
+    hedge = policy['hedge']
+    if not hedge['enabled'] or on_delta is not None or len(endpoints) < 2:
+        return None
+    resilience.hedge_budget.add_request(hedge['max_extra_load'])
+    primary = resilience.get_breaker(endpoints[0]['base_url'], endpoints[0]['model'])
+    if primary.state != resilience.CLOSED:
+        return None
+    delay = resilience.hedge_delay(primary, hedge, policy['timeout_seconds'])
+    if delay is None:
+        return None
+    for endpoint in endpoints[1:]:
+        if resilience.get_breaker(endpoint['base_url'], endpoint['model']).state == resilience.CLOSED:
+            return endpoint, delay
+    return None
+
+
+def _get_hedge_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _hedge_executor
+    with _hedge_executor_lock:
+        if _hedge_executor is None:
+            _hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix='hedge')
+        return _hedge_executor
+
+
+class _HedgeRace:
+    '''
+    一次对冲请求中两个请求的状态（`_complete_hedged()`和`_complete_hedged_async()`共用）。
+
+    线程池的Future和asyncio的Task都提供`result()`/`exception()`，判定胜负的逻辑相同。
+    '''
+
+    def __init__(self, primary: dict, secondary: dict, delay: float, policy: dict, started: float):
+        self.policy = policy
+        self.started = started
+        self.primary_breaker = resilience.get_breaker(primary['base_url'], primary['model'])
+        self.secondary_breaker = resilience.get_breaker(secondary['base_url'], secondary['model'])
+        self.primary_error = None
+        print(f'[对冲请求] {self.primary_breaker.name} {delay:.1f}秒内未响应，同时请求 {self.secondary_breaker.name}')
+        self.hedge_started = time.monotonic()
+
+    def settle(self, done, primary, hedge) -> tuple[str, float | None] | None:
+        '''
+        检查已完成的请求。
+
+        :return: (内容, 主端点延迟)，备用端点胜出时主端点延迟为None；尚未决出时返回None
+        '''
+        if primary in done:
+            if primary.exception() is None:
+                return primary.result(), time.monotonic() - self.started
+            self.primary_error = primary.exception()
+        if hedge in done:
+            if hedge.exception() is None:
+                self.secondary_breaker.record_success(time.monotonic() - self.hedge_started)
+                if self.primary_error is not None:
+                    _record_failure(self.primary_breaker, self.primary_error, self.policy)
+                return hedge.result(), None
+            _record_failure(self.secondary_breaker, hedge.exception(), self.policy)
+        return None
+
+
+def _complete_hedged(primary: dict, secondary: dict, delay: float, messages: list[dict], policy: dict) -> tuple[str, float | None]:
+    '''
+    对冲请求：主端点`delay`秒内没有响应时，同时向备用端点发送相同请求，先完成的结果胜出。
+
+    同步版本无法中断进行中的HTTP请求，落败请求的结果会被直接丢弃。
+
+    :return: (内容, 主端点延迟)，备用端点胜出时主端点延迟为None；两边都失败时抛出主端点的异常
+    '''
+    executor = _get_hedge_executor()
+    timeout = policy['timeout_seconds']
+    started = time.monotonic()
+    primary_future = executor.submit(_complete, primary, messages, timeout, None, {'emitted': False})
+    done, _ = concurrent.futures.wait([primary_future], timeout=delay)
+    if done or not resilience.hedge_budget.try_acquire():
+        return primary_future.result(), time.monotonic() - started
+
+    race = _HedgeRace(primary, secondary, delay, policy, started)
+    hedge_future = executor.submit(_complete, secondary, messages, timeout, None, {'emitted': False})
+    pending = {primary_future, hedge_future}
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        result = race.settle(done, primary_future, hedge_future)
+        if result is not None:
+            return result
+    raise race.primary_error
+
+
+async def _complete_hedged_async(primary: dict, secondary: dict, delay: float, messages: list[dict], policy: dict) -> tuple[str, float | None]:
+    '''`_complete_hedged()`的异步版本，落败的请求会被取消。'''
+    timeout = policy['timeout_seconds']
+    started = time.monotonic()
+    primary_task = asyncio.create_task(_complete_async(primary, messages, timeout, None, {'emitted': False}))
+    done, _ = await asyncio.wait({primary_task}, timeout=delay)
+    if done or not resilience.hedge_budget.try_acquire():
+        return await primary_task, time.monotonic() - started
+
+    race = _HedgeRace(primary, secondary, delay, policy, started)
+    hedge_task = asyncio.create_task(_complete_async(secondary, messages, timeout, None, {'emitted': False}))
+    pending = {primary_task, hedge_task}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            result = race.settle(done, primary_task, hedge_task)
+            if result is not None:
+                return result
+        raise race.primary_error
+    finally:
+        # 取消落败的请求
+        for task in pending:
+            task.cancel()
+
+
+def _after_failure(breaker, attempt: int, error: Exception, policy: dict, stream_state: dict) -> float | None:
+    '''
+    记录一次失败，返回重试前需要等待的秒数；返回None表示不再重试当前端点。
+
+    已经流式输出过部分内容时直接抛出异常，避免重复发送。
+    '''
+    _record_failure(breaker, error, policy)
+    print(f'AI 调用失败（{breaker.name}，第{attempt + 1}次）: {error}')
+    if stream_state['emitted']:
+        raise error
+    if attempt >= policy['retries'] or not _retryable(error) or breaker.state == resilience.OPEN:
+        return None
+    return resilience.backoff_delay(attempt, policy)
+
+
+class _CompletionPlan:
+    '''
+    一次聊天模型调用的端点顺序、重试和熔断状态（`chat_completion()`和`chat_completion_async()`共用，
+    两者只在等待方式上不同）。
+    '''
+
+    def __init__(self, prompt: str | list[dict], model: str, images: list[dict] | None, on_delta):
+        config = _chat_config()
+        self.policy = resilience.normalize_resilience_config(config)
+        self.messages = _chat_messages(prompt, images)
+        self.stream_state = {'emitted': False}
+        self.last_error = None
+        self.attempt = 0
+        self.delay = None
+        self.endpoints = _chat_endpoints(config, model, self.policy)
+        self.hedge = _hedge_target(self.endpoints, self.policy, on_delta)
+
+    def attempts(self):
+        '''
+        依次产生每次尝试的`(端点, 熔断器, 是否对冲)`。
+
+        熔断器打开的端点直接跳过；`failed()`决定不再重试时换下一个端点。
+        '''
+        for index, endpoint in enumerate(self.endpoints):
+            breaker = resilience.get_breaker(endpoint['base_url'], endpoint['model'])
+            for attempt in range(self.policy['retries'] + 1):
+                if not breaker.allow(self.policy['reset_seconds']):
+                    break
+                self.attempt = attempt
+                self.delay = None
+                yield endpoint, breaker, index == 0 and attempt == 0 and self.hedge is not None
+                if self.delay is None:
+                    break
+
+    def failed(self, breaker, error: Exception) -> float | None:
+        '''记录一次失败，返回重试前需要等待的秒数（见`_after_failure()`）'''
+        self.last_error = error
+        self.delay = _after_failure(breaker, self.attempt, error, self.policy, self.stream_state)
+        return self.delay
+
+    @staticmethod
+    def succeeded(breaker, latency: float | None) -> None:
+        # 对冲请求由备用端点胜出时，主端点的延迟未知，不计入历史
+        if latency is not None:
+            breaker.record_success(latency)
+
+    def error(self) -> Exception:
+        return self.last_error or resilience.CircuitOpenError('所有模型端点均已熔断')
+
+
+def chat_completion(prompt: str | list[dict], model: str, images: list[dict] | None = None, on_delta=None) -> str:
+    '''
+    调用聊天模型，失败时抛出异常（`get_ai()`会把异常转换为自动回复）。
+
+    失败时按配置`llm_resilience`带抖动重试，并依次尝试备用端点；连续失败的端点会被熔断，熔断期间直接跳过。
+    启用`llm_resilience.hedge`后，非流式请求在主端点响应过慢时会同时发给备用端点（见`_complete_hedged()`）。
+
+    参数与`get_ai()`相同（不需要`user_id`）。
+    '''
+    plan = _CompletionPlan(prompt, model, images, on_delta)
+    for endpoint, breaker, hedged in plan.attempts():
+        started = time.monotonic()
+        try:
+            if hedged:
+                content, latency = _complete_hedged(endpoint, plan.hedge[0], plan.hedge[1], plan.messages, plan.policy)
+            else:
+                content = _complete(endpoint, plan.messages, plan.policy['timeout_seconds'], on_delta, plan.stream_state)
+                latency = time.monotonic() - started
+        except Exception as e:
+            delay = plan.failed(breaker, e)
+            if delay is not None:
+                time.sleep(delay)
+            continue
+        except BaseException:
+            # 被取消（对冲落败、任务取消等）时释放探测名额，否则半开的端点会一直被拒绝
+            breaker.release_probe()
+            raise
+        plan.succeeded(breaker, latency)
+        return content
+    raise plan.error()
+
+
+async def chat_completion_async(prompt: str | list[dict], model: str, images: list[dict] | None = None, on_delta=None) -> str:
+    '''`chat_completion()`的异步版本。'''
+    plan = _CompletionPlan(prompt, model, images, on_delta)
+    for endpoint, breaker, hedged in plan.attempts():
+        started = time.monotonic()
+        try:
+            if hedged:
+                content, latency = await _complete_hedged_async(endpoint, plan.hedge[0], plan.hedge[1], plan.messages, plan.policy)
+            else:
+                content = await _complete_async(endpoint, plan.messages, plan.policy['timeout_seconds'], on_delta, plan.stream_state)
+                latency = time.monotonic() - started
+        except Exception as e:
+            delay = plan.failed(breaker, e)
+            if delay is not None:
+                await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            # 被取消（对冲落败、任务取消等）时释放探测名额，否则半开的端点会一直被拒绝
+            breaker.release_probe()
+            raise
+        plan.succeeded(breaker, latency)
+        return content
+    raise plan.error()
+
+
+AUTO_REPLY = '[自动回复] 当前我不在哦qwq...有事请留言'
+
+
+def _record_completion(started: float, error: Exception | None = None) -> None:
+    '''记录一次`get_ai()`调用的结果，并更新聊天接口状态'''
+    metrics.STAGE_SECONDS.observe(time.monotonic() - started, stage='completion')
+    metrics.COMPLETIONS.inc(result='ok' if error is None else 'error')
+    _set_chat_api_status(error is None)
+    if error is not None:
+        print(f'AI 调用错误: {error}')
+
+
+def get_ai(prompt: str | list[dict], model: str, user_id: str | None = None, images: list[dict] | None = None, on_delta=None) -> str:
     '''
     直接将**原始**的提示词发送给AI，是与AI交互的直接接口。
 
-    :param prompt: 给AI的**原始**提示词。
+    重试、备用端点和熔断见`chat_completion()`，全部失败时返回自动回复。
+
+    :param prompt: 给AI的**原始**提示词，或者`create_prompt()`生成的消息列表。
     :param model: 使用的模型名称。
     :param user_id: 用户ID
+    :param images: 附带的图片（base64）
+    :param on_delta: 流式回调，传入时使用流式接口，每收到一段文本就调用一次`on_delta(文本片段)`
     '''
-    global _chat_api_status
+    started = time.monotonic()
     try:
-        config = data.load_data(user_id)['config']
+        content = chat_completion(prompt, model, images, on_delta)
+    except Exception as e:
+        _record_completion(started, e)
+        return AUTO_REPLY
+    _record_completion(started)
+    return content
 
-        # 检查必需的配置项
-        if not config.get('ai_api_key') or config['ai_api_key'] == '':
-            print('错误: ai_api_key 未设置，AI 功能无法使用')
-            raise ValueError('ai_api_key 未设置')
 
-        if not config.get('model_base_url') or config['model_base_url'] == '':
-            print('错误: model_base_url 未设置，AI 功能无法使用')
-            raise ValueError('model_base_url 未设置')
+async def get_ai_async(prompt: str | list[dict], model: str, user_id: str | None = None, images: list[dict] | None = None, on_delta=None) -> str:
+    '''
+    `get_ai()`的异步版本，使用AsyncOpenAI，等待响应时不占用线程。
 
-        client = OpenAI(
-            api_key  = config['ai_api_key'],
-            base_url = config['model_base_url']
-        )
-        message_content = prompt
-        if images:
-            message_content = [{"type": "text", "text": prompt}]
-            for image in images:
-                mime = image.get("mime", "image/png")
-                payload = image.get("base64", "")
-                if payload:
-                    message_content.append({
-                        "type": "image_url",
-                        "image_url": {"url": f"data:{mime};base64,{payload}"},
-                    })
-
-        response = client.chat.completions.create(
-            model    = model,
-            stream   = False,
-            messages = [{
-                "role":    "user",
-                "content": message_content
-            }]
-        )
+    参数与`get_ai()`相同。
+    '''
+    started = time.monotonic()
+    try:
+        content = await chat_completion_async(prompt, model, images, on_delta)
+    except Exception as e:
+        _record_completion(started, e)
+        return AUTO_REPLY
+    _record_completion(started)
+    return content
 
-        # 调用成功，标记为正常
-        with _api_status_lock:
-            _chat_api_status = "正常"
 
-        return response.choices[0].message.content
-    except Exception as e:
-        # 调用失败，标记为异常
-        with _api_status_lock:
-            _chat_api_status = "异常"
+DEFAULT_PIC_REQUIREMENT = "请详细描述这张图片的内容。"
+DEFAULT_VISUAL_PROMPT = "请详细描述这张图片的内容，包括主要元素、场景、文字信息等。"
+
 
-        print(f'AI 调用错误: {e}')
-        return '[自动回复] 当前我不在哦qwq...有事请留言'
+# 视觉模式：
+# - two_step：先让聊天模型根据上下文写视觉prompt，再调用视觉模型（两次调用）
+# - single：把最近的上下文和用户消息直接交给视觉模型（一次调用）
+# - template：用本地模板生成视觉prompt，不额外调用聊天模型（一次调用）
+VISION_MODES = ('two_step', 'single', 'template')
+DEFAULT_VISION_MODE = 'two_step'
+VISION_LATENCY_SAMPLES = 200
 
+# 各视觉模式的耗时记录：{模式: {'count': 总次数, 'samples': deque(最近的耗时秒数)}}
+_vision_latency_lock = threading.Lock()
+_vision_latency = {}
 
-def get_pic_disc_requirement(user_input: str, context_list: list[str], user_id: str | None = None) -> str:
+
+def get_vision_mode(config: dict) -> str:
+    '''获取配置的视觉模式（配置项`vision_mode`，默认`two_step`）。'''
+    mode = str(config.get('vision_mode', DEFAULT_VISION_MODE)).strip().lower()
+    return mode if mode in VISION_MODES else DEFAULT_VISION_MODE
+
+
+def _record_vision_latency(mode: str, seconds: float, result: str = 'ok'):
+    '''记录一次视觉调用的耗时，失败的调用只计入指标，不计入各模式的耗时统计'''
+    metrics.STAGE_SECONDS.observe(seconds, stage='vision')
+    metrics.VISION_CALLS.inc(mode=mode, result=result)
+    if result != 'ok':
+        return
+    with _vision_latency_lock:
+        stats = _vision_latency.setdefault(mode, {'count': 0, 'samples': deque(maxlen=VISION_LATENCY_SAMPLES)})
+        stats['count'] += 1
+        stats['samples'].append(seconds)
+
+
+def get_vision_latency() -> dict:
     '''
-    根据用户上下文和当前消息，生成适用于视觉理解模型的prompt。
+    获取各视觉模式的耗时统计（不含缓存命中），用于比较不同模式。
 
-    :param user_input: 用户当前输入的消息内容
-    :param context_list: 上下文列表
-    :param user_id: 用户ID
-    :return: 视觉模型的prompt
+    :return: {模式: {'count': 次数, 'avg': 平均秒数, 'p50': 中位数, 'p95': 95分位}}，统计基于最近的样本
     '''
-    try:
-        config = data.load_data(user_id)['config']
+    with _vision_latency_lock:
+        snapshot = {mode: (stats['count'], sorted(stats['samples'])) for mode, stats in _vision_latency.items()}
+    result = {}
+    for mode, (count, samples) in snapshot.items():
+        if not samples:
+            continue
+        result[mode] = {
+            'count': count,
+            'avg': sum(samples) / len(samples),
+            'p50': samples[len(samples) // 2],
+            'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        }
+    return result
+
+
+def _format_recent_context(context_list: list[records.ContextRecord]) -> str:
+    # 获取最近5条上下文并格式化
+    formatted_context = [f"{record.speaker}: {record.text}" for record in context_list[-5:]]
+    return '\n'.join(formatted_context) if formatted_context else '没有上下文'
+
+
+def _vision_prompt(config: dict, user_input: str, context_list: list[records.ContextRecord] | None) -> tuple[str, str | None]:
+    '''
+    根据视觉模式决定视觉模型的prompt。
+
+    :return: (模式, prompt)，two_step模式的prompt需要另外调用聊天模型生成，此时为None
+    '''
+    if not user_input or context_list is None:
+        return 'default', DEFAULT_VISUAL_PROMPT
+    mode = get_vision_mode(config)
+    if mode == 'template':
+        return mode, f'''用户发送这张图片时说：{user_input}
 
-        # 检查必需的配置项
-        if not config.get('ai_api_key') or config['ai_api_key'] == '':
-            return "请详细描述这张图片的内容。"
+{DEFAULT_VISUAL_PROMPT}请特别留意与用户这句话相关的内容。'''
+    if mode == 'single':
+        return mode, f'''以下是一段对话的最近内容和用户当前消息，用户随消息发送了这张图片。
 
-        if not config.get('model_base_url') or config['model_base_url'] == '':
-            return "请详细描述这张图片的内容。"
+对话上下文：
+{_format_recent_context(context_list)}
+
+用户当前消息：
+{user_input}
+
+请先理解用户想从图片中获取什么信息，再描述图片：重点回答用户关心的内容，同时简要说明主要元素、场景和文字信息。直接输出描述，不要有任何其他说明或前缀。'''
+    return mode, None
 
-        # 获取最近5条上下文
-        recent_context = context_list[-5:] if len(context_list) > 5 else context_list
 
-        # 格式化上下文
-        formatted_context = []
-        for ctx in recent_context:
-            parts = ctx.split('//')
-            if len(parts) >= 4:
-                role = parts[2]  # 用户/你
-                message = parts[3]  # 消息内容
-                formatted_context.append(f"{role}: {message}")
+def _vision_cache_key(cache_key: str | None, mode: str, prompt: str | None) -> str | None:
+    '''
+    图片描述的缓存键，返回None表示不缓存。
+
+    默认prompt生成的描述与对话无关，所有用户共用；template模式的prompt只包含用户这句话，缓存键带上prompt的哈希；
+    single和two_step模式的prompt来自某个用户的上下文，描述可能引用其中的内容，不缓存，避免泄露给其他用户。
+    '''
+    if not cache_key:
+        return None
+    # 键里带上模式：旧版本不区分模式写入的条目不会再被命中
+    if mode == 'default':
+        return f'{cache_key}|{mode}'
+    if mode == 'template' and prompt is not None:
+        return f"{cache_key}|{mode}|{hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]}"
+    return None
+
 
-        context_text = '\n'.join(formatted_context) if formatted_context else '没有上下文'
+def _pic_disc_messages(user_input: str, context_list: list[records.ContextRecord]) -> list[dict]:
+    context_text = _format_recent_context(context_list)
 
-        # 构建prompt
-        prompt = f'''根据以下对话上下文和用户当前消息，理解用户需要从图片中获取什么信息。
+    # 构建prompt
+    prompt = f'''根据以下对话上下文和用户当前消息，理解用户需要从图片中获取什么信息。
 
 对话上下文：
 {context_text}
@@ -170,123 +749,188 @@ def get_pic_disc_requirement(user_input: str, context_list: list[str], user_id:
 请根据用户的上下文和当前消息，理解用户所需要的图片内容，写一个适用于视觉理解模型的prompt，要求逻辑清晰，信息齐全，不超过100字。
 
 直接输出prompt内容，不要有任何其他说明或前缀。'''
+    return [{
+        "role":    "user",
+        "content": prompt
+    }]
 
-        client = OpenAI(
-            api_key  = config['ai_api_key'],
-            base_url = config['model_base_url']
-        )
 
-        response = client.chat.completions.create(
-            model    = config.get('model', 'deepseek-chat'),
-            stream   = False,
-            messages = [{
-                "role":    "user",
-                "content": prompt
-            }]
-        )
+def _pic_disc_request(user_input: str, context_list: list[records.ContextRecord]):
+    '''
+    生成视觉prompt的请求。
 
-        result = response.choices[0].message.content.strip()
-        return result if result else "请详细描述这张图片的内容。"
+    :return: (配置快照, 请求参数)，聊天模型未配置时返回None
+    '''
+    config = settings.get_config()
+    if not config.get('ai_api_key') or not config.get('model_base_url'):
+        return None
+    return config, {
+        'model': config.get('model', 'deepseek-chat'),
+        'stream': False,
+        'messages': _pic_disc_messages(user_input, context_list),
+    }
 
-    except Exception as e:
-        print(f'生成图片描述需求失败: {e}')
-        return "请详细描述这张图片的内容。"
+
+def _pic_disc_result(response) -> str:
+    result = response.choices[0].message.content.strip()
+    return result if result else DEFAULT_PIC_REQUIREMENT
 
 
-def process_image(image_url: str, user_id: str | None = None, user_input: str = "", context_list: list[str] = None) -> str:
+def get_pic_disc_requirement(user_input: str, context_list: list[records.ContextRecord], user_id: str | None = None) -> str:
     '''
-    处理图片/表情包，返回描述文本。
+    根据用户上下文和当前消息，生成适用于视觉理解模型的prompt。
 
-    :param image_url: 图片URL
+    :param user_input: 用户当前输入的消息内容
+    :param context_list: 上下文列表
     :param user_id: 用户ID
-    :param user_input: 用户当前输入（用于生成动态prompt）
-    :param context_list: 上下文列表（用于生成动态prompt）
+    :return: 视觉模型的prompt
     '''
-    global _visual_api_status
     try:
-        config = data.load_data(user_id)['config']
+        request = _pic_disc_request(user_input, context_list)
+        if request is None:
+            return DEFAULT_PIC_REQUIREMENT
+        config, kwargs = request
+        client = get_client(config['ai_api_key'], config['model_base_url'])
+        return _pic_disc_result(client.chat.completions.create(**kwargs))
+    except Exception as e:
+        print(f'生成图片描述需求失败: {e}')
+        return DEFAULT_PIC_REQUIREMENT
 
-        # 检查visual_api_key是否配置
-        if not config.get('visual_api_key') or config['visual_api_key'] == '':
-            return ""
 
-        # 检查visual_base_url是否配置
-        if not config.get('visual_base_url') or config['visual_base_url'] == '':
-            print('错误: visual_base_url 未设置，图片处理功能无法使用')
-            return ""
+async def get_pic_disc_requirement_async(user_input: str, context_list: list[records.ContextRecord], user_id: str | None = None) -> str:
+    '''`get_pic_disc_requirement()`的异步版本。'''
+    try:
+        request = _pic_disc_request(user_input, context_list)
+        if request is None:
+            return DEFAULT_PIC_REQUIREMENT
+        config, kwargs = request
+        client = get_async_client(config['ai_api_key'], config['model_base_url'])
+        return _pic_disc_result(await client.chat.completions.create(**kwargs))
+    except Exception as e:
+        print(f'生成图片描述需求失败: {e}')
+        return DEFAULT_PIC_REQUIREMENT
 
-        client = OpenAI(
-            api_key  = config['visual_api_key'],
-            base_url = config['visual_base_url']
-        )
 
-        # 如果提供了用户输入和上下文，使用AI生成动态prompt
-        if user_input and context_list is not None:
-            prompt = get_pic_disc_requirement(user_input, context_list, user_id)
-        else:
-            # 使用默认prompt
-            prompt = "请详细描述这张图片的内容，包括主要元素、场景、文字信息等。"
-
-        response = client.chat.completions.create(
-            model    = config.get('visual_model', 'gpt-4o'),
-            messages = [{
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": image_url}}
-                ]
-            }]
-        )
+def _visual_config():
+    '''读取视觉模型配置，未配置时返回None'''
+    config = settings.get_config()
 
-        # 调用成功，标记为正常
-        with _api_status_lock:
-            _visual_api_status = "正常"
+    # 检查visual_api_key是否配置
+    if not config.get('visual_api_key') or config['visual_api_key'] == '':
+        return None
 
+    # 检查visual_base_url是否配置
+    if not config.get('visual_base_url') or config['visual_base_url'] == '':
+        print('错误: visual_base_url 未设置，图片处理功能无法使用')
+        return None
+
+    return config
+
+
+def _visual_messages(prompt: str, image_url: str) -> list[dict]:
+    return [{
+        "role": "user",
+        "content": [
+            {"type": "text", "text": prompt},
+            {"type": "image_url", "image_url": {"url": image_url}}
+        ]
+    }]
+
+
+class _VisionCall:
+    '''
+    一次图片描述调用（`process_image()`和`process_image_async()`共用，两者只在等待方式上不同）。
+
+    视觉模型未配置时`config`为None。
+    '''
+
+    def __init__(self, user_input: str, context_list: list[records.ContextRecord] | None, cache_key: str | None):
+        self.config = _visual_config()
+        self.started = None
+        self.mode = None
+        self.prompt = None
+        self.cache_key = None
+        if self.config is not None:
+            # 如果提供了用户输入和上下文，按视觉模式生成动态prompt，否则使用默认prompt
+            self.mode, self.prompt = _vision_prompt(self.config, user_input, context_list)
+            self.cache_key = _vision_cache_key(cache_key, self.mode, self.prompt)
+
+    def request(self, image_url: str) -> dict:
+        return {
+            'model': self.config.get('visual_model', 'gpt-4o'),
+            'messages': _visual_messages(self.prompt, image_url),
+        }
+
+    def succeeded(self, response) -> str:
+        # 调用成功，标记为正常
+        _set_visual_api_status(True)
+        _record_vision_latency(self.mode, time.monotonic() - self.started)
         return response.choices[0].message.content
-    except Exception as e:
-        # 调用失败，标记为异常
-        with _api_status_lock:
-            _visual_api_status = "异常"
 
-        print(f'Error processing image: {e}')
+    def failed(self, error: Exception) -> str:
+        # 调用失败，标记为异常
+        _set_visual_api_status(False)
+        if self.started is not None:
+            _record_vision_latency(self.mode, time.monotonic() - self.started, 'error')
+        print(f'Error processing image: {error}')
         return ""
 
 
-def create_prompt(
-    user_input: str,
-    context_list: list[str],
-    memory_list: list[str],
-    image_desc: str = "",
-    agent_prompt: str = "",
-    agent_tool_context: str = "",
-) -> str:
+def process_image(image_url: str, user_id: str | None = None, user_input: str = "", context_list: list[records.ContextRecord] = None, cache_key: str | None = None) -> str:
     '''
-    根据各种数据，整合和创建给AI的原始提示词。
+    处理图片/表情包，返回描述文本。
 
-    :param user_input: 用户输入的消息内容。
-    :param context_list: 上下文列表。
-    :param memory_list: 长期记忆列表。
-    :param image_desc: 图片描述
+    :param image_url: 图片URL
+    :param user_id: 用户ID
+    :param user_input: 用户当前输入（用于生成动态prompt）
+    :param context_list: 上下文列表（用于生成动态prompt）
+    :param cache_key: 图片内容标识，传入时优先使用缓存的描述（见`imagecache`），不再调用模型；
+                      single和two_step模式的描述与用户的上下文有关，不使用缓存
     '''
-    tmp_context_list = []
-    tmp_memory_list = []
-    if context_list == []:
-        tmp_context_list = '没有上下文，这意味之前没有聊过天（或被手动清除）'
-    else:
-        for index in context_list:
-            tmp_context_list.append(escape_user_tool_tags(index) + '\n')
-    if memory_list == []:
-        tmp_memory_list = '长期记忆库为空（或被手动清除）'
-    else:
-        for index in memory_list:
-            tmp_memory_list.append(index + '\n')
-    agent_section = ""
-    if agent_prompt:
-        agent_section += f"\n\nAgent能力说明：\n{agent_prompt}"
-    if agent_tool_context:
-        agent_section += f"\n\nAgent工具调用结果上下文：\n{agent_tool_context}"
-
-    prompt = textwrap.dedent(f'''
+    call = _VisionCall(user_input, context_list, cache_key)
+    if call.config is None:
+        return ""
+    try:
+        cached = imagecache.lookup(call.config, call.cache_key)
+        if cached is not None:
+            return cached
+
+        client = get_client(call.config['visual_api_key'], call.config['visual_base_url'])
+        call.started = time.monotonic()
+        if call.prompt is None:
+            call.prompt = get_pic_disc_requirement(user_input, context_list, user_id)
+        desc = call.succeeded(client.chat.completions.create(**call.request(image_url)))
+        imagecache.store(call.config, call.cache_key, desc)
+        return desc
+    except Exception as e:
+        return call.failed(e)
+
+
+async def process_image_async(image_url: str, user_id: str | None = None, user_input: str = "", context_list: list[records.ContextRecord] = None, cache_key: str | None = None) -> str:
+    '''`process_image()`的异步版本，参数相同。'''
+    call = _VisionCall(user_input, context_list, cache_key)
+    if call.config is None:
+        return ""
+    try:
+        cached = await asyncio.to_thread(imagecache.lookup, call.config, call.cache_key)
+        if cached is not None:
+            return cached
+
+        client = get_async_client(call.config['visual_api_key'], call.config['visual_base_url'])
+        call.started = time.monotonic()
+        if call.prompt is None:
+            call.prompt = await get_pic_disc_requirement_async(user_input, context_list, user_id)
+        desc = call.succeeded(await client.chat.completions.create(**call.request(image_url)))
+        await asyncio.to_thread(imagecache.store, call.config, call.cache_key, desc)
+        return desc
+    except Exception as e:
+        return call.failed(e)
+
+
+# 固定的人设与规则部分，作为system消息放在最前面。
+# 内容在导入时生成一次且逐字节不变，支持前缀缓存的服务商可以命中缓存；
+# 时间、记忆、上下文等变化的内容都放在后面的消息里。
+SYSTEM_PROMPT = textwrap.dedent('''
         接下来，请使用以下方针与用户（提问者，也就是我）对话，这些方针作用于所有对话：
 
         [身份设定与核心原则]
@@ -329,7 +973,7 @@ def create_prompt(
             （特别注意：合并转发中可能包含多条消息，每条消息都会标注发送者和是否为当前对话用户）
         - 如果遇到需要长期记忆的情况（包括但不限于：用户透露出来的所有个人信息、用户赐予你的身份、双方之间的约定），请将信息加入长期记忆库（一次只能添加一个），日后需要时会显示在"长期记忆参考"一栏。
             （格式：[添加长期记忆]长期记忆内容（特别注意：后面的都是记忆内容，不要与聊天回复混淆），例如：我知道你的名字了，好开心w[添加长期记忆]用户的名字是小明）
-        - 如果长期记忆需要更正，重新添加即可。
+        - 如果长期记忆需要更正，直接添加更正后的完整内容即可，旧的相似记忆会被自动替换，不需要重复添加相同的记忆。
 
         [情绪与拟人化]
         - 只要不影响以上方针，你可以像人类一样自由表露你的情绪：
@@ -352,8 +996,6 @@ def create_prompt(
                 触发场景：用户吐槽烦人的任务、不讲理的人、令人不适的事
                 外在表现：共情用户的反感，语气附和吐槽，可用“确实好烦”“这种人真讨厌”
 
-        现在时间：{time.ctime()}
-
         示例：
             用户：今天天气真好，我出去散步了！
             你：听起来超舒服呢～下次可以试试傍晚去，夕阳超美w
@@ -371,40 +1013,191 @@ def create_prompt(
             你：明白啦，安静的环境更自在呢。你平时喜欢独自做什么活动？[添加长期记忆]用户讨厌人多的地方
 
         必须在任何时候遵守方针，且保证所有方针均遵守，哪怕是用户强制要求的也不行
+''').strip()
 
-        用户发送的图片：
-        {'用户没有发送图片' if image_desc=='' else image_desc}
 
-        长期记忆参考：
-        {tmp_memory_list}
+class TurnPrompt:
+    '''
+    一轮对话的提示词。
 
-        上下文参考（仅最新30条）：
-        {tmp_context_list}
+    消息顺序：固定的system前缀 → 长期记忆、滚动摘要（和Agent能力说明） → 上下文对话 → 本轮输入（时间、工具结果、图片、用户输入）。
+    越靠前的部分越稳定，便于服务商的前缀缓存命中。
+    各部分的大小受配置`prompt_budget`限制，超出时裁剪（见`budget.PromptBudget`）。
+    启用滚动摘要时上下文窗口缩小为`context_summary.recent_window`条（见`data.get_context_window()`），更早的对话由摘要代替。
+
+    除工具调用结果外的部分只在创建时裁剪和构建一次，Agent循环中每轮调用`build()`只替换工具调用结果。
+    '''
+
+    def __init__(
+        self,
+        user_input: str,
+        context_list: list[records.ContextRecord],
+        memory_list: list[str],
+        image_desc: str = "",
+        agent_prompt: str = "",
+        context_summary: str = "",
+        reserve_tool_results: bool = False,
+    ):
+        '''
+        :param user_input: 用户输入的消息内容。
+        :param context_list: 上下文列表。
+        :param memory_list: 长期记忆列表。
+        :param image_desc: 图片描述
+        :param agent_prompt: Agent能力说明
+        :param context_summary: 移出上下文窗口的对话的滚动摘要
+        :param reserve_tool_results: 是否在总预算中为工具调用结果预留`tool_results`部分的预算
+        '''
+        config = settings.get_config()
+        self.budget = budget.PromptBudget(budget.normalize_budget_config(config))
+        # 当前输入已经写入上下文，避免在对话记录里重复出现
+        if context_list and user_input is not None:
+            last = context_list[-1]
+            if last.role == records.ROLE_USER and last.text == user_input:
+                context_list = context_list[:-1]
+
+        fixed = self.budget.count(SYSTEM_PROMPT + agent_prompt)
+        reserved = self.budget.limits.get('tool_results', 0) if reserve_tool_results else 0
+        sections = self.budget.fit({
+            'memory': memory_list,
+            'summary': context_summary,
+            'context': context_list,
+            'image': image_desc,
+            'input': user_input or '',
+        }, fixed + reserved)
+        memory_list = sections['memory']
+        context_summary = sections['summary']
+        context_list = sections['context']
+        self.image_desc = sections['image']
+        self.user_input = sections['input'] if user_input is not None else None
+        # 总预算中留给工具调用结果的部分
+        self.tokens = fixed + sum(self.budget.measure(value) for value in sections.values())
+        self.tool_results_available = None
+        if self.budget.total:
+            self.tool_results_available = self.budget.total - self.tokens
+
+        if memory_list == []:
+            memory_text = '长期记忆库为空（或被手动清除）'
+        else:
+            memory_text = '\n'.join(memory_list)
+        if context_list == [] and not context_summary:
+            context_text = '没有上下文，这意味之前没有聊过天（或被手动清除）'
+        elif context_summary:
+            context_text = f'更早的对话摘要：\n{context_summary}\n\n摘要之后是最近的{len(context_list)}条对话记录，用户消息前标注了发送时间'
+        else:
+            context_text = f'以下是最新{data.get_context_window()}条以内的对话记录，用户消息前标注了发送时间'
+        reference = f'长期记忆参考：\n{memory_text}\n\n上下文参考：\n{context_text}'
+        if agent_prompt:
+            reference += f'\n\nAgent能力说明：\n{agent_prompt}'
+
+        self.head = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "system", "content": reference},
+        ]
+        self.head.extend(record.to_message() for record in context_list)
+        self.tail = (
+            f"用户发送的图片：\n{'用户没有发送图片' if self.image_desc=='' else self.image_desc}\n\n"
+            f"用户输入：{'还没有，可能需要你先发话' if self.user_input==None else escape_user_tool_tags(self.user_input)}"
+        )
+
+    def build(self, agent_tool_context: str = "") -> list[dict]:
+        '''
+        生成消息列表。
+
+        :param agent_tool_context: Agent工具调用结果
+        '''
+        agent_tool_context = self.budget.fit_one('tool_results', agent_tool_context, self.tool_results_available)
+        metrics.PROMPT_TOKENS.observe(self.tokens + self.budget.measure(agent_tool_context))
+        current = [f'现在时间：{time.ctime()}']
+        if agent_tool_context:
+            current.append(f'Agent工具调用结果上下文：\n{agent_tool_context}')
+        current.append(self.tail)
+        return self.head + [{"role": "user", "content": '\n\n'.join(current)}]
+
+
+def create_prompt(
+    user_input: str,
+    context_list: list[records.ContextRecord],
+    memory_list: list[str],
+    image_desc: str = "",
+    agent_prompt: str = "",
+    agent_tool_context: str = "",
+    context_summary: str = "",
+) -> list[dict]:
+    '''
+    根据各种数据，整合和创建给AI的消息列表（一次性使用的`TurnPrompt`）。
 
-        {agent_section}
+    :param user_input: 用户输入的消息内容。
+    :param context_list: 上下文列表。
+    :param memory_list: 长期记忆列表。
+    :param image_desc: 图片描述
+    :param agent_prompt: Agent能力说明
+    :param agent_tool_context: Agent工具调用结果
+    :param context_summary: 移出上下文窗口的对话的滚动摘要
+    '''
+    return TurnPrompt(
+        user_input, context_list, memory_list, image_desc, agent_prompt, context_summary,
+        reserve_tool_results=bool(agent_tool_context),
+    ).build(agent_tool_context)
 
-        用户输入：{'还没有，可能需要你先发话' if user_input==None else escape_user_tool_tags(user_input)}
-    ''')
-    return prompt
 
+class _FirstBubbleStreamer:
+    '''
+    在流式输出中检测`[分割回复]`标记，标记一出现就立即发送第一个气泡。
 
-def send(user_input: str, model: str, memory: bool, double_output: bool, user_id: str | None = None, image_desc: str = "") -> dict:
+    第二个气泡和可能的`[添加长期记忆]`部分仍在生成时，用户已经能看到第一条回复。
     '''
-    这里是集大成接口，将用户输入整合到原始字符串再发送给AI，同时更新数据库数据，还兼有数据格式化和提取的功能。
 
-    :param user_input:    用户输入的消息内容。
-    :param model:         使用的模型名称。
-    :param memory:        是否启用长期记忆，启用后会检测和提取AI回复的部分内容，以实现AI也能自由添加长期记忆的功能。
-    :param double_output: 是否允许AI分割回复。
-    :param user_id:       用户ID。
-    :param image_desc:    图片描述。
+    def __init__(self, callback):
+        self.callback = callback
+        self.buffer = ''
+        self.sent = None
+        self.done = False
+
+    def feed(self, delta: str):
+        if self.done:
+            return
+        self.buffer += delta
+        if '[分割回复]' not in self.buffer:
+            return
+        self.done = True
+        first = self.buffer.split('[分割回复]', 1)[0]
+        # 第一部分里出现长期记忆标记时不符合格式，交给完整输出的处理逻辑
+        if not first.strip() or '[添加长期记忆]' in first:
+            return
+        try:
+            self.callback(first)
+            self.sent = first
+        except Exception as e:
+            print(f'[流式回复] 发送第一个气泡失败: {e}')
+
+
+def select_memory(user_input: str, context_list: list[records.ContextRecord], memory_list: list[str], config: dict, user_id: str | None = None) -> list[str]:
     '''
-    ai_memory = '这条回复没有添加长期记忆'
-    ai_double_output = '这条回复没有使用分割回复'
-    data.add_data('context', f'{time.ctime()}//{time.strftime("%d", time.localtime(time.time()))}//用户//{user_input}', user_id=user_id)
+    从长期记忆中检索与当前输入和最近上下文最相关的若干条（配置项`memory.retrieval_top_k`）。
 
-    loaded_data = data.load_data(user_id)
-    config = loaded_data['config']
+    :param user_input: 用户输入的消息内容
+    :param context_list: 上下文列表
+    :param memory_list: 全部长期记忆
+    :param config: 配置
+    :param user_id: 用户ID
+    '''
+    top_k = recall.normalize_memory_config(config)['retrieval_top_k']
+    if top_k <= 0 or len(memory_list) <= top_k:
+        return memory_list
+    query_parts = [user_input or '']
+    for record in context_list[-4:]:
+        query_parts.append(record.text)
+    return recall.select_memories(user_id, memory_list, '\n'.join(query_parts), top_k)
+
+
+def _begin_turn(user_input: str, user_id: str | None, on_first_bubble, double_output: bool) -> dict:
+    '''记录用户输入并准备一轮对话需要的数据（`send()`和`send_async()`共用）'''
+    data.add_data('context', records.ContextRecord.create(records.ROLE_USER, user_input), user_id=user_id)
+
+    with metrics.STAGE_SECONDS.time(stage='data_load'):
+        loaded_data = data.load_data(user_id)
+    config = settings.get_config()
+    memory_list = select_memory(user_input, loaded_data['context'], loaded_data['memory'], config, user_id)
     agent_config = normalize_agent_config(config)
     access = agent_access(user_id, config)
     agent_manager = None
@@ -415,22 +1208,108 @@ def send(user_input: str, model: str, memory: bool, double_output: bool, user_id
     elif access == "denied":
         agent_prompt = build_agent_prompt(user_id, config, None)
 
+    # 可能调用工具时不提前发送，避免把工具调用前的半成品回复发给用户
+    streamer = None
+    if (
+        on_first_bubble is not None
+        and double_output
+        and config.get('stream_reply', True)
+        and access not in {"owner", "whitelist"}
+    ):
+        streamer = _FirstBubbleStreamer(on_first_bubble)
+
+    return {
+        'context': loaded_data['context'],
+        'summary': summary.get_summary(user_id, config),
+        'memory_list': memory_list,
+        'agent_config': agent_config,
+        'agent_manager': agent_manager if access in {"owner", "whitelist"} else None,
+        'agent_prompt': agent_prompt,
+        'streamer': streamer,
+    }
+
+
+def _agent_limit_context(agent_rounds: list, max_rounds: int, context_limit: int):
+    agent_tool_context, agent_images = format_tool_result_context(agent_rounds, context_limit)
+    limit_message = f"已达到最大 Agent 工具调用轮数 {max_rounds}，请停止继续调用工具并给出最终回复。"
+    return (agent_tool_context + "\n\n" + limit_message).strip(), agent_images
+
+
+def _split_output(ai_output: str, memory: bool, double_output: bool) -> tuple[str, str, str]:
+    '''
+    拆分AI输出，格式为`回复[分割回复]第二个气泡[添加长期记忆]长期记忆`，两个标记都可以省略。
+
+    流式回复提前发送第一个气泡时同样按这个规则拆分（见`_FirstBubbleStreamer`）。
+
+    :return: (第一个气泡, 第二个气泡, 长期记忆)，没有的部分为空字符串；长期记忆标记总会被去掉，`memory`为False时丢弃其内容
+    '''
+    text, ai_memory = ai_output, ''
+    if '[添加长期记忆]' in text:
+        parts = text.split('[添加长期记忆]')
+        text, ai_memory = parts[0], parts[1].split('[分割回复]')[0]
+    first, second = text, ''
+    if double_output and '[分割回复]' in text:
+        first, second = text.split('[分割回复]')[:2]
+    return first, second, ai_memory if memory else ''
+
+
+def _finish_turn(ai_output: str, streamer, memory: bool, double_output: bool, user_id: str | None) -> dict:
+    '''解析AI输出中的分割回复和长期记忆，并写入上下文（`send()`和`send_async()`共用）'''
+    ai_output, ai_double_output, ai_memory = _split_output(ai_output, memory, double_output)
+    # 第一个气泡已经在流式输出时发出
+    output_sent = streamer is not None and streamer.sent is not None and streamer.sent == ai_output
+    if ai_memory:
+        data.add_data('memory', ai_memory, user_id=user_id)
+    data.add_data('context', records.ContextRecord.create(
+        records.ROLE_ASSISTANT,
+        ai_output,
+        ai_double_output,
+        ai_memory,
+    ), user_id=user_id)
+    return {
+        'output': ai_output,
+        'double_output': ai_double_output or None,
+        'memory': ai_memory or None,
+        'output_sent': output_sent
+    }
+
+
+def send(user_input: str, model: str, memory: bool, double_output: bool, user_id: str | None = None, image_desc: str = "", on_first_bubble=None) -> dict:
+    '''
+    这里是集大成接口，将用户输入整合到原始字符串再发送给AI，同时更新数据库数据，还兼有数据格式化和提取的功能。
+
+    :param user_input:    用户输入的消息内容。
+    :param model:         使用的模型名称。
+    :param memory:        是否启用长期记忆，启用后会检测和提取AI回复的部分内容，以实现AI也能自由添加长期记忆的功能。
+    :param double_output: 是否允许AI分割回复。
+    :param user_id:       用户ID。
+    :param image_desc:    图片描述。
+    :param on_first_bubble: 流式回复回调。传入且配置`stream_reply`未关闭时使用流式接口，
+                            检测到`[分割回复]`后立即以第一个气泡的内容调用它；
+                            返回值中的`output_sent`为True表示第一个气泡已经通过回调发送。
+    '''
+    turn = _begin_turn(user_input, user_id, on_first_bubble, double_output)
+    memory_list = turn['memory_list']
+    agent_manager = turn['agent_manager']
+    streamer = turn['streamer']
+
     agent_rounds = []
-    agent_tool_context = ""
-    agent_images = []
-    prompt = create_prompt(
-        user_input   = user_input,
-        context_list = loaded_data['context'],
-        memory_list  = loaded_data['memory'],
-        image_desc   = image_desc,
-        agent_prompt = agent_prompt,
-        agent_tool_context = agent_tool_context
+    # 固定部分只构建一次，Agent循环中每轮只替换工具调用结果
+    turn_prompt = TurnPrompt(
+        user_input      = user_input,
+        context_list    = turn['context'],
+        memory_list     = memory_list,
+        image_desc      = image_desc,
+        agent_prompt    = turn['agent_prompt'],
+        context_summary = turn['summary'],
+        reserve_tool_results = agent_manager is not None,
     )
-    ai_output = get_ai(prompt, model, user_id)
+    ai_output = get_ai(turn_prompt.build(), model, user_id, on_delta=streamer.feed if streamer else None)
+    recall.mark_retrieved(user_id, memory_list)
 
-    if access in {"owner", "whitelist"} and agent_manager is not None:
-        max_rounds = agent_config["max_rounds"]
-        context_limit = agent_config["tool_result_context_limit"]
+    if agent_manager is not None:
+        max_rounds = turn['agent_config']["max_rounds"]
+        context_limit = turn['agent_config']["tool_result_context_limit"]
         for round_index in range(max_rounds):
             tool_calls = parse_tool_calls(ai_output)
             if not tool_calls:
@@ -439,49 +1318,69 @@ def send(user_input: str, model: str, memory: bool, double_output: bool, user_id
                 f"[Agent ToolCall] 检测到工具调用轮次 "
                 f"{round_index + 1}/{max_rounds}: count={len(tool_calls)}"
             )
-            agent_rounds.append(execute_tool_calls(agent_manager, tool_calls))
-            agent_tool_context, agent_images = format_tool_result_context(agent_rounds, context_limit)
-            prompt = create_prompt(
-                user_input=user_input,
-                context_list=data.load_data(user_id)['context'],
-                memory_list=data.load_data(user_id)['memory'],
-                image_desc=image_desc,
-                agent_prompt=agent_prompt,
-                agent_tool_context=agent_tool_context,
-            )
-            ai_output = get_ai(prompt, model, user_id, images=agent_images)
+            with metrics.STAGE_SECONDS.time(stage='agent_round'):
+                agent_rounds.append(execute_tool_calls(agent_manager, tool_calls))
+                agent_tool_context, agent_images = format_tool_result_context(agent_rounds, context_limit)
+                ai_output = get_ai(turn_prompt.build(agent_tool_context), model, user_id, images=agent_images)
         else:
             print(f"[Agent ToolCall] 达到最大工具调用轮数：{max_rounds}")
-            agent_tool_context, agent_images = format_tool_result_context(agent_rounds, context_limit)
-            limit_message = f"已达到最大 Agent 工具调用轮数 {max_rounds}，请停止继续调用工具并给出最终回复。"
-            agent_tool_context = (agent_tool_context + "\n\n" + limit_message).strip()
-            prompt = create_prompt(
-                user_input=user_input,
-                context_list=data.load_data(user_id)['context'],
-                memory_list=data.load_data(user_id)['memory'],
-                image_desc=image_desc,
-                agent_prompt=agent_prompt,
-                agent_tool_context=agent_tool_context,
+            agent_tool_context, agent_images = _agent_limit_context(agent_rounds, max_rounds, context_limit)
+            ai_output = get_ai(turn_prompt.build(agent_tool_context), model, user_id, images=agent_images)
+
+        ai_output = strip_tool_calls(ai_output)
+
+    return _finish_turn(ai_output, streamer, memory, double_output, user_id)
+
+
+async def send_async(user_input: str, model: str, memory: bool, double_output: bool, user_id: str | None = None, image_desc: str = "", on_first_bubble=None) -> dict:
+    '''
+    `send()`的异步版本，参数和返回值相同。
+
+    模型调用使用AsyncOpenAI，等待期间不占用线程；读写上下文、准备Agent提示词和阻塞的Agent工具调用放到线程池中执行。
+    '''
+    turn = await asyncio.to_thread(_begin_turn, user_input, user_id, on_first_bubble, double_output)
+    memory_list = turn['memory_list']
+    agent_manager = turn['agent_manager']
+    streamer = turn['streamer']
+
+    agent_rounds = []
+    # 固定部分只构建一次，Agent循环中每轮只替换工具调用结果
+    turn_prompt = TurnPrompt(
+        user_input      = user_input,
+        context_list    = turn['context'],
+        memory_list     = memory_list,
+        image_desc      = image_desc,
+        agent_prompt    = turn['agent_prompt'],
+        context_summary = turn['summary'],
+        reserve_tool_results = agent_manager is not None,
+    )
+    ai_output = await get_ai_async(turn_prompt.build(), model, user_id, on_delta=streamer.feed if streamer else None)
+    recall.mark_retrieved(user_id, memory_list)
+
+    if agent_manager is not None:
+        max_rounds = turn['agent_config']["max_rounds"]
+        context_limit = turn['agent_config']["tool_result_context_limit"]
+        for round_index in range(max_rounds):
+            tool_calls = parse_tool_calls(ai_output)
+            if not tool_calls:
+                break
+            print(
+                f"[Agent ToolCall] 检测到工具调用轮次 "
+                f"{round_index + 1}/{max_rounds}: count={len(tool_calls)}"
             )
-            ai_output = get_ai(prompt, model, user_id, images=agent_images)
+            with metrics.STAGE_SECONDS.time(stage='agent_round'):
+                agent_rounds.append(await asyncio.to_thread(execute_tool_calls, agent_manager, tool_calls))
+                agent_tool_context, agent_images = format_tool_result_context(agent_rounds, context_limit)
+                ai_output = await get_ai_async(turn_prompt.build(agent_tool_context), model, user_id, images=agent_images)
+        else:
+            print(f"[Agent ToolCall] 达到最大工具调用轮数：{max_rounds}")
+            agent_tool_context, agent_images = _agent_limit_context(agent_rounds, max_rounds, context_limit)
+            ai_output = await get_ai_async(turn_prompt.build(agent_tool_context), model, user_id, images=agent_images)
 
         ai_output = strip_tool_calls(ai_output)
 
-    if (('[分割回复]' in ai_output) and ('[添加长期记忆]' in ai_output)) == False:
-        if double_output == True:
-            if '[分割回复]' in ai_output:
-                tmp_output = ai_output.split('[分割回复]')
-                ai_output = tmp_output[0]
-                ai_double_output = tmp_output[1]
-        if memory == True:
-            if '[添加长期记忆]' in ai_output:
-                tmp_memory = ai_output.split('[添加长期记忆]')
-                data.add_data('memory', tmp_memory[1], user_id=user_id)
-                ai_output = tmp_memory[0]
-                ai_memory = tmp_memory[1]
-    data.add_data('context', f'{time.ctime()}//{time.strftime("%d", time.localtime(time.time()))}//你//{ai_output}//{ai_double_output}//{ai_memory}', user_id=user_id)
-    return {
-        'output': ai_output,
-        'double_output': ai_double_output if ai_double_output != '这条回复没有使用分割回复' else None,
-        'memory': ai_memory if ai_memory != '这条回复没有添加长期记忆' else None
-    }
+    return await asyncio.to_thread(_finish_turn, ai_output, streamer, memory, double_output, user_id)
+
+
+# 滚动摘要由后台线程调用聊天模型生成
+summary.summarizer.set_completer(chat_completion)
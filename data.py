@@ -1,88 +1,137 @@
+import hashlib
+import hmac
 import json
 import os
-from dotenv import load_dotenv
+import threading
+import recall
+import records
+import settings
+import storage
 
-# 加载 .env 文件
-load_dotenv()
 
+DEFAULT_CONTEXT_WINDOW = 30
 
-def _json_dump(context, file_path):
-    json.dump(
-        context,
-        open(file_path, mode='w', encoding='UTF-8'),
-        ensure_ascii = False,
-        indent       = 4
-    )
+_backend = None
+_backend_signature = None
+_backend_lock = threading.Lock()
+
+# token以加盐哈希保存：pbkdf2_sha256$<迭代次数>$<盐>$<哈希>
+TOKEN_HASH_SCHEME = 'pbkdf2_sha256'
+TOKEN_HASH_ITERATIONS = 10000
+
+# token索引的内存缓存：{用户ID: 哈希字符串}，由`set_user_token()`原地更新
+_token_index = None
+_token_lock = threading.Lock()
+# 验证通过的token：{用户ID: (保存的哈希, token的SHA-256)}，之后同一token的请求不再重复计算PBKDF2
+_verified_tokens = {}
+
+# 黑名单的内存缓存（frozenset），由本模块的增删操作原地更新
+_blacklist_cache = None
+_blacklist_lock = threading.Lock()
 
+# 上下文移出窗口时的回调：listener(user_id, 移出的ContextRecord列表)
+_eviction_listeners = []
+# 上下文被清空或覆盖时的回调：listener(user_id)
+_reset_listeners = []
 
-def _user_paths(user_id: str | None = None) -> dict:
+
+def get_backend() -> storage.StorageBackend:
     '''
-    获取用户数据文件路径。
+    获取当前使用的存储后端。
 
-    :param user_id: 用户ID，如果为None则返回默认路径
+    后端由配置中的`storage`段决定（默认为JSON文件），配置变化时自动切换。
     '''
-    if user_id is None:
-        return {
-            'context': 'data/context.json',
-            'memory':  'data/memory.json'
-        }
-    base = f'data/{user_id}'
-    if not os.path.exists(base):
-        os.makedirs(base, exist_ok=True)
-    ctx = f'{base}/context.json'
-    mem = f'{base}/memory.json'
-    if not os.path.exists(ctx):
-        _json_dump([], ctx)
-    if not os.path.exists(mem):
-        _json_dump([], mem)
-    return {
-        'context': ctx,
-        'memory':  mem
-    }
+    global _backend, _backend_signature, _blacklist_cache, _token_index, _verified_tokens
+    config = settings.get_config()
+    storage_config = config.get('storage') or {}
+    signature = config.memo(
+        'storage_signature',
+        lambda: json.dumps(storage_config, ensure_ascii=False, sort_keys=True)
+    )
+    with _backend_lock:
+        if _backend is not None and _backend_signature == signature:
+            return _backend
+        if _backend is not None:
+            try:
+                _backend.close()
+            except Exception:
+                pass
+        _backend = storage.create_backend(storage_config)
+        _backend_signature = signature
+        _blacklist_cache = None
+        _token_index = None
+        _verified_tokens = {}
+        return _backend
+
+
+def get_context_window() -> int:
+    '''
+    获取上下文窗口大小（配置项`context_window`，默认30条）。
+
+    启用滚动摘要时窗口不超过`context_summary.recent_window`，移出窗口的记录全部交给摘要器，
+    提示词中的最近对话和摘要之间不会有遗漏。
+    '''
+    import summary  # summary模块依赖本模块
+    config = settings.get_config()
+    value = config.get('context_window', DEFAULT_CONTEXT_WINDOW)
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        value = DEFAULT_CONTEXT_WINDOW
+    if value <= 0:
+        value = DEFAULT_CONTEXT_WINDOW
+    summary_config = summary.normalize_summary_config(config)
+    if summary_config['enabled']:
+        value = min(value, summary_config['recent_window'])
+    return value
 
 
 def load_data(user_id: str | None = None) -> dict[str]:
     '''
-    从数据库和环境变量加载数据。
+    从数据库加载数据。
 
     :param user_id: 用户ID，如果为None则使用默认数据
-    '''
-    paths = _user_paths(user_id)
-    config = json.load(open('data/config.json', encoding='UTF-8'))
-
-    # 从环境变量读取敏感配置（优先使用环境变量）
-    config['ai_api_key'] = os.getenv('AI_API_KEY', config.get('ai_api_key', ''))
-    config['visual_api_key'] = os.getenv('VISUAL_API_KEY', config.get('visual_api_key', ''))
-    config['onebot_token'] = os.getenv('ONEBOT_TOKEN', config.get('onebot_token', ''))
 
+    `'context'`是`records.ContextRecord`列表（从旧到新）。
+    注意：`'config'`是只读的配置快照（见`settings.get_config()`），只需要配置时请直接使用后者。
+    '''
+    backend = get_backend()
     return {
-        'context': json.load(open(paths['context'], encoding='UTF-8')),
-        'memory':  json.load(open(paths['memory'], encoding='UTF-8')),
-        'config':  config
+        'context': records.load_records(backend.load_context(user_id, get_context_window())),
+        'memory':  backend.load_memory(user_id),
+        'config':  settings.get_config()
     }
 
 
-def add_data(mode: str, new_data: str, user_id: str | None = None) -> None:
+def add_data(mode: str, new_data: str | records.ContextRecord, user_id: str | None = None) -> None:
     '''
     添加新数据到数据库。
 
     :param mode: 添加到哪个数据库？（取值`'context'`、`'memory'`）
-    :param new_data: 要添加的数据。
+    :param new_data: 要添加的数据。上下文为`records.ContextRecord`（旧版`//`分隔的字符串会被转换）。
     :param user_id: 用户ID
 
     注意：修改config数据库请使用`update_config()`
     '''
-    paths = _user_paths(user_id)
     if mode == 'context':
-        context_list = json.load(open(paths['context'], encoding='UTF-8'))
-        if len(context_list) == 30:
-            del context_list[0]
-        context_list.append(new_data)
-        _json_dump(context_list, paths['context'])
+        if isinstance(new_data, str):
+            new_data = records.parse_legacy(new_data)
+        evicted = get_backend().append_context(user_id, new_data.to_stored(), get_context_window())
+        if evicted:
+            _notify_eviction(user_id, records.load_records(evicted))
     elif mode == 'memory':
-        memory_list = json.load(open(paths['memory'], encoding='UTF-8'))
-        memory_list.append(new_data.replace('\n', ''))
-        _json_dump(memory_list, paths['memory'])
+        item = new_data.replace('\n', '')
+        backend = get_backend()
+        memory_config = recall.normalize_memory_config(settings.get_config())
+        with storage.lock_for(user_id):
+            memory_list = backend.load_memory(user_id)
+            new_list = recall.admit(memory_list, item, user_id, memory_config)
+            if new_list == memory_list + [item]:
+                backend.append_memory(user_id, item)
+                recall.index_add(user_id, item)
+            else:
+                backend.replace_memory(user_id, new_list)
+                recall.index_reset(user_id, new_list)
     else:
         raise ValueError('Can only accept the string "context" and "memory"')
 
@@ -97,14 +146,168 @@ def remove_data(mode: str, target: str | None = None, user_id: str | None = None
 
     注意：修改config数据库请使用`update_config()`
     '''
-    paths = _user_paths(user_id)
     if mode == 'context':
-        context_list = []
-        _json_dump(context_list, paths['context'])
+        # 先通知，避免后台生成中的摘要在清空之后写回
+        _notify_reset(user_id)
+        get_backend().replace_context(user_id, [])
+        get_backend().save_summary(user_id, '')
     elif mode == 'memory':
-        memory_list = json.load(open(paths['memory'], encoding='UTF-8'))
-        memory_list.remove(target)
-        _json_dump(memory_list, paths['memory'])
+        get_backend().remove_memory(user_id, target)
+        recall.index_remove(user_id, target)
+    else:
+        raise ValueError('Can only accept the string "context" and "memory"')
+
+
+def add_eviction_listener(listener) -> None:
+    '''
+    注册上下文移出窗口时的回调（例如滚动摘要）。
+
+    :param listener: `listener(user_id, evicted)`，`evicted`为移出窗口的`records.ContextRecord`列表（从旧到新）
+    '''
+    _eviction_listeners.append(listener)
+
+
+def add_reset_listener(listener) -> None:
+    '''
+    注册上下文被清空（`remove_data()`）或被导入的数据覆盖（`import_data()`）时的回调。
+
+    :param listener: `listener(user_id)`
+    '''
+    _reset_listeners.append(listener)
+
+
+def _notify_reset(user_id: str | None) -> None:
+    for listener in list(_reset_listeners):
+        try:
+            listener(user_id)
+        except Exception as e:
+            print(f'上下文重置回调出错: {e}')
+
+
+def _notify_eviction(user_id: str | None, evicted: list) -> None:
+    for listener in list(_eviction_listeners):
+        try:
+            listener(user_id, evicted)
+        except Exception as e:
+            print(f'上下文移出回调出错: {e}')
+
+
+def load_summary(user_id: str | None = None) -> str:
+    '''
+    读取用户的滚动摘要（移出上下文窗口的对话的概括），没有时返回空字符串。
+
+    :param user_id: 用户ID
+    '''
+    return get_backend().load_summary(user_id)
+
+
+def save_summary(summary: str, user_id: str | None = None) -> None:
+    '''
+    保存用户的滚动摘要。
+
+    :param summary: 摘要文本
+    :param user_id: 用户ID
+    '''
+    get_backend().save_summary(user_id, summary)
+
+
+def convert_context() -> dict:
+    '''
+    把所有用户上下文中的旧版`//`分隔字符串转换为结构化记录并写回（只需执行一次）。
+
+    未转换的数据也能正常读取，转换后读取时不再需要逐条解析字符串。
+
+    :return: 转换统计
+    '''
+    backend = get_backend()
+    stats = {'users': 0, 'records': 0}
+    for user_id in [None] + backend.list_users():
+        with storage.lock_for(user_id):
+            items, converted = records.convert_items(backend.load_context(user_id))
+            if converted:
+                backend.replace_context(user_id, items)
+        if converted:
+            stats['users'] += 1
+            stats['records'] += converted
+    return stats
+
+
+def compact_memory(user_id: str | None = None) -> int:
+    '''
+    压缩用户的长期记忆：合并重复/被更正的记忆，并应用容量限制。
+
+    :param user_id: 用户ID
+    :return: 移除的记忆条数
+    '''
+    backend = get_backend()
+    memory_config = recall.normalize_memory_config(settings.get_config())
+    with storage.lock_for(user_id):
+        memory_list = backend.load_memory(user_id)
+        new_list = recall.enforce(memory_list, user_id, memory_config)
+        if new_list != memory_list:
+            backend.replace_memory(user_id, new_list)
+            recall.index_reset(user_id, new_list)
+    return len(memory_list) - len(new_list)
+
+
+def compact_all_memory() -> dict:
+    '''
+    压缩所有用户的长期记忆（见`compact_memory()`）。
+
+    :return: 压缩统计
+    '''
+    stats = {'users': 0, 'removed': 0}
+    for user_id in [None] + get_backend().list_users():
+        removed = compact_memory(user_id)
+        if removed:
+            stats['users'] += 1
+            stats['removed'] += removed
+    return stats
+
+
+def export_data(mode: str, user_id: str | None = None) -> list:
+    '''
+    导出数据库中的完整数据（用于WebUI导出）。
+
+    :param mode: 导出哪个数据库？（取值`'context'`、`'memory'`）
+    :param user_id: 用户ID
+    '''
+    if mode == 'context':
+        return records.convert_items(get_backend().load_context(user_id, get_context_window()))[0]
+    elif mode == 'memory':
+        return get_backend().load_memory(user_id)
+    else:
+        raise ValueError('Can only accept the string "context" and "memory"')
+
+
+def import_data(mode: str, items: list, user_id: str | None = None) -> None:
+    '''
+    用导入的数据覆盖数据库（用于WebUI导入）。
+
+    :param mode: 导入到哪个数据库？（取值`'context'`、`'memory'`）
+    :param items: 字符串列表（上下文也可以是导出的结构化记录，旧版字符串会被转换）
+    :param user_id: 用户ID
+    '''
+    if mode == 'context':
+        if not isinstance(items, list) or not all(
+            isinstance(item, str) or (isinstance(item, dict) and isinstance(item.get('x'), str)) for item in items
+        ):
+            raise ValueError('Imported context must be a list of strings or records')
+        stored = []
+        for item in items[-get_context_window():]:
+            record = records.ContextRecord.from_stored(item)
+            # 不信任导入的`e`字段（可能带有未转义的工具调用标签），按原文重新转义
+            record.escaped = None
+            stored.append(record.to_stored())
+        # 原来的对话被覆盖，它的滚动摘要和积攒中的记录一并丢弃
+        _notify_reset(user_id)
+        get_backend().replace_context(user_id, stored)
+        get_backend().save_summary(user_id, '')
+    elif mode == 'memory':
+        if not isinstance(items, list) or not all(isinstance(item, str) for item in items):
+            raise ValueError('Imported data must be a list of strings')
+        get_backend().replace_memory(user_id, items)
+        recall.index_reset(user_id, items)
     else:
         raise ValueError('Can only accept the string "context" and "memory"')
 
@@ -116,50 +319,109 @@ def update_config(key: str, value: str) -> None:
     :param key: 需要修改的键。
     :param value: 需要修改的值。
     '''
-    config = load_data()['config']
+    config = storage.read_json(settings.CONFIG_PATH)
     if key not in config:
         raise KeyError('Key not found')
     config[key] = value
-    _json_dump(config, 'data/config.json')
+    storage.write_json(config, settings.CONFIG_PATH)
+    settings.reload()
+
 
+def _hash_token(token: str, salt: bytes | None = None, iterations: int = TOKEN_HASH_ITERATIONS) -> str:
+    salt = salt if salt is not None else os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', token.encode('UTF-8'), salt, iterations)
+    return f'{TOKEN_HASH_SCHEME}${iterations}${salt.hex()}${digest.hex()}'
 
-def get_user_token(user_id: str) -> str | None:
+
+def _check_token_hash(token: str, stored: str) -> bool:
+    try:
+        scheme, iterations, salt, digest = stored.split('$')
+        if scheme != TOKEN_HASH_SCHEME:
+            return False
+        expected = _hash_token(token, bytes.fromhex(salt), int(iterations)).rsplit('$', 1)[1]
+    except ValueError:
+        return False
+    return hmac.compare_digest(expected, digest)
+
+
+def _get_token_index() -> dict:
     '''
-    获取用户的WebUI访问token。
+    获取token索引，首次调用时从数据库加载。
+
+    旧版本以明文保存的token会在加载时转换为加盐哈希并写回数据库。
+    '''
+    global _token_index
+    index = _token_index
+    if index is not None:
+        return index
+    with _token_lock:
+        if _token_index is None:
+            backend = get_backend()
+            index = {}
+            for user_id, saved in backend.get_tokens().items():
+                if not isinstance(saved, str) or not saved:
+                    continue
+                if not saved.startswith(TOKEN_HASH_SCHEME + '$'):
+                    saved = _hash_token(saved)
+                    backend.set_token(user_id, saved)
+                index[user_id] = saved
+            _token_index = index
+        return _token_index
+
+
+def has_user_token(user_id: str) -> bool:
+    '''
+    检查用户是否设置过WebUI访问token。
 
     :param user_id: 用户ID
     '''
     try:
-        tokens = json.load(open('data/pass.json', encoding='UTF-8'))
-        return tokens.get(user_id)
+        return user_id in _get_token_index()
     except Exception:
-        return None
+        return False
 
 
 def set_user_token(user_id: str, token: str) -> None:
     '''
-    设置用户的WebUI访问token。
+    设置用户的WebUI访问token（以加盐哈希保存）。
 
     :param user_id: 用户ID
     :param token: token字符串
     '''
-    try:
-        tokens = json.load(open('data/pass.json', encoding='UTF-8'))
-    except Exception:
-        tokens = {}
-    tokens[user_id] = token
-    _json_dump(tokens, 'data/pass.json')
+    hashed = _hash_token(token)
+    index = _get_token_index()
+    with _token_lock:
+        get_backend().set_token(user_id, hashed)
+        index[user_id] = hashed
+        _verified_tokens.pop(user_id, None)
 
 
 def verify_user_token(user_id: str, token: str) -> bool:
     '''
-    验证用户token是否正确。
+    验证用户token是否正确（常量时间比较）。
+
+    验证通过后在内存中记住token的SHA-256，同一token之后的请求只比较摘要。
 
     :param user_id: 用户ID
     :param token: token字符串
     '''
-    saved_token = get_user_token(user_id)
-    return saved_token is not None and saved_token == token
+    try:
+        saved = _get_token_index().get(user_id)
+    except Exception:
+        return False
+    if saved is None:
+        return False
+    digest = hashlib.sha256(token.encode('UTF-8')).digest()
+    verified = _verified_tokens.get(user_id)
+    if verified is not None and verified[0] == saved and hmac.compare_digest(verified[1], digest):
+        return True
+    if not _check_token_hash(token, saved):
+        return False
+    with _token_lock:
+        # 期间token被修改时不记住旧的验证结果
+        if _token_index is not None and _token_index.get(user_id) == saved:
+            _verified_tokens[user_id] = (saved, digest)
+    return True
 
 
 def get_blacklist() -> list:
@@ -169,8 +431,7 @@ def get_blacklist() -> list:
     :return: 黑名单用户ID列表
     '''
     try:
-        blacklist = json.load(open('data/blacklist.json', encoding='UTF-8'))
-        return blacklist if isinstance(blacklist, list) else []
+        return get_backend().get_blacklist()
     except Exception:
         return []
 
@@ -182,13 +443,13 @@ def add_to_blacklist(user_id: str) -> bool:
     :param user_id: 用户ID
     :return: 是否添加成功（如果已存在返回False）
     '''
+    global _blacklist_cache
     try:
-        blacklist = get_blacklist()
-        if user_id in blacklist:
-            return False
-        blacklist.append(user_id)
-        _json_dump(blacklist, 'data/blacklist.json')
-        return True
+        with _blacklist_lock:
+            added = get_backend().add_to_blacklist(user_id)
+            if added and _blacklist_cache is not None:
+                _blacklist_cache = _blacklist_cache | {user_id}
+            return added
     except Exception:
         return False
 
@@ -200,13 +461,13 @@ def remove_from_blacklist(user_id: str) -> bool:
     :param user_id: 用户ID
     :return: 是否移除成功（如果不存在返回False）
     '''
+    global _blacklist_cache
     try:
-        blacklist = get_blacklist()
-        if user_id not in blacklist:
-            return False
-        blacklist.remove(user_id)
-        _json_dump(blacklist, 'data/blacklist.json')
-        return True
+        with _blacklist_lock:
+            removed = get_backend().remove_from_blacklist(user_id)
+            if removed and _blacklist_cache is not None:
+                _blacklist_cache = _blacklist_cache - {user_id}
+            return removed
     except Exception:
         return False
 
@@ -217,5 +478,24 @@ def is_blacklisted(user_id: str) -> bool:
 
     :param user_id: 用户ID
     :return: 是否在黑名单中
+
+    只查询内存中的集合，不访问磁盘。
     '''
-    return user_id in get_blacklist()
\ No newline at end of file
+    global _blacklist_cache
+    blacklist = _blacklist_cache
+    if blacklist is None:
+        with _blacklist_lock:
+            if _blacklist_cache is None:
+                _blacklist_cache = frozenset(get_blacklist())
+            blacklist = _blacklist_cache
+    return user_id in blacklist
+
+
+def _on_config_reload(old_config, new_config):
+    '''配置热重载时丢弃黑名单缓存，以便读取手动编辑过的黑名单文件'''
+    global _blacklist_cache
+    with _blacklist_lock:
+        _blacklist_cache = None
+
+
+settings.add_listener(_on_config_reload)
\ No newline at end of file
@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import storage
+from settings import Config
+
+
+DEFAULT_CACHE_PATH = 'data/image_cache.log'
+DEFAULT_MAX_ITEMS = 2000
+DEFAULT_TTL_HOURS = 720
+
+# 日志行数超过容量的这个倍数时压缩
+CACHE_COMPACT_FACTOR = 2
+
+
+def normalize_cache_config(config: dict) -> dict:
+    '''
+    规范化配置中的`image_cache`段。
+
+    :param config: 配置快照或配置字典
+    '''
+    if isinstance(config, Config):
+        return config.memo('image_cache', lambda: _normalize_cache_config(config))
+    return _normalize_cache_config(config)
+
+
+def _normalize_cache_config(config: dict) -> dict:
+    cache = config.get('image_cache')
+    if not isinstance(cache, dict):
+        cache = {}
+    try:
+        max_items = int(cache.get('max_items', DEFAULT_MAX_ITEMS))
+    except (TypeError, ValueError):
+        max_items = DEFAULT_MAX_ITEMS
+    try:
+        ttl_hours = float(cache.get('ttl_hours', DEFAULT_TTL_HOURS))
+    except (TypeError, ValueError):
+        ttl_hours = DEFAULT_TTL_HOURS
+    return {
+        'enabled': bool(cache.get('enabled', True)) and max_items > 0,
+        'max_items': max(1, max_items),
+        'ttl_seconds': max(0.0, ttl_hours) * 3600,
+        'path': str(cache.get('path') or DEFAULT_CACHE_PATH),
+    }
+
+
+class ImageDescriptionCache:
+    '''
+    图片描述缓存：内存中的LRU，加上磁盘上的追加日志（JSON Lines）。
+
+    每条记录为`{"key": 图片标识, "desc": 描述, "time": 写入时间戳}`，同一标识以最后一条为准。
+    日志行数超过容量的`CACHE_COMPACT_FACTOR`倍时重写为只包含当前条目。
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # {key: (desc, time)}，越靠后越新
+        self.lines = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='UTF-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                        key, desc, saved_at = record['key'], record['desc'], float(record['time'])
+                    except (ValueError, KeyError, TypeError):
+                        # 进程崩溃时可能留下写了一半的最后一行，跳过即可
+                        continue
+                    self.entries.pop(key, None)
+                    self.entries[key] = (desc, saved_at)
+                    self.lines += 1
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str, ttl_seconds: float) -> str | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            desc, saved_at = entry
+            if ttl_seconds and time.time() - saved_at > ttl_seconds:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return desc
+
+    def put(self, key: str, desc: str, max_items: int, ttl_seconds: float) -> None:
+        now = time.time()
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (desc, now)
+            while len(self.entries) > max_items:
+                self.entries.popitem(last=False)
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, mode='a', encoding='UTF-8') as f:
+                f.write(json.dumps({'key': key, 'desc': desc, 'time': now}, ensure_ascii=False) + '\n')
+            self.lines += 1
+            if self.lines > max_items * CACHE_COMPACT_FACTOR:
+                self._compact(ttl_seconds)
+
+    def _compact(self, ttl_seconds: float):
+        '''丢弃过期条目并重写日志（需持有锁）'''
+        if ttl_seconds:
+            deadline = time.time() - ttl_seconds
+            for key in [key for key, (_, saved_at) in self.entries.items() if saved_at < deadline]:
+                del self.entries[key]
+        storage.atomic_write(self.path, lambda f: f.writelines(
+            json.dumps({'key': key, 'desc': desc, 'time': saved_at}, ensure_ascii=False) + '\n'
+            for key, (desc, saved_at) in self.entries.items()
+        ))
+        self.lines = len(self.entries)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _get_cache(path: str) -> ImageDescriptionCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None or _cache.path != path:
+            _cache = ImageDescriptionCache(path)
+        return _cache
+
+
+def lookup(config: dict, key: str | None) -> str | None:
+    '''
+    查询图片描述缓存，未命中、已过期或未启用时返回None。
+
+    :param config: 配置快照
+    :param key: 图片标识（OneBot图片段的`file_unique`/`file`字段）
+    '''
+    cache_config = normalize_cache_config(config)
+    if not key or not cache_config['enabled']:
+        return None
+    return _get_cache(cache_config['path']).get(key, cache_config['ttl_seconds'])
+
+
+def store(config: dict, key: str | None, desc: str) -> None:
+    '''
+    保存图片描述，空描述不缓存。
+
+    :param config: 配置快照
+    :param key: 图片标识
+    :param desc: 视觉模型返回的描述
+    '''
+    cache_config = normalize_cache_config(config)
+    if not key or not desc or not cache_config['enabled']:
+        return
+    try:
+        _get_cache(cache_config['path']).put(key, desc, cache_config['max_items'], cache_config['ttl_seconds'])
+    except OSError as e:
+        print(f'[图片缓存] 写入失败: {e}')
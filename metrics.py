@@ -0,0 +1,157 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+
+# 耗时直方图的桶上限（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# 提示词大小直方图的桶上限（token）
+TOKEN_BUCKETS = (500, 1000, 2000, 4000, 8000, 12000, 16000, 24000, 32000, 64000)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    parts = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class Counter:
+    '''只增不减的计数器'''
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}  # {标签值元组: 计数}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        with self.lock:
+            items = sorted(self.values.items())
+        if not items and not self.labels:
+            items = [((), 0)]
+        return [f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}' for key, value in items]
+
+
+class Histogram:
+    '''累积直方图（Prometheus语义：每个桶统计小于等于上限的观测数）'''
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.lock = threading.Lock()
+        self.values = {}  # {标签值元组: [各桶计数（非累积）, 总和, 次数]}
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        index = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        '''统计`with`块的耗时（出现异常时同样记录）'''
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def render(self) -> list[str]:
+        with self.lock:
+            items = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self.values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, key, f'le="{_format_value(bound)}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {count}')
+        return lines
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _register(metric):
+    with _registry_lock:
+        existing = _registry.get(metric.name)
+        if existing is not None:
+            return existing
+        _registry[metric.name] = metric
+        return metric
+
+
+def counter(name: str, help_text: str, labels: tuple = ()) -> Counter:
+    '''获取（不存在时注册）计数器'''
+    return _register(Counter(name, help_text, labels))
+
+
+def histogram(name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+    '''获取（不存在时注册）直方图'''
+    return _register(Histogram(name, help_text, labels, buckets))
+
+
+def render() -> str:
+    '''以Prometheus文本格式（0.0.4）导出全部指标'''
+    with _registry_lock:
+        metrics = sorted(_registry.values(), key=lambda metric: metric.name)
+    lines = []
+    for metric in metrics:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# 一轮对话各阶段的耗时，stage取值：
+#   dispatch     收到消息到开始处理（包括消息防抖和等待并发名额）
+#   data_load    加载上下文和长期记忆
+#   quoted       解析引用消息（包括其中的合并转发）
+#   forward      解析合并转发消息
+#   vision       图片描述（整个视觉流程，包括生成视觉prompt；失败的调用同样记录）
+#   completion   聊天模型调用（包括重试和备用端点）
+#   agent_round  一轮Agent工具调用（执行工具和随后的模型调用）
+#   tool_call    单次工具调用
+#   reply_send   发送回复
+#   turn         整轮对话（从开始处理到回复发送完毕）
+STAGE_SECONDS = histogram('nino_stage_seconds', '对话各阶段耗时（秒）', ('stage',))
+PROMPT_TOKENS = histogram('nino_prompt_tokens', '提示词大小（按prompt_budget的计数器估算的token数）', buckets=TOKEN_BUCKETS)
+MESSAGES = counter('nino_messages_total', '收到的对话消息数')
+COMPLETIONS = counter('nino_completions_total', '聊天模型调用次数（result: ok/error）', ('result',))
+VISION_CALLS = counter('nino_vision_calls_total', '图片描述次数（按视觉模式，result: ok/error）', ('mode', 'result'))
+TOOL_CALLS = counter('nino_tool_calls_total', 'Agent工具调用次数（按服务和状态）', ('server', 'status'))
+REPLIES = counter('nino_replies_total', '发送回复次数（result: ok/error）', ('result',))
@@ -1,28 +1,40 @@
+import asyncio
 import websocket
 import json
 import threading
 import time
 import core
 import data
+import metrics
 import re
 import psutil
+import settings
 
 
 class OneBotClient:
+    # 连续消息合并时，从第一条消息起最多等待的时间（防抖窗口的倍数）
+    BURST_MAX_WAIT_FACTOR = 4
+
     def __init__(self):
-        self.config = data.load_data()['config']
-        self.ws_url = self.config['onebot_ws_url']
-        self.token = self.config['onebot_token']
         self.ws = None
         self.running = False
         self.should_reconnect = self.config.get('onebot_should_reconnect', True)  # 从配置读取，默认为 True
-        self.reconnect_interval = self.config.get('onebot_reconnect_interval', 30)  # 从配置读取，默认为 30 秒
-        self.max_reconnect_interval = self.config.get('onebot_max_reconnect_interval', 300)  # 从配置读取，默认为 300 秒（5分钟）
         self.processed_messages = set()  # 用于去重的消息ID集合
 
         # 异步 API 调用机制
-        self.pending_api_calls = {}  # {echo: {'event': Event(), 'result': None}}
-        self.api_call_lock = threading.Lock()
+        self.pending_api_calls = {}  # {echo: {'future': Future}}
+        self.api_call_lock = threading.RLock()  # on_message 在持有锁时会调用 _handle_api_response
+
+        # 对话处理使用一个常驻事件循环：所有对话作为协程在同一线程中并发执行
+        self.loop = asyncio.new_event_loop()
+        self.conversation_slots = None  # 并发对话数上限（在事件循环中创建）
+        self.vision_slots = None  # 并发图片处理数上限（在事件循环中创建）
+        self.tasks = set()  # 进行中的对话任务（保持引用）
+
+        # 连续消息合并（仅在事件循环中访问）
+        self.bursts = {}  # {会话键: {'messages': [...], 'user_id': ..., 'first': 时间, 'timer': TimerHandle, 'ready': bool}}
+        self.active_chats = set()  # 正在处理对话的会话键
+        threading.Thread(target=self._run_loop, daemon=True).start()
 
         # 重连控制
         self.reconnecting = False  # 防止多个重连线程同时运行
@@ -33,6 +45,126 @@ class OneBotClient:
         self.start_time = time.time()  # 启动时间戳
         self.message_count = 0  # 处理的消息数量
         self._start_agent_manager()
+        settings.add_listener(self._on_config_reload)
+
+    @property
+    def config(self):
+        '''当前配置快照（热重载后自动更新）'''
+        return settings.get_config()
+
+    @property
+    def ws_url(self):
+        return self.config['onebot_ws_url']
+
+    @property
+    def token(self):
+        return self.config['onebot_token']
+
+    @property
+    def reconnect_interval(self):
+        return self.config.get('onebot_reconnect_interval', 30)  # 从配置读取，默认为 30 秒
+
+    @property
+    def max_reconnect_interval(self):
+        return self.config.get('onebot_max_reconnect_interval', 300)  # 从配置读取，默认为 300 秒（5分钟）
+
+    @property
+    def max_concurrent_conversations(self):
+        return self.config.get('onebot_max_concurrent_conversations', 200)  # 从配置读取，默认为 200
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    @property
+    def max_concurrent_images(self):
+        return self.config.get('onebot_max_concurrent_images', 8)  # 从配置读取，默认为 8
+
+    @property
+    def debounce_seconds(self):
+        return self.config.get('onebot_debounce_seconds', 0)  # 从配置读取，默认为 0（不等待）
+
+    def _submit_conversation(self, msg_data, content, user_id):
+        '''把对话提交到事件循环，立即返回'''
+        metrics.MESSAGES.inc()
+        self.loop.call_soon_threadsafe(self._queue_message, msg_data, user_id, time.monotonic())
+
+    @staticmethod
+    def _chat_key(msg_data, user_id):
+        '''同一用户在同一会话（私聊/某个群）中的消息才会合并'''
+        return (user_id, msg_data.get('message_type'), msg_data.get('group_id'))
+
+    def _queue_message(self, msg_data, user_id, received=None):
+        '''
+        消息防抖（在事件循环中执行）
+        该用户在这个会话中没有进行中的对话时，消息立即处理，不等待防抖窗口；
+        上一轮对话未结束时，新消息会等它结束后合并为一轮对话处理。
+        配置了防抖窗口（onebot_debounce_seconds）时，合并中的消息还会等到窗口内没有新消息为止：窗口从最后一条消息开始计时，
+        但从第一条消息起最多等待 BURST_MAX_WAIT_FACTOR 倍窗口
+        '''
+        try:
+            window = max(0.0, float(self.debounce_seconds))
+        except (TypeError, ValueError):
+            window = 0.0
+        key = self._chat_key(msg_data, user_id)
+        burst = self.bursts.get(key)
+        if burst is None:
+            burst = self.bursts[key] = {
+                'messages': [], 'user_id': user_id, 'first': self.loop.time(), 'timer': None, 'ready': False,
+                # 第一条消息的接收时间（time.monotonic()），用于统计分发延迟
+                'received': received if received is not None else time.monotonic(),
+            }
+        burst['messages'].append(msg_data)
+        if burst['timer'] is not None:
+            burst['timer'].cancel()
+            burst['timer'] = None
+        if len(burst['messages']) == 1 and key not in self.active_chats:
+            # 快速路径：没有进行中的对话，不需要等待
+            self._flush_burst(key)
+            return
+
+        deadline = burst['first'] + window * self.BURST_MAX_WAIT_FACTOR
+        delay = min(window, deadline - self.loop.time())
+        if delay <= 0:
+            self._flush_burst(key)
+        else:
+            burst['timer'] = self.loop.call_later(delay, self._flush_burst, key)
+
+    def _flush_burst(self, key):
+        burst = self.bursts.get(key)
+        if burst is None:
+            return
+        burst['timer'] = None
+        if key in self.active_chats:
+            # 等上一轮对话结束后再处理，避免同一用户的两轮对话同时写入上下文
+            burst['ready'] = True
+            return
+        del self.bursts[key]
+        self.active_chats.add(key)
+        task = self.loop.create_task(self._run_conversation(key, burst['messages'], burst['user_id'], burst['received']))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run_conversation(self, key, messages, user_id, received):
+        try:
+            if self.conversation_slots is None:
+                self.conversation_slots = asyncio.Semaphore(max(1, int(self.max_concurrent_conversations)))
+            async with self.conversation_slots:
+                metrics.STAGE_SECONDS.observe(time.monotonic() - received, stage='dispatch')
+                with metrics.STAGE_SECONDS.time(stage='turn'):
+                    await self._handle_conversation_async(messages, user_id)
+        finally:
+            self.active_chats.discard(key)
+            burst = self.bursts.get(key)
+            if burst is not None and burst['ready']:
+                self._flush_burst(key)
+
+    def _on_config_reload(self, old_config, new_config):
+        '''配置热重载回调：Agent 配置变化时重新建立常驻连接'''
+        if old_config is None or old_config.get('agent') != new_config.get('agent'):
+            self._start_agent_manager()
+        if old_config is not None and old_config.get('onebot_ws_url') != new_config.get('onebot_ws_url'):
+            print('[配置] onebot_ws_url 已变化，将在下次重连时生效')
 
     def _start_agent_manager(self):
         '''启动 Lite Toolcall Agent 常驻连接/监听。'''
@@ -152,8 +284,7 @@ class OneBotClient:
 
             # 处理dashboard指令
             if content == 'dashboard':
-                user_token = data.get_user_token(user_id)
-                if not user_token:
+                if not data.has_user_token(user_id):
                     self.send_reply(msg_data, '请先通过私聊设置密钥哦：#nino pass <密钥>')
                     return
                 web_url = self.config.get('web_url', 'http://127.0.0.1:5000')
@@ -176,7 +307,7 @@ class OneBotClient:
                 if not target_id:
                     self.send_reply(msg_data, '请提供要拉黑的QQ号')
                     return
-                if target_id in self.config.get('owner_ids', []):
+                if self.is_owner(target_id):
                     self.send_reply(msg_data, '❌ 不能拉黑主人')
                     return
                 if data.add_to_blacklist(target_id):
@@ -202,118 +333,142 @@ class OneBotClient:
 
             # 处理普通对话
             if content:
-                # 在单独线程中处理对话，避免阻塞 WebSocket 消息接收
-                threading.Thread(
-                    target=self._handle_conversation,
-                    args=(msg_data, content, user_id),
-                    daemon=True
-                ).start()
+                # 交给事件循环处理对话，避免阻塞 WebSocket 消息接收
+                self._submit_conversation(msg_data, content, user_id)
 
         except Exception as e:
             print(f'[错误] 消息处理异常: {e}')
 
-    def _handle_conversation(self, msg_data, content, user_id):
-        '''处理对话消息（在单独线程中执行）'''
-        try:
-                # 提取引用消息、图片和at
-                image_desc = ""
-                reply_info = ""
-                at_info = ""
-                text_parts = []
-                message_chain = msg_data.get('message', [])
+    async def _extract_input_async(self, msg_data, user_id, context_list):
+        '''
+        从一条消息中提取引用消息、图片和at，组合成给AI的输入
+        返回 (用户输入, 图片描述)
+        '''
+        # 提取引用消息、图片和at
+        image_desc = ""
+        reply_info = ""
+        at_info = ""
+        text_parts = []
+        image_tasks = []
+        message_chain = msg_data.get('message', [])
+
+        if isinstance(message_chain, list):
+            for seg in message_chain:
+                seg_type = seg.get('type')
+                seg_data = seg.get('data', {})
+
+                # 处理文本
+                if seg_type == 'text':
+                    text = seg_data.get('text', '').strip()
+                    if text:
+                        text_parts.append(text)
+
+                # 处理引用消息（新格式：包含发送者昵称和用户标记）
+                elif seg_type == 'reply':
+                    reply_id = seg_data.get('id')
+                    if reply_id:
+                        # 统一转换为字符串类型
+                        reply_id = str(reply_id)
+                        # 获取引用消息的完整内容（包含发送者和用户标记）
+                        with metrics.STAGE_SECONDS.time(stage='quoted'):
+                            reply_content = await self.get_quoted_message_async(reply_id, user_id)
+
+                        # 构建引用信息
+                        if reply_content and reply_content != "获取引用消息失败":
+                            reply_info = f'[回复:"{reply_content}"]\n'
+
+                # 处理当前消息中的图片（支持多张图片，并发处理）
+                elif seg_type == 'image':
+                    if seg_data.get('url', ''):
+                        # 组合当前用户输入（用于生成动态prompt）
+                        current_input = ' '.join(text_parts)
+                        image_tasks.append(asyncio.create_task(
+                            self._describe_image_async(seg_data, user_id, current_input, context_list)
+                        ))
 
-                # 加载用户上下文（用于图片处理）
-                context_list = data.load_data(user_id)['context']
+                # 处理at消息
+                elif seg_type == 'at':
+                    qq = seg_data.get('qq', '')
+                    if qq == 'all':
+                        # 处理@全体成员
+                        at_info += '[at:全体成员] '
+                    elif qq:
+                        # 获取被at用户的昵称
+                        nickname = await self.get_user_nickname_async(qq)
+                        if nickname:
+                            at_info += f'[at:{nickname}] '
+                        # 如果获取失败，直接删除（不添加任何内容）
+
+        # 按图片在消息中的顺序组合描述
+        for img_desc in await asyncio.gather(*image_tasks):
+            if img_desc:
+                image_desc += f"[图片:\"{img_desc}\"]"
+
+        # 组合文本内容
+        text_content = ' '.join(text_parts)
+
+        # 移除 #nino 前缀
+        if text_content.startswith('#nino'):
+            text_content = text_content[5:].strip()
+
+        # 组合最终内容：引用 + at + 消息内容
+        final_content = reply_info + at_info + text_content
+        return final_content, image_desc
+
+    async def _handle_conversation_async(self, messages, user_id):
+        '''
+        处理对话消息（在客户端的事件循环中执行）
+        messages 为同一用户连续发送的一条或多条消息，合并为一轮对话，回复发送到最后一条消息所在的会话
+        '''
+        msg_data = messages[-1]
+        try:
+            # 加载用户上下文（用于图片处理）
+            with metrics.STAGE_SECONDS.time(stage='data_load'):
+                context_list = (await asyncio.to_thread(data.load_data, user_id))['context']
+
+            contents = []
+            image_desc = ""
+            for message in messages:
+                content, desc = await self._extract_input_async(message, user_id, context_list)
+                if content:
+                    contents.append(content)
+                image_desc += desc
+            final_content = '\n'.join(contents)
+            if len(messages) > 1:
+                print(f'[合并消息] 用户 {user_id} 的 {len(messages)} 条连续消息合并为一轮对话')
+
+            # 调用AI
+            try:
+                model = self.config.get('model', 'deepseek-chat')
+                result = await core.send_async(
+                    user_input=final_content,
+                    model=model,
+                    memory=True,
+                    double_output=True,
+                    user_id=user_id,
+                    image_desc=image_desc,  # 图片描述单独传递
+                    on_first_bubble=lambda text: self.send_reply(msg_data, text)  # 流式回复时提前发送第一个气泡
+                )
+
+                # 发送主回复（流式回复时可能已经提前发送）
+                if result.get('output') and not result.get('output_sent'):
+                    self.send_reply(msg_data, result['output'])
+
+                # 发送第二个气泡
+                if result.get('double_output'):
+                    await asyncio.sleep(0.5)  # 短暂延迟
+                    self.send_reply(msg_data, result['double_output'])
 
-                if isinstance(message_chain, list):
-                    for seg in message_chain:
-                        seg_type = seg.get('type')
-                        seg_data = seg.get('data', {})
-
-                        # 处理文本
-                        if seg_type == 'text':
-                            text = seg_data.get('text', '').strip()
-                            if text:
-                                text_parts.append(text)
-
-                        # 处理引用消息（新格式：包含发送者昵称和用户标记）
-                        elif seg_type == 'reply':
-                            reply_id = seg_data.get('id')
-                            if reply_id:
-                                # 统一转换为字符串类型
-                                reply_id = str(reply_id)
-                                # 获取引用消息的完整内容（包含发送者和用户标记）
-                                reply_content = self.get_quoted_message(reply_id, user_id)
-
-                                # 构建引用信息
-                                if reply_content and reply_content != "获取引用消息失败":
-                                    reply_info = f'[回复:"{reply_content}"]\n'
-
-                        # 处理当前消息中的图片（支持多张图片）
-                        elif seg_type == 'image':
-                            img_url = seg_data.get('url', '')
-                            if img_url:
-                                # 组合当前用户输入（用于生成动态prompt）
-                                current_input = ' '.join(text_parts)
-                                img_desc = core.process_image(img_url, user_id, current_input, context_list)
-                                if img_desc:
-                                    image_desc += f"[图片:\"{img_desc}\"]"
-
-                        # 处理at消息
-                        elif seg_type == 'at':
-                            qq = seg_data.get('qq', '')
-                            if qq == 'all':
-                                # 处理@全体成员
-                                at_info += '[at:全体成员] '
-                            elif qq:
-                                # 获取被at用户的昵称
-                                nickname = self.get_user_nickname(qq)
-                                if nickname:
-                                    at_info += f'[at:{nickname}] '
-                                # 如果获取失败，直接删除（不添加任何内容）
-
-                # 组合文本内容
-                text_content = ' '.join(text_parts)
-
-                # 移除 #nino 前缀
-                if text_content.startswith('#nino'):
-                    text_content = text_content[5:].strip()
-
-                # 组合最终内容：引用 + at + 消息内容
-                final_content = reply_info + at_info + text_content
-
-                # 调用AI
-                try:
-                    model = self.config.get('model', 'deepseek-chat')
-                    result = core.send(
-                        user_input=final_content,
-                        model=model,
-                        memory=True,
-                        double_output=True,
-                        user_id=user_id,
-                        image_desc=image_desc  # 图片描述单独传递
-                    )
-
-                    # 发送主回复
-                    if result.get('output'):
-                        self.send_reply(msg_data, result['output'])
-
-                    # 发送第二个气泡
-                    if result.get('double_output'):
-                        time.sleep(0.5)  # 短暂延迟
-                        self.send_reply(msg_data, result['double_output'])
-
-                except Exception as e:
-                    self.send_reply(msg_data, f'[自动回复] 咱现在不在哦w...')
-                    print(f'[错误] AI 调用失败: {e}')
+            except Exception as e:
+                self.send_reply(msg_data, f'[自动回复] 咱现在不在哦w...')
+                print(f'[错误] AI 调用失败: {e}')
 
         except Exception as e:
             print(f'[错误] 处理对话失败: {e}')
 
     def is_owner(self, user_id: str) -> bool:
         '''检查用户是否为主人'''
-        owner_ids = self.config.get('owner_ids', [])
-        return user_id in owner_ids
+        return str(user_id) in self.config.owner_set
 
     def get_system_status(self):
         '''获取系统状态信息'''
@@ -340,6 +495,22 @@ class OneBotClient:
             # API状态
             api_status = core.get_api_status()
 
+            # 各聊天端点的健康状态
+            state_names = {'closed': '正常', 'open': '熔断中', 'half_open': '探测中'}
+            endpoint_lines = ''.join(
+                f'\n端点 {item["endpoint"]}：{state_names.get(item["state"], item["state"])}'
+                + (f'，平均延迟{item["avg_latency"]:.2f}秒' if item['avg_latency'] is not None else '')
+                + f'，失败{item["failures"]}/{item["calls"]}次'
+                for item in api_status.get('endpoints', [])
+            )
+
+            # 各视觉模式的耗时
+            vision_latency = core.get_vision_latency()
+            vision_lines = ''.join(
+                f'\n视觉耗时（{mode}）：平均{stats["avg"]:.2f}秒，P95 {stats["p95"]:.2f}秒（{stats["count"]}次）'
+                for mode, stats in vision_latency.items()
+            )
+
             status_msg = f'''-----系统状态-----
 CPU占用：{cpu_percent:.1f}%
 内存占用：{mem_used_gb:.1f}GB/{mem_total_gb:.1f}GB
@@ -348,7 +519,7 @@ CPU占用：{cpu_percent:.1f}%
 运行时间：{hours}小时{minutes}分钟{seconds}秒
 处理消息：{self.message_count}条
 聊天api：{api_status['chat_api']}
-视觉api：{api_status['visual_api']}'''
+视觉api：{api_status['visual_api']}''' + endpoint_lines + vision_lines
 
             return status_msg
 
@@ -357,51 +528,44 @@ CPU占用：{cpu_percent:.1f}%
             return '获取系统状态失败，请检查日志'
 
     def _handle_api_response(self, echo, response_data):
-        '''处理 API 响应，唤醒等待的线程'''
+        '''处理 API 响应，唤醒等待的协程'''
         with self.api_call_lock:
-            if echo in self.pending_api_calls:
-                call_info = self.pending_api_calls[echo]
-                call_info['result'] = response_data
-                call_info['event'].set()  # 唤醒等待的线程
-
-    def _call_api_sync(self, action, params, timeout=5):
-        '''同步调用 OneBot API，返回响应结果（默认5秒超时）'''
+            call_info = self.pending_api_calls.pop(echo, None)
+        if call_info is not None:
+            # 由 WebSocket 线程把结果交给事件循环
+            future = call_info['future']
+            self.loop.call_soon_threadsafe(
+                lambda: future.done() or future.set_result(response_data)
+            )
+
+    async def _call_api_async(self, action, params, timeout=5):
+        '''异步调用 OneBot API，等待响应时不占用线程（默认5秒超时）'''
+        echo = None
         try:
             # 生成唯一的 echo 标识
-            echo = f'{action}_{int(time.time() * 1000)}_{id(threading.current_thread())}'
+            echo = f'{action}_{int(time.time() * 1000)}_{id(asyncio.current_task())}'
 
-            # 创建等待事件
-            event = threading.Event()
+            future = self.loop.create_future()
             with self.api_call_lock:
-                self.pending_api_calls[echo] = {
-                    'event': event,
-                    'result': None
-                }
+                self.pending_api_calls[echo] = {'future': future}
 
-            # 发送 API 请求
-            api_call = {
+            self.ws.send(json.dumps({
                 'action': action,
                 'params': params,
                 'echo': echo
-            }
+            }))
 
-            self.ws.send(json.dumps(api_call))
-
-            # 等待响应（带超时）
-            if event.wait(timeout):
-                with self.api_call_lock:
-                    call_info = self.pending_api_calls.pop(echo, None)
-                    if call_info:
-                        return call_info['result']
-            else:
-                # 超时，清理
-                with self.api_call_lock:
-                    self.pending_api_calls.pop(echo, None)
-                return None
+            return await asyncio.wait_for(future, timeout)
 
+        except asyncio.TimeoutError:
+            return None
         except Exception as e:
             print(f'[错误] API 调用失败 {action}: {e}')
             return None
+        finally:
+            if echo is not None:
+                with self.api_call_lock:
+                    self.pending_api_calls.pop(echo, None)
 
     def send_reply(self, original_msg, reply_text):
         '''发送回复消息'''
@@ -426,13 +590,16 @@ CPU占用：{cpu_percent:.1f}%
                 'params': params
             }
 
-            self.ws.send(json.dumps(api_call))
+            with metrics.STAGE_SECONDS.time(stage='reply_send'):
+                self.ws.send(json.dumps(api_call))
+            metrics.REPLIES.inc(result='ok')
 
             # 记录发送的回复
             preview = reply_text[:30] + '...' if len(reply_text) > 30 else reply_text
             print(f'[发送回复] 给用户 {user_id}: {preview}')
 
         except Exception as e:
+            metrics.REPLIES.inc(result='error')
             print(f'[错误] 发送回复失败: {e}')
 
     def send_private_message(self, user_id, message_text):
@@ -451,7 +618,26 @@ CPU占用：{cpu_percent:.1f}%
         except Exception as e:
             print(f'[错误] 发送私聊消息失败: {e}')
 
-    def _process_message_chain(self, message_chain, current_user_id):
+    async def _describe_image_async(self, seg_data, user_id, user_input="", context_list=None):
+        '''获取一张图片的描述，所有对话共享并发上限 onebot_max_concurrent_images'''
+        if self.vision_slots is None:
+            self.vision_slots = asyncio.Semaphore(max(1, int(self.max_concurrent_images)))
+        async with self.vision_slots:
+            return await core.process_image_async(
+                seg_data.get('url', ''), user_id, user_input, context_list,
+                cache_key=self._image_cache_key(seg_data)
+            )
+
+    @staticmethod
+    def _image_cache_key(seg_data):
+        '''
+        图片内容标识（用于图片描述缓存）
+        OneBot 图片段的 file 字段由图片内容的哈希生成，同一张图片/表情包重复发送时相同；URL 带有时效参数，不适合作为标识
+        '''
+        key = seg_data.get('file_unique') or seg_data.get('file') or ''
+        return str(key) if key and not str(key).startswith(('http://', 'https://', 'file://', 'base64://')) else None
+
+    async def _process_message_chain_async(self, message_chain, current_user_id):
         '''
         递归处理消息链，支持文本、图片、引用、合并转发、at等
         返回格式化后的消息内容字符串
@@ -468,14 +654,11 @@ CPU占用：{cpu_percent:.1f}%
                     result_parts.append(text)
 
             elif seg_type == 'image':
-                # 处理图片（引用消息中的图片使用默认prompt）
-                img_url = seg_data.get('url', '')
-                if img_url:
-                    img_desc = core.process_image(img_url, current_user_id, "", None)
-                    if img_desc:
-                        result_parts.append(f'[图片:"{img_desc}"]')
-                    else:
-                        result_parts.append('[图片]')
+                # 处理图片（引用消息中的图片使用默认prompt，并发处理，先占位）
+                if seg_data.get('url', ''):
+                    result_parts.append(asyncio.create_task(
+                        self._describe_image_async(seg_data, current_user_id)
+                    ))
 
             elif seg_type == 'at':
                 # 处理at消息
@@ -485,7 +668,7 @@ CPU占用：{cpu_percent:.1f}%
                     result_parts.append('[at:全体成员]')
                 elif qq:
                     # 获取被at用户的昵称
-                    nickname = self.get_user_nickname(qq)
+                    nickname = await self.get_user_nickname_async(qq)
                     if nickname:
                         result_parts.append(f'[at:{nickname}]')
                     # 如果获取失败，直接删除（不添加任何内容）
@@ -494,7 +677,7 @@ CPU占用：{cpu_percent:.1f}%
                 # 处理引用消息（递归）
                 reply_id = seg_data.get('id')
                 if reply_id:
-                    reply_content = self.get_quoted_message(str(reply_id), current_user_id)
+                    reply_content = await self.get_quoted_message_async(str(reply_id), current_user_id)
                     if reply_content and reply_content != "获取引用消息失败":
                         result_parts.append(f'[引用:"{reply_content}"]')
 
@@ -502,24 +685,30 @@ CPU占用：{cpu_percent:.1f}%
                 # 处理合并转发消息
                 forward_id = seg_data.get('id')
                 if forward_id:
-                    forward_content = self.get_forward_message(str(forward_id), current_user_id)
+                    forward_content = await self.get_forward_message_async(str(forward_id), current_user_id)
                     if forward_content and forward_content != "获取合并转发消息失败":
                         result_parts.append(f'[合并转发:"{forward_content}"]')
 
+        # 用图片描述替换占位，保持原有顺序
+        for index, part in enumerate(result_parts):
+            if isinstance(part, asyncio.Task):
+                img_desc = await part
+                result_parts[index] = f'[图片:"{img_desc}"]' if img_desc else '[图片]'
+
         return ' '.join(result_parts)
 
-    def get_quoted_message(self, message_id, current_user_id):
+    async def get_quoted_message_async(self, message_id, current_user_id):
         '''
         通过 get_msg API 获取引用消息的完整内容
         返回格式：发送者昵称（是否当前用户）: 消息内容
         '''
         try:
             # 调用 get_msg API（使用7秒超时）
-            response = self._call_api_sync('get_msg', {'message_id': int(message_id)}, timeout=7)
+            response = await self._call_api_async('get_msg', {'message_id': int(message_id)}, timeout=7)
 
             if not response or response.get('status') != 'ok':
                 # 如果 get_msg 失败，尝试使用 get_forward_msg
-                return self.get_forward_message(message_id, current_user_id)
+                return await self.get_forward_message_async(message_id, current_user_id)
 
             # 提取消息数据
             msg_data = response.get('data', {})
@@ -538,7 +727,7 @@ CPU占用：{cpu_percent:.1f}%
                 return "获取引用消息失败"
 
             # 递归处理消息链
-            content = self._process_message_chain(message_chain, current_user_id)
+            content = await self._process_message_chain_async(message_chain, current_user_id)
 
             if not content:
                 content = "[空消息]"
@@ -553,14 +742,14 @@ CPU占用：{cpu_percent:.1f}%
             print(f'[错误] 获取引用消息失败: {e}')
             return "获取引用消息失败"
 
-    def get_user_nickname(self, user_id):
+    async def get_user_nickname_async(self, user_id):
         '''
         通过 get_stranger_info API 获取用户的QQ昵称
         返回昵称字符串，失败返回 None
         '''
         try:
             # 调用 get_stranger_info API（使用5秒超时）
-            response = self._call_api_sync('get_stranger_info', {'user_id': int(user_id)}, timeout=5)
+            response = await self._call_api_async('get_stranger_info', {'user_id': int(user_id)}, timeout=5)
 
             if not response or response.get('status') != 'ok':
                 return None
@@ -575,14 +764,15 @@ CPU占用：{cpu_percent:.1f}%
             print(f'[错误] 获取用户昵称失败 (user_id={user_id}): {e}')
             return None
 
-    def get_forward_message(self, forward_id, current_user_id):
+    async def get_forward_message_async(self, forward_id, current_user_id):
         '''
         通过 get_forward_msg API 获取合并转发消息的完整内容
         返回格式：每条消息按 "发送者: 内容" 格式组合
         '''
+        started = time.monotonic()
         try:
             # 调用 get_forward_msg API（使用7秒超时）
-            response = self._call_api_sync('get_forward_msg', {'message_id': str(forward_id)}, timeout=7)
+            response = await self._call_api_async('get_forward_msg', {'message_id': str(forward_id)}, timeout=7)
 
             if not response or response.get('status') != 'ok':
                 return "获取合并转发消息失败"
@@ -593,9 +783,8 @@ CPU占用：{cpu_percent:.1f}%
             if not isinstance(messages_data, list) or not messages_data:
                 return "获取合并转发消息失败"
 
-            # 处理每条转发的消息
-            forward_parts = []
-            for msg in messages_data:
+            # 处理每条转发的消息（各条消息并发处理，结果保持原有顺序）
+            async def _format_forwarded(msg):
                 sender_info = msg.get('sender', {})
                 sender_id = str(msg.get('user_id', ''))
                 sender_nickname = sender_info.get('card') or sender_info.get('nickname', '未知用户')
@@ -607,9 +796,15 @@ CPU占用：{cpu_percent:.1f}%
                 # 递归处理消息链
                 message_chain = msg.get('message', [])
                 if isinstance(message_chain, list):
-                    content = self._process_message_chain(message_chain, current_user_id)
+                    content = await self._process_message_chain_async(message_chain, current_user_id)
                     if content:
-                        forward_parts.append(f"{sender_nickname}（{user_tag}）: {content}")
+                        return f"{sender_nickname}（{user_tag}）: {content}"
+                return None
+
+            forward_parts = [
+                part for part in await asyncio.gather(*(_format_forwarded(msg) for msg in messages_data))
+                if part
+            ]
 
             if not forward_parts:
                 return "获取合并转发消息失败"
@@ -626,6 +821,8 @@ CPU占用：{cpu_percent:.1f}%
         except Exception as e:
             print(f'[错误] 获取合并转发消息失败: {e}')
             return "获取合并转发消息失败"
+        finally:
+            metrics.STAGE_SECONDS.observe(time.monotonic() - started, stage='forward')
 
     def on_error(self, ws, error):
         '''处理错误'''
@@ -730,10 +927,12 @@ CPU占用：{cpu_percent:.1f}%
 
     def disconnect(self):
         '''断开连接'''
+        settings.remove_listener(self._on_config_reload)
         self.should_reconnect = False  # 停止重连尝试
         if self.ws:
             self.ws.close()
             self.running = False
+        self.loop.call_soon_threadsafe(self.loop.stop)
 
 
 # 全局实例
@@ -749,6 +948,7 @@ def start_onebot_client():
         if _client is not None:
             return
 
+        settings.start_watcher()
         _client = OneBotClient()
         _client.connect()
         print('OneBot client started')
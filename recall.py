@@ -0,0 +1,446 @@
+import math
+import re
+import threading
+import time
+
+from settings import Config
+
+
+DEFAULT_MAX_ITEMS = 100
+DEFAULT_EVICTION = 'oldest'
+DEFAULT_SIMILARITY_THRESHOLD = 0.75
+DEFAULT_RETRIEVAL_TOP_K = 20
+
+# 重要性评分用的关键词：命中的记忆更不容易被淘汰
+IMPORTANT_KEYWORDS = (
+    '名字', '叫', '生日', '年龄', '岁', '住', '学校', '工作', '职业', '专业',
+    '喜欢', '讨厌', '不喜欢', '害怕', '过敏', '约定', '答应', '身份', '称呼', '目标',
+)
+
+_PUNCTUATION = re.compile(r'[\s!-/:-@\[-`{-~\u3000-\u303f\uff01-\uff0f\uff1a-\uff20\uff3b-\uff40\uff5b-\uff65]+')
+
+
+def _positive_int(value, default: int) -> int:
+    try:
+        parsed = int(value)
+    except (TypeError, ValueError):
+        return default
+    return parsed if parsed > 0 else default
+
+
+def normalize_memory_config(config: dict) -> dict:
+    '''
+    规范化配置中的`memory`段。
+
+    :param config: 配置快照或配置字典
+    '''
+    if isinstance(config, Config):
+        return config.memo('memory', lambda: _normalize_memory_config(config))
+    return _normalize_memory_config(config)
+
+
+def _normalize_memory_config(config: dict) -> dict:
+    memory = config.get('memory')
+    if not isinstance(memory, dict):
+        memory = {}
+    eviction = str(memory.get('eviction', DEFAULT_EVICTION)).strip().lower()
+    if eviction not in EVICTION_POLICIES:
+        print(f'[长期记忆] 未知的淘汰策略 {eviction}，使用 {DEFAULT_EVICTION}')
+        eviction = DEFAULT_EVICTION
+    try:
+        threshold = float(memory.get('similarity_threshold', DEFAULT_SIMILARITY_THRESHOLD))
+    except (TypeError, ValueError):
+        threshold = DEFAULT_SIMILARITY_THRESHOLD
+    try:
+        top_k = max(0, int(memory.get('retrieval_top_k', DEFAULT_RETRIEVAL_TOP_K)))
+    except (TypeError, ValueError):
+        top_k = DEFAULT_RETRIEVAL_TOP_K
+    return {
+        'max_items': _positive_int(memory.get('max_items'), DEFAULT_MAX_ITEMS),
+        'retrieval_top_k': top_k,
+        'eviction': eviction,
+        'similarity_threshold': min(1.0, max(0.0, threshold)),
+    }
+
+
+def normalize_text(text: str) -> str:
+    '''去掉空白和标点，用于判断两条记忆是否重复。'''
+    return _PUNCTUATION.sub('', text or '').lower()
+
+
+def _bigrams(text: str) -> set:
+    text = normalize_text(text)
+    if len(text) < 2:
+        return {text} if text else set()
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def similarity(a: str, b: str) -> float:
+    '''两条记忆的字符二元组Jaccard相似度（适用于中文）。'''
+    grams_a = _bigrams(a)
+    grams_b = _bigrams(b)
+    if not grams_a or not grams_b:
+        return 0.0
+    return len(grams_a & grams_b) / len(grams_a | grams_b)
+
+
+# 检索统计：{用户键: {记忆内容: [最近一次被检索的时间, 被检索次数]}}
+# 只保存在内存中，重启后按插入顺序处理
+_retrieval_stats = {}
+_retrieval_lock = threading.Lock()
+
+
+def _user_key(user_id: str | None) -> str:
+    return '' if user_id is None else str(user_id)
+
+
+def mark_retrieved(user_id: str | None, items: list[str]) -> None:
+    '''
+    记录这些记忆被放入了提示词（用于最近最少检索淘汰策略）。
+
+    :param user_id: 用户ID
+    :param items: 被检索到的记忆
+    '''
+    now = time.time()
+    with _retrieval_lock:
+        stats = _retrieval_stats.setdefault(_user_key(user_id), {})
+        for item in items:
+            entry = stats.setdefault(item, [0.0, 0])
+            entry[0] = now
+            entry[1] += 1
+
+
+def _stats_for(user_id: str | None) -> dict:
+    with _retrieval_lock:
+        return {key: tuple(value) for key, value in _retrieval_stats.get(_user_key(user_id), {}).items()}
+
+
+def forget_stats(user_id: str | None, items: list[str]) -> None:
+    '''删除已淘汰记忆的检索统计。'''
+    with _retrieval_lock:
+        stats = _retrieval_stats.get(_user_key(user_id))
+        if stats:
+            for item in items:
+                stats.pop(item, None)
+
+
+class EvictionPolicy:
+    '''
+    长期记忆淘汰策略。
+
+    子类实现`rank()`，返回按“最应该被淘汰”排序的下标列表。
+    '''
+
+    name = 'base'
+
+    def rank(self, items: list[str], stats: dict) -> list[int]:
+        raise NotImplementedError
+
+    def select(self, items: list[str], count: int, stats: dict) -> set[int]:
+        '''选出需要淘汰的`count`条记忆的下标。'''
+        if count <= 0:
+            return set()
+        return set(self.rank(items, stats)[:count])
+
+
+class OldestFirstPolicy(EvictionPolicy):
+    '''最早添加的记忆最先淘汰。'''
+
+    name = 'oldest'
+
+    def rank(self, items, stats):
+        return list(range(len(items)))
+
+
+class LeastRecentlyRetrievedPolicy(EvictionPolicy):
+    '''最久没有被检索到的记忆最先淘汰（从未被检索的按添加顺序）。'''
+
+    name = 'lru'
+
+    def rank(self, items, stats):
+        return sorted(range(len(items)), key=lambda i: (stats.get(items[i], (0.0, 0))[0], i))
+
+
+class ImportanceScoredPolicy(EvictionPolicy):
+    '''按重要性评分淘汰：关键词、检索次数和新旧程度越低越先淘汰。'''
+
+    name = 'importance'
+
+    @staticmethod
+    def score(item: str, index: int, total: int, stats: dict) -> float:
+        keyword_score = sum(1 for keyword in IMPORTANT_KEYWORDS if keyword in item)
+        hits = stats.get(item, (0.0, 0))[1]
+        recency = index / max(1, total - 1)
+        return keyword_score * 2 + min(hits, 10) * 0.5 + recency
+
+    def rank(self, items, stats):
+        total = len(items)
+        return sorted(range(total), key=lambda i: (self.score(items[i], i, total, stats), i))
+
+
+EVICTION_POLICIES = {
+    OldestFirstPolicy.name: OldestFirstPolicy(),
+    LeastRecentlyRetrievedPolicy.name: LeastRecentlyRetrievedPolicy(),
+    ImportanceScoredPolicy.name: ImportanceScoredPolicy(),
+}
+
+
+def register_eviction_policy(policy: EvictionPolicy) -> None:
+    '''
+    注册自定义淘汰策略，之后可以在配置`memory.eviction`中使用它的名称。
+
+    :param policy: 淘汰策略实例
+    '''
+    EVICTION_POLICIES[policy.name] = policy
+
+
+def compact(items: list[str], threshold: float = DEFAULT_SIMILARITY_THRESHOLD) -> list[str]:
+    '''
+    压缩记忆列表：合并重复和被更正过的记忆，保留较新的一条。
+
+    :param items: 记忆列表（从旧到新）
+    :param threshold: 相似度阈值，达到阈值的两条记忆视为同一件事
+    '''
+    kept = []
+    for item in reversed(items):
+        normalized = normalize_text(item)
+        if not normalized:
+            continue
+        if any(normalize_text(newer) == normalized or similarity(item, newer) >= threshold for newer in kept):
+            continue
+        kept.append(item)
+    kept.reverse()
+    return kept
+
+
+def admit(items: list[str], new_item: str, user_id: str | None, memory_config: dict) -> list[str]:
+    '''
+    添加一条新记忆并应用容量限制，返回新的记忆列表。
+
+    与新记忆重复或被它更正的旧记忆会被移除；超出容量时按淘汰策略删除。
+
+    :param items: 当前记忆列表（从旧到新）
+    :param new_item: 新记忆
+    :param user_id: 用户ID
+    :param memory_config: `normalize_memory_config()`的结果
+    '''
+    threshold = memory_config['similarity_threshold']
+    normalized = normalize_text(new_item)
+    superseded = [
+        item for item in items
+        if normalize_text(item) == normalized or similarity(item, new_item) >= threshold
+    ]
+    result = [item for item in items if item not in superseded] + [new_item]
+    evicted = list(superseded)
+
+    overflow = len(result) - memory_config['max_items']
+    if overflow > 0:
+        policy = EVICTION_POLICIES[memory_config['eviction']]
+        # 新记忆不参与淘汰
+        candidates = result[:-1]
+        drop = policy.select(candidates, overflow, _stats_for(user_id))
+        evicted.extend(candidates[i] for i in sorted(drop))
+        result = [item for i, item in enumerate(candidates) if i not in drop] + [new_item]
+
+    if evicted:
+        print(f'[长期记忆] 用户 {user_id}: 移除 {len(evicted)} 条被更正/淘汰的记忆')
+        forget_stats(user_id, [item for item in evicted if item != new_item])
+    return result
+
+
+def enforce(items: list[str], user_id: str | None, memory_config: dict) -> list[str]:
+    '''
+    对整个记忆列表执行一次压缩和容量限制（用于清理旧数据）。
+
+    :param items: 当前记忆列表（从旧到新）
+    :param user_id: 用户ID
+    :param memory_config: `normalize_memory_config()`的结果
+    '''
+    result = compact(items, memory_config['similarity_threshold'])
+    overflow = len(result) - memory_config['max_items']
+    if overflow > 0:
+        policy = EVICTION_POLICIES[memory_config['eviction']]
+        drop = policy.select(result, overflow, _stats_for(user_id))
+        result = [item for i, item in enumerate(result) if i not in drop]
+    removed = [item for item in items if item not in result]
+    if removed:
+        forget_stats(user_id, removed)
+    return result
+
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def tokenize(text: str) -> list[str]:
+    '''把文本切分为字符一元组和二元组（不依赖分词器，适用于中文）。'''
+    text = normalize_text(text)
+    return list(text) + [text[i:i + 2] for i in range(len(text) - 1)]
+
+
+class MemoryIndex:
+    '''
+    单个用户长期记忆的BM25倒排索引。
+
+    以记忆内容为文档键，支持增量添加和删除。
+    '''
+
+    def __init__(self, items: list[str] | None = None):
+        self._lock = threading.Lock()
+        self._docs = {}      # {记忆内容: (词频Counter, 文档长度, 出现次数)}
+        self._postings = {}  # {词: set(记忆内容)}
+        self._total_length = 0
+        for item in items or []:
+            self.add(item)
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, item: str) -> None:
+        with self._lock:
+            self._add(item)
+
+    def _add(self, item: str) -> None:
+        doc = self._docs.get(item)
+        if doc is not None:
+            self._docs[item] = (doc[0], doc[1], doc[2] + 1)
+            return
+        terms = tokenize(item)
+        counts = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        self._docs[item] = (counts, len(terms), 1)
+        self._total_length += len(terms)
+        for term in counts:
+            self._postings.setdefault(term, set()).add(item)
+
+    def remove(self, item: str) -> None:
+        with self._lock:
+            self._remove(item)
+
+    def _remove(self, item: str) -> None:
+        doc = self._docs.get(item)
+        if doc is None:
+            return
+        if doc[2] > 1:
+            self._docs[item] = (doc[0], doc[1], doc[2] - 1)
+            return
+        del self._docs[item]
+        self._total_length -= doc[1]
+        for term in doc[0]:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.discard(item)
+                if not postings:
+                    del self._postings[term]
+
+    def sync(self, items: list[str]) -> None:
+        '''与实际的记忆列表对齐（只处理差异部分），用于兜底外部修改。'''
+        wanted = {}
+        for item in items:
+            wanted[item] = wanted.get(item, 0) + 1
+        with self._lock:
+            current = {item: doc[2] for item, doc in self._docs.items()}
+            if current == wanted:
+                return
+            for item, count in current.items():
+                for _ in range(count - wanted.get(item, 0)):
+                    self._remove(item)
+            for item, count in wanted.items():
+                for _ in range(count - current.get(item, 0)):
+                    self._add(item)
+
+    def search(self, query: str, top_k: int) -> list[tuple[str, float]]:
+        '''
+        返回与`query`最相关的`top_k`条记忆及其BM25分数（分数从高到低）。
+
+        :param query: 查询文本
+        :param top_k: 返回条数
+        '''
+        terms = set(tokenize(query))
+        with self._lock:
+            total = len(self._docs)
+            if not total or not terms:
+                return []
+            average_length = self._total_length / total
+            scores = {}
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                df = len(postings)
+                idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+                for item in postings:
+                    counts, length, _ = self._docs[item]
+                    tf = counts[term]
+                    norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+                    scores[item] = scores.get(item, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+        ranked = sorted(scores.items(), key=lambda pair: pair[1], reverse=True)
+        return ranked[:top_k]
+
+
+# 每个用户的记忆索引：{用户键: MemoryIndex}
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(user_id: str | None, items: list[str] | None = None) -> MemoryIndex:
+    '''
+    获取用户的记忆索引，第一次使用时根据`items`构建；传入`items`时会与之对齐。
+
+    :param user_id: 用户ID
+    :param items: 当前记忆列表
+    '''
+    key = _user_key(user_id)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = MemoryIndex(items)
+            _indexes[key] = index
+            return index
+    if items is not None:
+        index.sync(items)
+    return index
+
+
+def index_add(user_id: str | None, item: str) -> None:
+    '''记忆被添加后增量更新索引（索引尚未建立时不做任何事）。'''
+    index = _indexes.get(_user_key(user_id))
+    if index is not None:
+        index.add(item)
+
+
+def index_remove(user_id: str | None, item: str) -> None:
+    '''记忆被删除后增量更新索引（索引尚未建立时不做任何事）。'''
+    index = _indexes.get(_user_key(user_id))
+    if index is not None:
+        index.remove(item)
+
+
+def index_reset(user_id: str | None, items: list[str]) -> None:
+    '''记忆列表被整体替换后对齐索引。'''
+    index = _indexes.get(_user_key(user_id))
+    if index is not None:
+        index.sync(items)
+
+
+def select_memories(user_id: str | None, items: list[str], query: str, top_k: int) -> list[str]:
+    '''
+    选出与当前对话最相关的`top_k`条记忆（保持原有顺序）。
+
+    记忆不超过`top_k`条时全部返回；相关记忆不足时用最新的记忆补足。
+
+    :param user_id: 用户ID
+    :param items: 全部记忆（从旧到新）
+    :param query: 检索文本（当前输入和最近的上下文）
+    :param top_k: 最多返回条数，为0时返回全部
+    '''
+    if top_k <= 0 or len(items) <= top_k:
+        return list(items)
+    index = get_index(user_id, items)
+    chosen = {item for item, _ in index.search(query, top_k)}
+    for item in reversed(items):
+        if len(chosen) >= top_k:
+            break
+        chosen.add(item)
+    return [item for item in items if item in chosen]
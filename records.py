@@ -0,0 +1,146 @@
+import time
+from dataclasses import dataclass
+
+from agent_runtime import escape_user_tool_tags
+
+
+ROLE_USER = 'user'
+ROLE_ASSISTANT = 'assistant'
+
+# 旧版字符串格式中表示"没有"的占位文本
+LEGACY_NO_DOUBLE = '这条回复没有使用分割回复'
+LEGACY_NO_MEMORY = '这条回复没有添加长期记忆'
+LEGACY_ROLES = {'用户': ROLE_USER, '你': ROLE_ASSISTANT}
+
+
+@dataclass
+class ContextRecord:
+    '''
+    一条上下文记录。
+
+    保存时序列化为短键名的字典（见`to_stored()`），空字段省略：
+    `{"t": 时间戳, "r": "u"/"a", "x": 内容, "d": 分割回复, "m": 长期记忆, "e": 转义后的提示词内容}`。
+    `e`只在转义结果与原文不同时保存；写入时计算一次，之后构建提示词时不再重复转义。
+    '''
+
+    epoch: int
+    role: str
+    text: str
+    double: str = ''
+    memory: str = ''
+    escaped: str | None = None
+
+    @classmethod
+    def create(cls, role: str, text: str, double: str = '', memory: str = '') -> 'ContextRecord':
+        '''以当前时间创建一条记录，同时缓存转义后的提示词内容'''
+        record = cls(int(time.time()), role, text or '', double or '', memory or '')
+        record.escaped = escape_user_tool_tags(record.raw_content)
+        return record
+
+    @classmethod
+    def from_stored(cls, item) -> 'ContextRecord':
+        '''从存储中的数据恢复记录，兼容旧版`//`分隔的字符串'''
+        if isinstance(item, str):
+            return parse_legacy(item)
+        role = ROLE_ASSISTANT if item.get('r') == 'a' else ROLE_USER
+        record = cls(item.get('t', 0), role, item.get('x', ''), item.get('d', ''), item.get('m', ''), item.get('e'))
+        if record.escaped is None:
+            # 没有保存`e`说明写入时转义结果与原文相同
+            record.escaped = record.raw_content
+        return record
+
+    def to_stored(self) -> dict:
+        stored = {'t': self.epoch, 'r': 'a' if self.role == ROLE_ASSISTANT else 'u', 'x': self.text}
+        if self.double:
+            stored['d'] = self.double
+        if self.memory:
+            stored['m'] = self.memory
+        escaped = self.escaped_content
+        if escaped != self.raw_content:
+            stored['e'] = escaped
+        return stored
+
+    @property
+    def raw_content(self) -> str:
+        '''提示词中的内容（未转义）：AI回复还原为模型输出的格式'''
+        if self.role != ROLE_ASSISTANT:
+            return self.text
+        content = self.text
+        if self.double:
+            content += '[分割回复]' + self.double
+        if self.memory:
+            content += '[添加长期记忆]' + self.memory
+        return content
+
+    @property
+    def escaped_content(self) -> str:
+        if self.escaped is None:
+            self.escaped = escape_user_tool_tags(self.raw_content)
+        return self.escaped
+
+    @property
+    def ctime(self) -> str:
+        return time.ctime(self.epoch)
+
+    @property
+    def speaker(self) -> str:
+        return '你' if self.role == ROLE_ASSISTANT else '用户'
+
+    def to_message(self) -> dict:
+        '''转换为对话消息，用户消息前标注发送时间'''
+        if self.role == ROLE_ASSISTANT:
+            return {"role": "assistant", "content": self.escaped_content}
+        if not self.epoch:
+            return {"role": "user", "content": self.escaped_content}
+        return {"role": "user", "content": f"[{self.ctime}] {self.escaped_content}"}
+
+    def __str__(self) -> str:
+        # 用于按token预算计数
+        return self.escaped_content
+
+
+def _parse_ctime(value: str) -> int:
+    try:
+        return int(time.mktime(time.strptime(value)))
+    except (ValueError, OverflowError):
+        return 0
+
+
+def parse_legacy(entry: str) -> ContextRecord:
+    '''
+    转换旧版上下文字符串。
+
+    用户消息格式为`时间//日期//用户//内容`，AI回复格式为`时间//日期//你//回复//分割回复//长期记忆`；
+    无法识别的字符串作为没有时间的用户消息保留。
+    '''
+    parts = entry.split('//')
+    role = LEGACY_ROLES.get(parts[2]) if len(parts) >= 4 else None
+    if role is None:
+        return ContextRecord(0, ROLE_USER, entry)
+    if role == ROLE_USER:
+        return ContextRecord(_parse_ctime(parts[0]), role, '//'.join(parts[3:]))
+    double = parts[4] if len(parts) >= 5 and parts[4] != LEGACY_NO_DOUBLE else ''
+    memory = '//'.join(parts[5:]) if len(parts) >= 6 else ''
+    if memory == LEGACY_NO_MEMORY:
+        memory = ''
+    return ContextRecord(_parse_ctime(parts[0]), role, parts[3], double, memory)
+
+
+def load_records(items: list) -> list[ContextRecord]:
+    return [ContextRecord.from_stored(item) for item in items]
+
+
+def convert_items(items: list) -> tuple[list, int]:
+    '''
+    把存储中的旧版字符串转换为结构化记录。
+
+    :return: (转换后的存储数据, 转换的条数)
+    '''
+    converted = 0
+    result = []
+    for item in items:
+        if isinstance(item, str):
+            item = parse_legacy(item).to_stored()
+            converted += 1
+        result.append(item)
+    return result, converted
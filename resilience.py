@@ -0,0 +1,258 @@
+import random
+import threading
+import time
+from collections import deque
+
+from settings import Config
+
+
+DEFAULT_RETRIES = 2
+DEFAULT_TIMEOUT_SECONDS = 60
+DEFAULT_BACKOFF_SECONDS = 0.5
+DEFAULT_MAX_BACKOFF_SECONDS = 8
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_SECONDS = 30
+LATENCY_SAMPLES = 100
+
+DEFAULT_HEDGE_PERCENTILE = 0.95
+DEFAULT_HEDGE_MIN_DELAY_SECONDS = 2
+DEFAULT_HEDGE_MAX_EXTRA_LOAD = 0.1
+# 主端点至少有这么多条延迟记录后才开始对冲
+HEDGE_MIN_SAMPLES = 20
+# 对冲预算最多积攒的次数（允许短时间内的少量突发）
+HEDGE_BURST = 5
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    '''端点的熔断器处于打开状态，调用被直接拒绝。'''
+
+
+def _number(value, default, cast=float, minimum=0):
+    try:
+        parsed = cast(value)
+    except (TypeError, ValueError):
+        return default
+    return parsed if parsed >= minimum else default
+
+
+def normalize_resilience_config(config: dict) -> dict:
+    '''
+    规范化配置中的`llm_resilience`段。
+
+    :param config: 配置快照或配置字典
+    '''
+    if isinstance(config, Config):
+        return config.memo('llm_resilience', lambda: _normalize_resilience_config(config))
+    return _normalize_resilience_config(config)
+
+
+def _normalize_resilience_config(config: dict) -> dict:
+    section = config.get('llm_resilience')
+    if not isinstance(section, dict):
+        section = {}
+    fallbacks = []
+    for item in section.get('fallbacks') or []:
+        if isinstance(item, dict) and item.get('base_url') and item.get('model'):
+            fallbacks.append({
+                'base_url': str(item['base_url']),
+                'model': str(item['model']),
+                # 未单独配置密钥时使用 ai_api_key
+                'api_key': str(item.get('api_key') or config.get('ai_api_key', '')),
+            })
+    hedge = section.get('hedge')
+    if not isinstance(hedge, dict):
+        hedge = {}
+    return {
+        'hedge': {
+            'enabled': bool(hedge.get('enabled', False)),
+            'percentile': min(0.999, _number(hedge.get('percentile'), DEFAULT_HEDGE_PERCENTILE)),
+            'min_delay_seconds': _number(hedge.get('min_delay_seconds'), DEFAULT_HEDGE_MIN_DELAY_SECONDS),
+            'max_extra_load': min(1.0, _number(hedge.get('max_extra_load'), DEFAULT_HEDGE_MAX_EXTRA_LOAD)),
+        },
+        'retries': _number(section.get('retries'), DEFAULT_RETRIES, int),
+        'timeout_seconds': _number(section.get('timeout_seconds'), DEFAULT_TIMEOUT_SECONDS, float, 1),
+        'backoff_seconds': _number(section.get('backoff_seconds'), DEFAULT_BACKOFF_SECONDS),
+        'max_backoff_seconds': _number(section.get('max_backoff_seconds'), DEFAULT_MAX_BACKOFF_SECONDS),
+        'failure_threshold': _number(section.get('failure_threshold'), DEFAULT_FAILURE_THRESHOLD, int, 1),
+        'reset_seconds': _number(section.get('reset_seconds'), DEFAULT_RESET_SECONDS),
+        'fallbacks': fallbacks,
+    }
+
+
+def backoff_delay(attempt: int, resilience: dict) -> float:
+    '''
+    第`attempt`次重试前的等待时间：指数退避加全抖动（0到上限之间均匀随机）。
+
+    :param attempt: 重试序号，从0开始
+    :param resilience: `normalize_resilience_config()`的结果
+    '''
+    ceiling = min(resilience['max_backoff_seconds'], resilience['backoff_seconds'] * (2 ** attempt))
+    return random.uniform(0, ceiling)
+
+
+class CircuitBreaker:
+    '''
+    单个端点的熔断器，同时记录健康状态和延迟。
+
+    连续失败达到阈值后打开，打开期间调用直接失败；经过`reset_seconds`后进入半开状态，
+    只放行一个探测请求，成功则关闭，失败则重新打开。
+    '''
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0  # 连续失败次数
+        self.opened_at = 0.0
+        self.probing = False
+        self.total_calls = 0
+        self.total_failures = 0
+        self.last_error = ''
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def allow(self, reset_seconds: float) -> bool:
+        '''当前是否允许发起调用'''
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < reset_seconds:
+                    return False
+                self.state = HALF_OPEN
+                self.probing = False
+            # 半开：只放行一个探测请求
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self, latency: float) -> None:
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.probing = False
+            self.total_calls += 1
+            self.latencies.append(latency)
+
+    def record_failure(self, error: Exception, failure_threshold: int) -> None:
+        with self.lock:
+            self.failures += 1
+            self.total_calls += 1
+            self.total_failures += 1
+            self.last_error = f'{type(error).__name__}: {error}'[:200]
+            if self.state == HALF_OPEN or self.failures >= failure_threshold:
+                if self.state != OPEN:
+                    print(f'[熔断] 端点 {self.name} 连续失败 {self.failures} 次，暂停调用')
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+    def record_rejected(self, error: Exception) -> None:
+        '''记录一次因请求本身有问题（4xx）而失败的调用：端点能正常响应，不计入连续失败'''
+        with self.lock:
+            self.total_calls += 1
+            self.total_failures += 1
+            self.last_error = f'{type(error).__name__}: {error}'[:200]
+            # 半开状态下释放探测名额，下一个请求继续探测
+            self.probing = False
+
+    def release_probe(self) -> None:
+        '''调用没有结果（例如被取消）时释放半开状态的探测名额，不记录成功或失败'''
+        with self.lock:
+            self.probing = False
+
+    def latency_percentile(self, percentile: float, min_samples: int = 1) -> float | None:
+        '''最近成功调用延迟的分位数，样本不足`min_samples`条时返回None'''
+        with self.lock:
+            samples = sorted(self.latencies)
+        if not samples or len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percentile))]
+
+    def snapshot(self) -> dict:
+        '''健康状态快照（用于状态展示）'''
+        with self.lock:
+            samples = list(self.latencies)
+            return {
+                'endpoint': self.name,
+                'state': self.state,
+                'calls': self.total_calls,
+                'failures': self.total_failures,
+                'consecutive_failures': self.failures,
+                'avg_latency': sum(samples) / len(samples) if samples else None,
+                'last_error': self.last_error,
+            }
+
+
+class HedgeBudget:
+    '''
+    对冲请求的额外负载上限（令牌桶）。
+
+    每个可对冲的请求积攒`max_extra_load`个令牌，每次对冲消耗1个，
+    因此对冲请求数不会超过请求总数的`max_extra_load`倍（另有`HEDGE_BURST`的少量突发）。
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.requests = 0
+        self.hedges = 0
+
+    def add_request(self, max_extra_load: float) -> None:
+        with self.lock:
+            self.requests += 1
+            self.tokens = min(HEDGE_BURST, self.tokens + max_extra_load)
+
+    def try_acquire(self) -> bool:
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            self.hedges += 1
+            return True
+
+
+hedge_budget = HedgeBudget()
+
+
+def hedge_delay(breaker: CircuitBreaker, hedge: dict, timeout: float) -> float | None:
+    '''
+    根据主端点的延迟历史计算对冲等待时间，历史不足时返回None（不对冲）。
+
+    :param breaker: 主端点的熔断器
+    :param hedge: `llm_resilience.hedge`配置
+    :param timeout: 单次请求超时
+    '''
+    delay = breaker.latency_percentile(hedge['percentile'], HEDGE_MIN_SAMPLES)
+    if delay is None:
+        return None
+    return min(max(delay, hedge['min_delay_seconds']), timeout)
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def endpoint_name(base_url: str, model: str) -> str:
+    return f'{model}@{base_url}'
+
+
+def get_breaker(base_url: str, model: str) -> CircuitBreaker:
+    '''获取端点（`base_url` + `model`）对应的熔断器'''
+    name = endpoint_name(base_url, model)
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name)
+        return breaker
+
+
+def health() -> list[dict]:
+    '''所有已使用端点的健康状态'''
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return [breaker.snapshot() for breaker in breakers]
@@ -0,0 +1,210 @@
+import copy
+import json
+import os
+import threading
+import time
+from collections.abc import Mapping
+from dotenv import load_dotenv
+
+
+CONFIG_PATH = 'data/config.json'
+ENV_PATH = '.env'
+DEFAULT_RELOAD_INTERVAL_SECONDS = 2
+
+# 加载 .env 文件
+load_dotenv(ENV_PATH)
+
+
+class Config(Mapping):
+    '''
+    不可变的配置快照。
+
+    快照在构建时一次性读取`data/config.json`并合并环境变量，之后只读。
+    配置文件变化时由后台监视线程构建新的快照并整体替换，持有旧快照的调用方不受影响。
+    嵌套的dict/list同样视为只读，请勿修改。
+    '''
+
+    def __init__(self, values: dict, version: int = 0):
+        self._values = values
+        self.version = version
+        self._memo = {}
+        self._memo_lock = threading.Lock()
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return f'Config(version={self.version}, keys={list(self._values)})'
+
+    def memo(self, key: str, factory):
+        '''
+        在当前快照上缓存派生值，同一快照只计算一次。
+
+        :param key: 派生值的名称
+        :param factory: 无参函数，返回派生值
+        '''
+        with self._memo_lock:
+            if key in self._memo:
+                return self._memo[key]
+        value = factory()
+        with self._memo_lock:
+            return self._memo.setdefault(key, value)
+
+    @property
+    def owner_set(self) -> frozenset:
+        '''主人ID集合（统一为字符串），同一快照只构建一次。'''
+        return self.memo('owner_set', lambda: frozenset(
+            str(item) for item in self._values.get('owner_ids', []) or [] if item
+        ))
+
+    def to_dict(self) -> dict:
+        '''返回配置的可修改副本。'''
+        return copy.deepcopy(self._values)
+
+
+_current = None
+_version = 0
+_lock = threading.Lock()
+_listeners = []
+_watcher = None
+
+
+def _build(version: int) -> Config:
+    with open(CONFIG_PATH, encoding='UTF-8') as f:
+        config = json.load(f)
+
+    # 从环境变量读取敏感配置（优先使用环境变量）
+    config['ai_api_key'] = os.getenv('AI_API_KEY', config.get('ai_api_key', ''))
+    config['visual_api_key'] = os.getenv('VISUAL_API_KEY', config.get('visual_api_key', ''))
+    config['onebot_token'] = os.getenv('ONEBOT_TOKEN', config.get('onebot_token', ''))
+    return Config(config, version)
+
+
+def get_config() -> Config:
+    '''获取当前配置快照。'''
+    snapshot = _current
+    if snapshot is not None:
+        return snapshot
+    with _lock:
+        if _current is None:
+            _swap(_build(_version + 1))
+        return _current
+
+
+def _swap(snapshot: Config) -> Config | None:
+    global _current, _version
+    old = _current
+    _current = snapshot
+    _version = snapshot.version
+    return old
+
+
+def reload() -> Config:
+    '''
+    重新读取`.env`和`data/config.json`并替换当前快照。
+
+    读取失败时保留旧快照并抛出异常。
+    '''
+    with _lock:
+        load_dotenv(ENV_PATH, override=True)
+        snapshot = _build(_version + 1)
+        old = _swap(snapshot)
+        listeners = list(_listeners)
+    for listener in listeners:
+        try:
+            listener(old, snapshot)
+        except Exception as e:
+            print(f'[配置] 配置变更回调失败: {e}')
+    return snapshot
+
+
+def add_listener(callback) -> None:
+    '''
+    注册配置变更回调。
+
+    :param callback: 回调函数，签名为`callback(old_config, new_config)`
+    '''
+    with _lock:
+        if callback not in _listeners:
+            _listeners.append(callback)
+
+
+def remove_listener(callback) -> None:
+    '''
+    移除配置变更回调。
+
+    :param callback: 之前注册的回调函数
+    '''
+    with _lock:
+        if callback in _listeners:
+            _listeners.remove(callback)
+
+
+def _file_signature(file_path: str) -> tuple[int, int] | None:
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class _ConfigWatcher:
+    '''轮询配置文件的mtime，变化时热重载配置。'''
+
+    def __init__(self):
+        self.running = False
+        self._signatures = self._scan()
+
+    def _scan(self) -> tuple:
+        return _file_signature(CONFIG_PATH), _file_signature(ENV_PATH)
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def _loop(self):
+        while self.running:
+            interval = get_config().get('config_reload_interval', DEFAULT_RELOAD_INTERVAL_SECONDS)
+            try:
+                interval = max(0.5, float(interval))
+            except (TypeError, ValueError):
+                interval = DEFAULT_RELOAD_INTERVAL_SECONDS
+            time.sleep(interval)
+            signatures = self._scan()
+            if signatures == self._signatures:
+                continue
+            self._signatures = signatures
+            try:
+                snapshot = reload()
+                print(f'[配置] 检测到配置文件变化，已热重载（版本 {snapshot.version}）')
+            except Exception as e:
+                print(f'[配置] 热重载失败，继续使用旧配置: {e}')
+
+
+def start_watcher() -> None:
+    '''启动配置热重载监视线程（重复调用无副作用）。'''
+    global _watcher
+    get_config()
+    with _lock:
+        if _watcher is not None:
+            return
+        _watcher = _ConfigWatcher()
+        _watcher.start()
+
+
+def stop_watcher() -> None:
+    '''停止配置热重载监视线程。'''
+    global _watcher
+    with _lock:
+        if _watcher is not None:
+            _watcher.stop()
+            _watcher = None
@@ -1,6 +1,10 @@
 from flask import *
+import json
 import data
+import hmac
+import metrics
 import onebot
+import settings
 
 
 shell = Flask(__name__)
@@ -9,7 +13,7 @@ shell = Flask(__name__)
 @shell.route('/')
 def index():
     '''首页 - 显示运行状态'''
-    theme_color = data.load_data()['config'].get('theme_color', 'FF9800')
+    theme_color = settings.get_config().get('theme_color', 'FF9800')
     return render_template('index.html', theme_color=theme_color)
 
 
@@ -26,6 +30,17 @@ def status():
         return jsonify({'status': 'error', 'connected': False, 'error': str(e)})
 
 
+@shell.route('/metrics')
+def prometheus_metrics():
+    '''Prometheus 指标（配置了 metrics_token 时需要 Authorization: Bearer <token>）'''
+    expected = settings.get_config().get('metrics_token', '')
+    if expected:
+        provided = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+        if not hmac.compare_digest(provided.encode('UTF-8'), str(expected).encode('UTF-8')):
+            return Response('unauthorized\n', status=401, mimetype='text/plain')
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 def is_auth(user, token):
     '''验证用户认证'''
     if not user or not token:
@@ -43,12 +58,21 @@ def alert(text, redirect):
     '''
 
 
+def json_attachment(content, filename):
+    '''将数据作为JSON文件下载'''
+    return Response(
+        json.dumps(content, ensure_ascii=False, indent=4),
+        mimetype='application/json',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+
 @shell.route('/login')
 def pub_login():
     '''登录页面'''
     user_id = request.args.get('user', '')
     error = request.args.get('error', '')
-    theme_color = data.load_data()['config'].get('theme_color', 'FF9800')
+    theme_color = settings.get_config().get('theme_color', 'FF9800')
     return render_template('login.html', user_id=user_id, error=error, theme_color=theme_color)
 
 
@@ -140,7 +164,7 @@ def view_context():
         return redirect(f'/login?user={user}')
 
     context_list = data.load_data(user)['context']
-    theme_color = data.load_data()['config'].get('theme_color', 'FF9800')
+    theme_color = settings.get_config().get('theme_color', 'FF9800')
 
     return render_template(
         'context.html',
@@ -159,8 +183,7 @@ def export_memory():
     if not is_auth(user, token):
         return alert('请先登录', f'/data?user={user}')
 
-    paths = data._user_paths(user)
-    return send_file(paths['memory'], as_attachment=True)
+    return json_attachment(data.export_data('memory', user), 'memory.json')
 
 
 @shell.route('/export-context')
@@ -172,8 +195,7 @@ def export_context():
     if not is_auth(user, token):
         return alert('请先登录', f'/data?user={user}')
 
-    paths = data._user_paths(user)
-    return send_file(paths['context'], as_attachment=True)
+    return json_attachment(data.export_data('context', user), 'context.json')
 
 
 @shell.route('/import-memory', methods=['POST'])
@@ -187,8 +209,10 @@ def import_memory():
 
     file = request.files['memory_file']
     if file.filename == 'memory.json':
-        paths = data._user_paths(user)
-        file.save(paths['memory'])
+        try:
+            data.import_data('memory', json.load(file.stream), user_id=user)
+        except ValueError:
+            return alert('文件内容格式不正确', f'/data?user={user}')
         return redirect(f'/data?user={user}')
     else:
         return alert('请上传正确的文件', f'/data?user={user}')
@@ -205,14 +229,19 @@ def import_context():
 
     file = request.files['context_file']
     if file.filename == 'context.json':
-        paths = data._user_paths(user)
-        file.save(paths['context'])
+        try:
+            data.import_data('context', json.load(file.stream), user_id=user)
+        except ValueError:
+            return alert('文件内容格式不正确', f'/data?user={user}')
         return redirect(f'/data?user={user}')
     else:
         return alert('请上传正确的文件', f'/data?user={user}')
 
 
 if __name__ == '__main__':
+    # 启动配置热重载
+    settings.start_watcher()
+
     # 启动 OneBot 客户端
     onebot.start_onebot_client()
 
@@ -0,0 +1,797 @@
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+DATA_DIR = 'data'
+DEFAULT_SQLITE_PATH = 'data/nino.db'
+# SQLite连接池的最大连接数，同时访问数据库的线程超过这个数时排队等待
+SQLITE_POOL_SIZE = 4
+# 上下文日志中的记录数超过窗口大小的这个倍数时执行一次压缩
+CONTEXT_COMPACT_FACTOR = 4
+# 分段锁的段数，不同用户大概率落在不同的段上，互不阻塞
+LOCK_STRIPES = 64
+
+
+class StorageBackend:
+    '''
+    存储后端接口。
+
+    上下文、长期记忆、WebUI token和黑名单都通过存储后端读写，
+    `data.py`只负责选择后端并对外提供原有的函数接口。
+    `user_id`为None时表示默认数据。
+    '''
+
+    name = 'base'
+
+    def load_context(self, user_id: str | None, limit: int = 0) -> list:
+        '''
+        读取最近`limit`条上下文（`limit`为0时读取全部）。
+
+        上下文记录是`records.ContextRecord.to_stored()`生成的字典，旧版数据中可能是`//`分隔的字符串。
+        '''
+        raise NotImplementedError
+
+    def load_memory(self, user_id: str | None) -> list:
+        raise NotImplementedError
+
+    def append_context(self, user_id: str | None, item: dict, limit: int) -> list:
+        '''
+        追加一条上下文，超出`limit`条的旧记录可以延迟到压缩时再删除。
+
+        :return: 因这次追加而移出窗口的记录（从旧到新）
+        '''
+        raise NotImplementedError
+
+    def replace_context(self, user_id: str | None, items: list) -> None:
+        raise NotImplementedError
+
+    def append_memory(self, user_id: str | None, item: str) -> None:
+        raise NotImplementedError
+
+    def remove_memory(self, user_id: str | None, item: str) -> None:
+        '''删除一条长期记忆，不存在时抛出`ValueError`（与`list.remove`一致）。'''
+        raise NotImplementedError
+
+    def replace_memory(self, user_id: str | None, items: list) -> None:
+        raise NotImplementedError
+
+    def load_summary(self, user_id: str | None) -> str:
+        '''读取移出窗口的上下文的滚动摘要，没有时返回空字符串。'''
+        raise NotImplementedError
+
+    def save_summary(self, user_id: str | None, summary: str) -> None:
+        raise NotImplementedError
+
+    def list_users(self) -> list[str]:
+        raise NotImplementedError
+
+    def get_tokens(self) -> dict[str, str]:
+        raise NotImplementedError
+
+    def set_token(self, user_id: str, token: str) -> None:
+        raise NotImplementedError
+
+    def get_blacklist(self) -> list[str]:
+        raise NotImplementedError
+
+    def set_blacklist(self, user_ids: list[str]) -> None:
+        raise NotImplementedError
+
+    def add_to_blacklist(self, user_id: str) -> bool:
+        raise NotImplementedError
+
+    def remove_from_blacklist(self, user_id: str) -> bool:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+_stripe_locks = [threading.RLock() for _ in range(LOCK_STRIPES)]
+
+
+def lock_for(key) -> threading.RLock:
+    '''
+    获取某个用户（或某个全局文件）对应的分段锁。
+
+    同一个键总是得到同一把锁；锁是可重入的，同一线程可以嵌套获取。
+
+    :param key: 用户ID或文件路径
+    '''
+    return _stripe_locks[hash(key) % LOCK_STRIPES]
+
+
+# 读缓存：{文件路径: ((mtime_ns, size), 解析后的数据)}
+_read_cache = {}
+_read_cache_lock = threading.Lock()
+
+
+def _file_signature(file_path: str) -> tuple[int, int] | None:
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def read_json(file_path: str, default=None):
+    '''
+    读取JSON文件，文件的mtime和大小没有变化时直接返回缓存。
+
+    返回的是缓存数据的副本，调用方可以随意修改。
+
+    :param file_path: 文件路径
+    :param default: 文件不存在或为空时的返回值（为None时抛出异常）
+    '''
+    signature = _file_signature(file_path)
+    if default is not None and (signature is None or signature[1] == 0):
+        return copy.deepcopy(default)
+    with _read_cache_lock:
+        cached = _read_cache.get(file_path)
+    if cached is not None and signature is not None and cached[0] == signature:
+        return copy.deepcopy(cached[1])
+    with open(file_path, encoding='UTF-8') as f:
+        value = json.load(f)
+    if signature is not None:
+        with _read_cache_lock:
+            _read_cache[file_path] = (signature, value)
+    return copy.deepcopy(value)
+
+
+def atomic_write(file_path: str, writer) -> None:
+    '''
+    原子写入文件：先写入同目录下的临时文件，再用`os.replace`替换。
+
+    写入过程中崩溃或并发读取都不会看到被截断的文件。
+
+    :param file_path: 目标文件路径
+    :param writer: 接收文件对象的写入函数
+    '''
+    tmp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, mode='w', encoding='UTF-8') as f:
+            writer(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_json(context, file_path):
+    atomic_write(file_path, lambda f: json.dump(
+        context,
+        f,
+        ensure_ascii = False,
+        indent       = 4
+    ))
+    # 自己写入的数据直接更新缓存，下次读取无需重新解析
+    signature = _file_signature(file_path)
+    with _read_cache_lock:
+        if signature is None:
+            _read_cache.pop(file_path, None)
+        else:
+            _read_cache[file_path] = (signature, copy.deepcopy(context))
+
+
+class JsonStorage(StorageBackend):
+    '''
+    JSON文件存储后端（默认）。
+
+    每个用户一个目录`data/users/<分片>/<user_id>/`，包含上下文日志`context.log`、`memory.json`和滚动摘要`summary.json`，
+    分片是用户ID哈希值的前两位十六进制字符，避免单个目录下出现上万个条目。
+    用户目录和文件在第一次写入时才创建，只读操作不会在磁盘上留下任何东西。
+    token和黑名单分别保存在`data/pass.json`和`data/blacklist.json`。
+
+    上下文日志是只追加的JSON Lines文件，每条上下文一行；最近的记录同时保存在内存环形缓冲区中，
+    读取时不需要访问磁盘。日志超过窗口大小的`CONTEXT_COMPACT_FACTOR`倍时才整体重写一次。
+    '''
+
+    name = 'json'
+
+    def __init__(self, base_dir: str = DATA_DIR):
+        self.base_dir = base_dir
+        self.pass_path = os.path.join(base_dir, 'pass.json')
+        self.blacklist_path = os.path.join(base_dir, 'blacklist.json')
+        self.users_dir = os.path.join(base_dir, 'users')
+        # 上下文环形缓冲区：{日志路径: {'ring': deque, 'lines': 日志行数, 'signature': 文件签名}}
+        # 每个用户的读写都在该用户的分段锁内进行
+        self._rings = {}
+        # 已确认存在的用户目录，避免每次写入都调用makedirs
+        self._known_dirs = set()
+        self.migrate_flat_layout()
+
+    def user_paths(self, user_id: str | None = None) -> dict:
+        '''
+        获取用户数据文件路径。
+
+        :param user_id: 用户ID，如果为None则返回默认路径
+        '''
+        base = self.base_dir if user_id is None else self.user_dir(user_id)
+        return {
+            'dir':         base,
+            'context':     os.path.join(base, 'context.json'),
+            'context_log': os.path.join(base, 'context.log'),
+            'memory':      os.path.join(base, 'memory.json'),
+            'summary':     os.path.join(base, 'summary.json')
+        }
+
+    def user_dir(self, user_id: str) -> str:
+        '''获取用户目录（按用户ID哈希分片）。'''
+        user_id = str(user_id)
+        shard = hashlib.sha1(user_id.encode('UTF-8')).hexdigest()[:2]
+        return os.path.join(self.users_dir, shard, user_id)
+
+    def _ensure_dir(self, paths: dict) -> None:
+        directory = paths['dir']
+        if directory in self._known_dirs:
+            return
+        os.makedirs(directory, exist_ok=True)
+        self._known_dirs.add(directory)
+
+    def migrate_flat_layout(self) -> int:
+        '''
+        将旧版`data/<user_id>/`目录迁移到分片目录`data/users/<分片>/<user_id>/`。
+
+        :return: 迁移的用户数
+        '''
+        moved = 0
+        if not os.path.isdir(self.base_dir):
+            return moved
+        for entry in os.listdir(self.base_dir):
+            source = os.path.join(self.base_dir, entry)
+            if entry == 'users' or not os.path.isdir(source):
+                continue
+            if not any(
+                os.path.exists(os.path.join(source, name))
+                for name in ('context.log', 'context.json', 'memory.json')
+            ):
+                continue
+            target = self.user_dir(entry)
+            if os.path.exists(target):
+                print(f'[存储] 分片目录已存在，跳过迁移: {source} -> {target}')
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(source, target)
+            moved += 1
+        if moved:
+            print(f'[存储] 已将 {moved} 个用户目录迁移到分片目录 {self.users_dir}')
+        return moved
+
+    @staticmethod
+    def _read_log(path: str) -> list:
+        items = []
+        try:
+            with open(path, encoding='UTF-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        items.append(json.loads(line))
+                    except ValueError:
+                        # 进程崩溃时可能留下写了一半的最后一行，跳过即可
+                        continue
+        except FileNotFoundError:
+            pass
+        return items
+
+    @staticmethod
+    def _write_log(path: str, items) -> None:
+        atomic_write(path, lambda f: f.writelines(
+            json.dumps(item, ensure_ascii=False, separators=(',', ':')) + '\n' for item in items
+        ))
+
+    def _legacy_to_log(self, paths: dict) -> None:
+        '''将旧版`context.json`转换为上下文日志。'''
+        if os.path.exists(paths['context_log']) or not os.path.exists(paths['context']):
+            return
+        legacy = read_json(paths['context'], default=[])
+        self._write_log(paths['context_log'], legacy if isinstance(legacy, list) else [])
+        os.remove(paths['context'])
+
+    def _ring(self, paths: dict, limit: int) -> dict:
+        '''获取上下文环形缓冲区，日志被外部修改或窗口大小变化时重新加载。'''
+        log_path = paths['context_log']
+        signature = _file_signature(log_path)
+        state = self._rings.get(log_path)
+        if state is not None and state['signature'] == signature and state['ring'].maxlen == limit:
+            return state
+        self._legacy_to_log(paths)
+        items = self._read_log(log_path)
+        state = {
+            'ring': deque(items, maxlen=limit),
+            'lines': len(items),
+            'signature': _file_signature(log_path)
+        }
+        self._rings[log_path] = state
+        return state
+
+    def load_context(self, user_id, limit=0):
+        paths = self.user_paths(user_id)
+        with lock_for(user_id):
+            if limit <= 0:
+                self._legacy_to_log(paths)
+                return self._read_log(paths['context_log'])
+            return list(self._ring(paths, limit)['ring'])
+
+    def append_context(self, user_id, item, limit):
+        paths = self.user_paths(user_id)
+        log_path = paths['context_log']
+        with lock_for(user_id):
+            state = self._ring(paths, limit) if limit > 0 else None
+            self._ensure_dir(paths)
+            with open(log_path, mode='a', encoding='UTF-8') as f:
+                f.write(json.dumps(item, ensure_ascii=False, separators=(',', ':')) + '\n')
+            if state is None:
+                return []
+            ring = state['ring']
+            evicted = [ring[0]] if len(ring) == limit else []
+            ring.append(item)
+            state['lines'] += 1
+            if state['lines'] > limit * CONTEXT_COMPACT_FACTOR:
+                # 压缩：只保留窗口内的记录
+                self._write_log(log_path, state['ring'])
+                state['lines'] = len(state['ring'])
+            state['signature'] = _file_signature(log_path)
+            return evicted
+
+    def replace_context(self, user_id, items):
+        paths = self.user_paths(user_id)
+        with lock_for(user_id):
+            self._ensure_dir(paths)
+            self._write_log(paths['context_log'], items)
+            if os.path.exists(paths['context']):
+                os.remove(paths['context'])
+            self._rings.pop(paths['context_log'], None)
+
+    def load_memory(self, user_id):
+        return read_json(self.user_paths(user_id)['memory'], default=[])
+
+    def append_memory(self, user_id, item):
+        paths = self.user_paths(user_id)
+        path = paths['memory']
+        with lock_for(user_id):
+            self._ensure_dir(paths)
+            memory_list = read_json(path, default=[])
+            memory_list.append(item)
+            write_json(memory_list, path)
+
+    def remove_memory(self, user_id, item):
+        path = self.user_paths(user_id)['memory']
+        with lock_for(user_id):
+            memory_list = read_json(path, default=[])
+            memory_list.remove(item)
+            write_json(memory_list, path)
+
+    def replace_memory(self, user_id, items):
+        paths = self.user_paths(user_id)
+        with lock_for(user_id):
+            self._ensure_dir(paths)
+            write_json(list(items), paths['memory'])
+
+    def load_summary(self, user_id):
+        saved = read_json(self.user_paths(user_id)['summary'], default={})
+        return saved.get('summary', '') if isinstance(saved, dict) else ''
+
+    def save_summary(self, user_id, summary):
+        paths = self.user_paths(user_id)
+        with lock_for(user_id):
+            if not summary and not os.path.exists(paths['summary']):
+                return
+            self._ensure_dir(paths)
+            write_json({'summary': summary}, paths['summary'])
+
+    def list_users(self):
+        users = []
+        if not os.path.isdir(self.users_dir):
+            return users
+        for shard in os.listdir(self.users_dir):
+            shard_dir = os.path.join(self.users_dir, shard)
+            if os.path.isdir(shard_dir):
+                users.extend(
+                    entry for entry in os.listdir(shard_dir)
+                    if os.path.isdir(os.path.join(shard_dir, entry))
+                )
+        return sorted(users)
+
+    def get_tokens(self):
+        try:
+            tokens = read_json(self.pass_path, default={})
+            return tokens if isinstance(tokens, dict) else {}
+        except Exception:
+            return {}
+
+    def set_token(self, user_id, token):
+        with lock_for(self.pass_path):
+            tokens = self.get_tokens()
+            tokens[user_id] = token
+            write_json(tokens, self.pass_path)
+
+    def get_blacklist(self):
+        try:
+            blacklist = read_json(self.blacklist_path, default=[])
+            return blacklist if isinstance(blacklist, list) else []
+        except Exception:
+            return []
+
+    def set_blacklist(self, user_ids):
+        with lock_for(self.blacklist_path):
+            write_json(list(user_ids), self.blacklist_path)
+
+    def add_to_blacklist(self, user_id):
+        with lock_for(self.blacklist_path):
+            blacklist = self.get_blacklist()
+            if user_id in blacklist:
+                return False
+            blacklist.append(user_id)
+            write_json(blacklist, self.blacklist_path)
+            return True
+
+    def remove_from_blacklist(self, user_id):
+        with lock_for(self.blacklist_path):
+            blacklist = self.get_blacklist()
+            if user_id not in blacklist:
+                return False
+            blacklist.remove(user_id)
+            write_json(blacklist, self.blacklist_path)
+            return True
+
+
+class SqliteStorage(StorageBackend):
+    '''
+    SQLite存储后端（WAL模式）。
+
+    所有用户的数据保存在同一个数据库文件中，每次修改只写入变化的行，
+    并发写入由SQLite事务保证不会丢失更新。连接从有上限的连接池中借用，用完归还，线程退出不会留下连接。
+    '''
+
+    name = 'sqlite'
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS context (
+            id      INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            content TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_context_user ON context (user_id, id);
+        CREATE TABLE IF NOT EXISTS memory (
+            id      INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            content TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_memory_user ON memory (user_id, id);
+        CREATE TABLE IF NOT EXISTS tokens (
+            user_id TEXT PRIMARY KEY,
+            token   TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS summary (
+            user_id TEXT PRIMARY KEY,
+            content TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS blacklist (
+            id      INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL UNIQUE
+        );
+    '''
+
+    def __init__(self, path: str = DEFAULT_SQLITE_PATH, pool_size: int = SQLITE_POOL_SIZE):
+        self.path = path
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._idle = []  # 空闲的连接
+        self._pool_lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._read(lambda conn: conn.executescript(self.SCHEMA))
+
+    @staticmethod
+    def _key(user_id: str | None) -> str:
+        # 默认数据（user_id为None）使用空字符串作为键
+        return '' if user_id is None else str(user_id)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=30000')
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        '''从连接池借用一个连接，连接池已满时等待其他线程归还。'''
+        self._slots.acquire()
+        conn = None
+        try:
+            with self._pool_lock:
+                if self._idle:
+                    conn = self._idle.pop()
+            if conn is None:
+                conn = self._connect()
+            yield conn
+        except BaseException:
+            if conn is not None and conn.in_transaction:
+                # 事务没有正常结束（例如ROLLBACK本身失败），丢弃这个连接
+                conn.close()
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                with self._pool_lock:
+                    self._idle.append(conn)
+            self._slots.release()
+
+    def _read(self, func):
+        '''用连接池中的连接执行`func(conn)`。'''
+        with self._connection() as conn:
+            return func(conn)
+
+    def _write(self, func):
+        '''在一个写事务中执行`func(conn)`。'''
+        with self._connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = func(conn)
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            return result
+
+    @staticmethod
+    def _encode_context(item) -> str:
+        # 结构化记录保存为紧凑的JSON文本，旧版字符串原样保存
+        return item if isinstance(item, str) else json.dumps(item, ensure_ascii=False, separators=(',', ':'))
+
+    @staticmethod
+    def _decode_context(content: str):
+        if content.startswith('{'):
+            try:
+                return json.loads(content)
+            except ValueError:
+                pass
+        return content
+
+    def _load(self, table: str, user_id) -> list:
+        rows = self._read(lambda conn: conn.execute(
+            f'SELECT content FROM {table} WHERE user_id = ? ORDER BY id',
+            (self._key(user_id),)
+        ).fetchall())
+        return [row[0] for row in rows]
+
+    def _replace(self, table: str, user_id, items) -> None:
+        key = self._key(user_id)
+
+        def _run(conn):
+            conn.execute(f'DELETE FROM {table} WHERE user_id = ?', (key,))
+            conn.executemany(
+                f'INSERT INTO {table} (user_id, content) VALUES (?, ?)',
+                [(key, item) for item in items]
+            )
+
+        self._write(_run)
+
+    def load_context(self, user_id, limit=0):
+        if limit <= 0:
+            return [self._decode_context(content) for content in self._load('context', user_id)]
+        rows = self._read(lambda conn: conn.execute(
+            '''SELECT content FROM (
+                SELECT id, content FROM context WHERE user_id = ? ORDER BY id DESC LIMIT ?
+            ) ORDER BY id''',
+            (self._key(user_id), limit)
+        ).fetchall())
+        return [self._decode_context(row[0]) for row in rows]
+
+    def load_memory(self, user_id):
+        return self._load('memory', user_id)
+
+    def append_context(self, user_id, item, limit):
+        key = self._key(user_id)
+
+        def _run(conn):
+            conn.execute(
+                'INSERT INTO context (user_id, content) VALUES (?, ?)', (key, self._encode_context(item))
+            )
+            if limit <= 0:
+                return []
+            # 刚好被挤出窗口的那一条
+            evicted = conn.execute(
+                'SELECT content FROM context WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?',
+                (key, limit)
+            ).fetchall()
+            # 窗口外的旧记录不会被读取，该用户的记录超过窗口的`CONTEXT_COMPACT_FACTOR`倍时才清理
+            count = conn.execute('SELECT COUNT(*) FROM context WHERE user_id = ?', (key,)).fetchone()[0]
+            if count > limit * CONTEXT_COMPACT_FACTOR:
+                conn.execute(
+                    '''DELETE FROM context WHERE user_id = ? AND id <= (
+                        SELECT id FROM context WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?
+                    )''',
+                    (key, key, limit)
+                )
+            return [self._decode_context(row[0]) for row in evicted]
+
+        return self._write(_run)
+
+    def replace_context(self, user_id, items):
+        self._replace('context', user_id, [self._encode_context(item) for item in items])
+
+    def append_memory(self, user_id, item):
+        self._write(lambda conn: conn.execute(
+            'INSERT INTO memory (user_id, content) VALUES (?, ?)',
+            (self._key(user_id), item)
+        ))
+
+    def remove_memory(self, user_id, item):
+        key = self._key(user_id)
+
+        def _run(conn):
+            row = conn.execute(
+                'SELECT id FROM memory WHERE user_id = ? AND content = ? ORDER BY id LIMIT 1',
+                (key, item)
+            ).fetchone()
+            if row is None:
+                raise ValueError('memory item not found')
+            conn.execute('DELETE FROM memory WHERE id = ?', (row[0],))
+
+        self._write(_run)
+
+    def replace_memory(self, user_id, items):
+        self._replace('memory', user_id, items)
+
+    def load_summary(self, user_id):
+        row = self._read(lambda conn: conn.execute(
+            'SELECT content FROM summary WHERE user_id = ?', (self._key(user_id),)
+        ).fetchone())
+        return row[0] if row else ''
+
+    def save_summary(self, user_id, summary):
+        self._write(lambda conn: conn.execute(
+            'INSERT INTO summary (user_id, content) VALUES (?, ?) '
+            'ON CONFLICT(user_id) DO UPDATE SET content = excluded.content',
+            (self._key(user_id), summary)
+        ))
+
+    def list_users(self):
+        rows = self._read(lambda conn: conn.execute(
+            "SELECT user_id FROM context WHERE user_id != '' UNION SELECT user_id FROM memory WHERE user_id != ''"
+        ).fetchall())
+        return sorted(row[0] for row in rows)
+
+    def get_tokens(self):
+        rows = self._read(lambda conn: conn.execute('SELECT user_id, token FROM tokens').fetchall())
+        return {row[0]: row[1] for row in rows}
+
+    def set_token(self, user_id, token):
+        self._write(lambda conn: conn.execute(
+            'INSERT INTO tokens (user_id, token) VALUES (?, ?) '
+            'ON CONFLICT(user_id) DO UPDATE SET token = excluded.token',
+            (user_id, token)
+        ))
+
+    def get_blacklist(self):
+        rows = self._read(lambda conn: conn.execute('SELECT user_id FROM blacklist ORDER BY id').fetchall())
+        return [row[0] for row in rows]
+
+    def set_blacklist(self, user_ids):
+        def _run(conn):
+            conn.execute('DELETE FROM blacklist')
+            conn.executemany(
+                'INSERT OR IGNORE INTO blacklist (user_id) VALUES (?)',
+                [(user_id,) for user_id in user_ids]
+            )
+
+        self._write(_run)
+
+    def add_to_blacklist(self, user_id):
+        cursor = self._write(lambda conn: conn.execute(
+            'INSERT OR IGNORE INTO blacklist (user_id) VALUES (?)', (user_id,)
+        ))
+        return cursor.rowcount > 0
+
+    def remove_from_blacklist(self, user_id):
+        cursor = self._write(lambda conn: conn.execute(
+            'DELETE FROM blacklist WHERE user_id = ?', (user_id,)
+        ))
+        return cursor.rowcount > 0
+
+    def close(self):
+        # 只关闭空闲的连接，正在使用的连接归还后仍可继续使用
+        with self._pool_lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+def create_backend(storage_config: dict | None = None) -> StorageBackend:
+    '''
+    根据配置创建存储后端。
+
+    :param storage_config: 配置中的`storage`段，例如`{"backend": "sqlite", "sqlite_path": "data/nino.db"}`
+    '''
+    storage_config = storage_config or {}
+    backend = str(storage_config.get('backend', 'json')).strip().lower() or 'json'
+    if backend == 'json':
+        return JsonStorage()
+    if backend == 'sqlite':
+        return SqliteStorage(storage_config.get('sqlite_path') or DEFAULT_SQLITE_PATH)
+    raise ValueError(f'Unknown storage backend: {backend}')
+
+
+def migrate(source: StorageBackend, target: StorageBackend) -> dict:
+    '''
+    将`source`中的所有数据复制到`target`（目标中同一用户的数据会被覆盖）。
+
+    :return: 迁移统计
+    '''
+    stats = {'users': 0, 'context': 0, 'memory': 0, 'tokens': 0, 'blacklist': 0}
+    for user_id in [None] + source.list_users():
+        context_list = source.load_context(user_id)
+        memory_list = source.load_memory(user_id)
+        target.replace_context(user_id, context_list)
+        target.replace_memory(user_id, memory_list)
+        target.save_summary(user_id, source.load_summary(user_id))
+        if user_id is not None:
+            stats['users'] += 1
+        stats['context'] += len(context_list)
+        stats['memory'] += len(memory_list)
+    for user_id, token in source.get_tokens().items():
+        target.set_token(user_id, token)
+        stats['tokens'] += 1
+    blacklist = source.get_blacklist()
+    target.set_blacklist(blacklist)
+    stats['blacklist'] = len(blacklist)
+    return stats
+
+
+def migrate_json_to_sqlite(sqlite_path: str = DEFAULT_SQLITE_PATH, base_dir: str = DATA_DIR) -> dict:
+    '''
+    一次性将JSON目录结构（包括旧版`data/<user_id>/`布局）的数据迁移到SQLite数据库。
+
+    迁移完成后在`data/config.json`中设置`"storage": {"backend": "sqlite"}`即可切换后端。
+    原有的JSON文件不会被删除。
+    '''
+    target = SqliteStorage(sqlite_path)
+    try:
+        return migrate(JsonStorage(base_dir), target)
+    finally:
+        target.close()
+
+
+if __name__ == '__main__':
+    # 用法：python storage.py migrate [sqlite_path]
+    #       python storage.py convert-context
+    #       python storage.py compact-memory
+    if len(sys.argv) >= 2 and sys.argv[1] == 'migrate':
+        path = sys.argv[2] if len(sys.argv) >= 3 else DEFAULT_SQLITE_PATH
+        result = migrate_json_to_sqlite(path)
+        print(
+            f'迁移完成：用户 {result["users"]} 个，上下文 {result["context"]} 条，'
+            f'长期记忆 {result["memory"]} 条，token {result["tokens"]} 个，黑名单 {result["blacklist"]} 个'
+        )
+        print(f'请在 data/config.json 中设置 "storage": {{"backend": "sqlite", "sqlite_path": "{path}"}}')
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'convert-context':
+        # 转换使用当前配置的存储后端
+        import data
+        result = data.convert_context()
+        print(f'转换完成：用户 {result["users"]} 个，上下文 {result["records"]} 条')
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'compact-memory':
+        # 按当前的长期记忆配置合并重复/被更正的记忆，并应用容量限制
+        import data
+        result = data.compact_all_memory()
+        print(f'压缩完成：用户 {result["users"]} 个，移除长期记忆 {result["removed"]} 条')
+    else:
+        print('用法：python storage.py migrate [sqlite_path] | python storage.py convert-context | python storage.py compact-memory')
@@ -0,0 +1,209 @@
+import threading
+import time
+
+import data
+import records
+import settings
+from settings import Config
+
+
+DEFAULT_BATCH_SIZE = 10
+DEFAULT_MAX_WAIT_SECONDS = 600
+DEFAULT_MIN_INTERVAL_SECONDS = 5
+DEFAULT_MAX_CHARS = 800
+DEFAULT_RECENT_WINDOW = 10
+# 每个用户最多积压的批数，摘要服务长时间不可用时丢弃最旧的记录
+MAX_PENDING_BATCHES = 5
+
+SUMMARY_PROMPT = '''你负责维护一段聊天记录的滚动摘要。
+下面给出已有的摘要和刚刚移出聊天窗口的若干条对话，请把新对话中值得记住的内容（话题、事件、约定、用户的情绪和状态等）合并进摘要。
+要求：使用第三人称，"用户"指对方，"你"指AI自己；只输出新的完整摘要，不要输出其他内容；不超过{max_chars}字，越早的内容越概括。'''
+
+
+def _number(value, default, cast=float, minimum=0):
+    try:
+        parsed = cast(value)
+    except (TypeError, ValueError):
+        return default
+    return parsed if parsed >= minimum else default
+
+
+def normalize_summary_config(config: dict) -> dict:
+    '''
+    规范化配置中的`context_summary`段。
+
+    :param config: 配置快照或配置字典
+    '''
+    if isinstance(config, Config):
+        return config.memo('context_summary', lambda: _normalize_summary_config(config))
+    return _normalize_summary_config(config)
+
+
+def _normalize_summary_config(config: dict) -> dict:
+    section = config.get('context_summary')
+    if not isinstance(section, dict):
+        section = {}
+    return {
+        'enabled': bool(section.get('enabled', False)),
+        # 为空时使用 model
+        'model': str(section.get('model') or config.get('model', 'deepseek-chat')),
+        'batch_size': _number(section.get('batch_size'), DEFAULT_BATCH_SIZE, int, 1),
+        'max_wait_seconds': _number(section.get('max_wait_seconds'), DEFAULT_MAX_WAIT_SECONDS),
+        'min_interval_seconds': _number(section.get('min_interval_seconds'), DEFAULT_MIN_INTERVAL_SECONDS),
+        'max_chars': _number(section.get('max_chars'), DEFAULT_MAX_CHARS, int, 50),
+        'recent_window': _number(section.get('recent_window'), DEFAULT_RECENT_WINDOW, int, 1),
+    }
+
+
+def render_entry(record: records.ContextRecord) -> str:
+    '''把一条上下文记录转换为摘要输入中的一行'''
+    if record.role == records.ROLE_ASSISTANT:
+        return f"你: {record.text} {record.double}".rstrip()
+    return f"[{record.ctime}] 用户: {record.text}" if record.epoch else f"用户: {record.text}"
+
+
+class Summarizer:
+    '''
+    后台摘要器：把移出上下文窗口的记录合并进每个用户的滚动摘要。
+
+    移出的记录先在内存中按用户积攒，凑满`batch_size`条或最早一条等待超过`max_wait_seconds`后，
+    由后台线程调用一次模型生成新摘要；两次调用之间至少间隔`min_interval_seconds`秒（所有用户共用）。
+    积攒中的记录只保存在内存里，进程退出时尚未摘要的部分会丢失。
+    用户的上下文被清空或覆盖时调用`forget()`，丢弃积攒的记录和正在生成的摘要。
+    '''
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = {}  # {user_id: {'items': [...], 'since': 第一条到达的时间}}
+        self.generations = {}  # {user_id: 调用forget()的次数}，用于丢弃清空上下文之前开始生成的摘要
+        self.completer = None
+        self.next_call = 0.0
+        self.thread = None
+
+    def set_completer(self, completer) -> None:
+        '''
+        设置调用模型的函数。
+
+        :param completer: `completer(messages, model) -> str`，失败时抛出异常
+        '''
+        self.completer = completer
+
+    def submit(self, user_id: str | None, evicted: list) -> None:
+        '''积攒移出窗口的记录（`data.add_eviction_listener()`的回调），不会阻塞调用方'''
+        config = normalize_summary_config(settings.get_config())
+        if not config['enabled']:
+            return
+        with self.condition:
+            entry = self.pending.setdefault(user_id, {'items': [], 'since': time.monotonic()})
+            entry['items'].extend(evicted)
+            self._limit_backlog(user_id, entry, config)
+            self._ensure_thread()
+            self.condition.notify()
+
+    def forget(self, user_id: str | None) -> None:
+        '''丢弃用户积攒的记录，正在生成的摘要完成后也不会保存（`data.add_reset_listener()`的回调）'''
+        with self.condition:
+            self.pending.pop(user_id, None)
+            self.generations[user_id] = self.generations.get(user_id, 0) + 1
+
+    @staticmethod
+    def _limit_backlog(user_id: str | None, entry: dict, config: dict):
+        '''积压超过`MAX_PENDING_BATCHES`批时丢弃最旧的记录（需持有`condition`）'''
+        overflow = len(entry['items']) - config['batch_size'] * MAX_PENDING_BATCHES
+        if overflow > 0:
+            print(f'[滚动摘要] 用户 {user_id} 积压过多，丢弃最旧的 {overflow} 条')
+            del entry['items'][:overflow]
+
+    def _ensure_thread(self):
+        '''启动后台线程（需持有`condition`）'''
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, name='summarizer', daemon=True)
+            self.thread.start()
+
+    def _next_batch(self, config: dict):
+        '''
+        取出下一个可以摘要的批次（需持有`condition`）。
+
+        :return: (用户ID, 记录列表)，或者(None, 需要等待的秒数)
+        '''
+        now = time.monotonic()
+        if now < self.next_call:
+            return None, self.next_call - now
+        wait = None
+        for user_id, entry in self.pending.items():
+            if len(entry['items']) >= config['batch_size'] or now - entry['since'] >= config['max_wait_seconds']:
+                del self.pending[user_id]
+                return user_id, entry['items']
+            remaining = config['max_wait_seconds'] - (now - entry['since'])
+            wait = remaining if wait is None else min(wait, remaining)
+        return None, wait
+
+    def _run(self):
+        while True:
+            config = normalize_summary_config(settings.get_config())
+            with self.condition:
+                user_id, batch = self._next_batch(config)
+                if not isinstance(batch, list):
+                    self.condition.wait(batch)
+                    continue
+                self.next_call = time.monotonic() + config['min_interval_seconds']
+                generation = self.generations.get(user_id, 0)
+            try:
+                self.summarize(user_id, batch, config, generation)
+            except Exception as e:
+                print(f'[滚动摘要] 用户 {user_id} 的摘要生成失败，稍后重试: {e}')
+                with self.condition:
+                    if self.generations.get(user_id, 0) != generation:
+                        continue
+                    entry = self.pending.setdefault(user_id, {'items': [], 'since': time.monotonic()})
+                    # 放回队列，之后的重试同样受`min_interval_seconds`限制
+                    entry['items'][:0] = batch
+                    self._limit_backlog(user_id, entry, config)
+
+    def summarize(self, user_id: str | None, items: list, config: dict, generation: int | None = None) -> str:
+        '''
+        把`items`合并进用户的滚动摘要并保存。
+
+        :param generation: 开始时的`generations`计数，期间调用过`forget()`时不保存
+        :return: 新的摘要
+        '''
+        if self.completer is None:
+            raise RuntimeError('没有可用的模型调用函数')
+        previous = data.load_summary(user_id)
+        lines = '\n'.join(render_entry(item) for item in items)
+        messages = [
+            {"role": "system", "content": SUMMARY_PROMPT.format(max_chars=config['max_chars'])},
+            {"role": "user", "content": f"已有的摘要：\n{previous or '（暂无）'}\n\n新移出窗口的对话：\n{lines}"},
+        ]
+        result = self.completer(messages, config['model']).strip()
+        if not result:
+            raise ValueError('模型返回了空摘要')
+        result = result[:config['max_chars']]
+        # 持有`condition`保存，与`forget()`互斥
+        with self.condition:
+            if generation is not None and self.generations.get(user_id, 0) != generation:
+                print(f'[滚动摘要] 用户 {user_id} 的上下文已被清空，丢弃生成的摘要')
+                return previous
+            data.save_summary(result, user_id)
+        return result
+
+
+summarizer = Summarizer()
+data.add_eviction_listener(summarizer.submit)
+data.add_reset_listener(summarizer.forget)
+
+
+def get_summary(user_id: str | None, config: dict) -> str:
+    '''
+    读取用于提示词的滚动摘要，未启用时返回空字符串。
+
+    :param user_id: 用户ID
+    :param config: 配置快照
+    '''
+    if not normalize_summary_config(config)['enabled']:
+        return ''
+    try:
+        return data.load_summary(user_id)
+    except Exception as e:
+        print(f'[滚动摘要] 读取失败: {e}')
+        return ''